@@ -0,0 +1,64 @@
+import asyncio
+import socket
+import unittest
+import traceflow.aio
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_trace(self):
+        # Loopback answers the very first probe with a port unreachable
+        traces = self.loop.run_until_complete(
+            traceflow.aio.trace("127.0.0.1", 2, max_ttl=4, to_wait=0.5)
+        )
+        self.assertDictEqual(traces, {1: {1: "127.0.0.1"}, 2: {1: "127.0.0.1"}})
+
+    def test_trace_probe_id(self):
+        for probe_id in ["srcport", "checksum"]:
+            traces = self.loop.run_until_complete(
+                traceflow.aio.trace("127.0.0.1", 300, max_ttl=3, probe_id=probe_id)
+            )
+            self.assertEqual(len(traces), 300)
+
+    def test_concurrent_traces(self):
+        async def run():
+            return await asyncio.gather(
+                traceflow.aio.trace("127.0.0.1", 2, src_port=40000, to_wait=0.5),
+                traceflow.aio.trace("127.0.0.1", 3, src_port=41000, to_wait=0.5),
+            )
+
+        first, second = self.loop.run_until_complete(run())
+        self.assertListEqual(sorted(first), [1, 2])
+        self.assertListEqual(sorted(second), [1, 2, 3])
+        # Both traces are done, so the shared sockets should have been released
+        self.assertDictEqual(traceflow.aio._trace_io._instances, {})
+
+    def test_send_resumes(self):
+        class short_sender:
+            # Only gets two probes out per call, as a busy non-blocking socket might
+            def __init__(self):
+                self.raw_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sent = list()
+
+            def send_batch(self, probes):
+                self.sent.extend(probes[:2])
+                return min(2, len(probes))
+
+        io = traceflow.aio._trace_io.get(self.loop)
+        sender, io.sender = io.sender, short_sender()
+        try:
+            self.loop.run_until_complete(io.send([b"1", b"2", b"3", b"4", b"5"]))
+            self.assertListEqual(io.sender.sent, [b"1", b"2", b"3", b"4", b"5"])
+        finally:
+            io.sender.raw_sock.close()
+            io.sender = sender
+            io.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
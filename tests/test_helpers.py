@@ -1,6 +1,8 @@
 import unittest
 import traceflow.helpers as helpers
 import argparse
+import tempfile
+import time
 
 
 class Test__main__(unittest.TestCase):
@@ -16,6 +18,13 @@ class Test__main__(unittest.TestCase):
         self.assertIsInstance(ipid, int)
         self.assertEqual(ipid, 257)
 
+    def test_time_ns(self):
+        before = int(time.time() * 1e9)
+        now = helpers._time_ns()
+        self.assertIsInstance(now, int)
+        self.assertLess(abs(now - before), 1_000_000_000)
+        self.assertLess(abs(helpers.time_ns() - now), 1_000_000_000)
+
     def test_help_text(self):
         helptext = helpers.help_text()
         self.assertIsInstance(helptext, str)
@@ -25,6 +34,16 @@ class Test__main__(unittest.TestCase):
     #    args = helpers.get_help()
     #    self.assertIsInstance(args, argparse.Namespace)
 
+    def test_get_destinations(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("# comment\n1.1.1.1\n\n8.8.8.8\n")
+            f.flush()
+            args = argparse.Namespace(
+                destination=["9.9.9.9", "1.1.1.1"], targets=f.name
+            )
+            destinations = helpers.get_destinations(args)
+        self.assertListEqual(destinations, ["9.9.9.9", "1.1.1.1", "8.8.8.8"])
+
     def test_remove_duplicates(self):
         duplicate_paths = {1: {1: "1.1.1.1", 2: "1.1.1.1"}}
         dedup_example = {1: {1: "1.1.1.1"}}
@@ -63,6 +82,78 @@ class Test__main__(unittest.TestCase):
         dedup_result = helpers.remove_duplicate_paths(duplicate_paths)
         self.assertDictEqual(dedup_example, dedup_result)
 
+    def test_find_diamonds(self):
+        traces = {
+            1: {1: "10.0.0.1", 2: "10.0.1.1", 3: "10.0.2.1", 4: "10.0.9.1"},
+            2: {1: "10.0.0.1", 2: "10.0.1.2", 3: "*", 4: "10.0.9.1"},
+            3: {1: "10.0.0.1", 2: "10.0.1.3", 3: "10.0.2.2", 4: "x"},
+        }
+        self.assertListEqual(
+            helpers.find_diamonds(traces),
+            [
+                {
+                    "start_ttl": 1,
+                    "start": "10.0.0.1",
+                    "width": 3,
+                    "end_ttl": 4,
+                    "end": "10.0.9.1",
+                }
+            ],
+        )
+        self.assertListEqual(helpers.find_diamonds({1: traces[1]}), [])
+
+    def test_get_schedule(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("# comment\n1.1.1.1 60\n8.8.8.8\n")
+            f.flush()
+            args = argparse.Namespace(
+                destination=["9.9.9.9"], targets=f.name, interval=300.0
+            )
+            self.assertDictEqual(
+                helpers.get_schedule(args),
+                {"9.9.9.9": 300.0, "1.1.1.1": 60.0, "8.8.8.8": 300.0},
+            )
+
+            self.assertListEqual(
+                helpers.get_destinations(args), ["9.9.9.9", "1.1.1.1", "8.8.8.8"]
+            )
+
+    def test_get_schedule_bad_interval(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("1.1.1.1 60\n8.8.8.8 often\n")
+            f.flush()
+            args = argparse.Namespace(destination=[], targets=f.name, interval=300.0)
+            with self.assertLogs(level="ERROR") as logs:
+                with self.assertRaises(SystemExit):
+                    helpers.get_schedule(args)
+        self.assertIn(f"{f.name}:2:", logs.output[0])
+
+    def test_diff_paths(self):
+        old = helpers.distinct_paths({1: {1: "a", 2: "b"}, 2: {1: "a", 2: "b"}})
+        self.assertEqual(len(old), 1)
+        new = helpers.distinct_paths({1: {1: "a", 2: "b"}, 2: {1: "a", 2: "c", 3: "x"}})
+        self.assertTupleEqual(helpers.diff_paths(old, new), ([("a", "c")], []))
+        self.assertTupleEqual(helpers.diff_paths(new, old), ([], [("a", "c")]))
+        self.assertTupleEqual(helpers.diff_paths(None, old), ([("a", "b")], []))
+
+    def test_group_paths(self):
+        traces = {
+            3: {1: "a", 2: "b"},
+            1: {1: "a", 2: "b"},
+            2: {1: "a", 2: "c"},
+            4: {2: "c", 1: "a"},
+        }
+        groups = helpers.group_paths(traces)
+        self.assertListEqual(list(groups.values()), [[1, 3], [2, 4]])
+        self.assertEqual(list(groups)[0], helpers.path_fingerprint(("a", "b")))
+        self.assertNotEqual(
+            helpers.path_fingerprint(["a", "bc"]), helpers.path_fingerprint(["ab", "c"])
+        )
+        self.assertDictEqual(
+            helpers.remove_duplicate_paths(traces, groups),
+            {1: {1: "a", 2: "b"}, 2: {1: "a", 2: "c"}},
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,167 @@
+import multiprocessing
+import os
+import struct
+import tempfile
+import unittest
+import traceflow
+from traceflow import hop_event
+
+
+def _trace(target, hops):
+    # One event per hop of each path, the last one final
+    events = list()
+    for path, responders in hops.items():
+        for ttl, responder in enumerate(responders, 1):
+            final = ttl == len(responders)
+            events.append(
+                hop_event(target, path, ttl, responder, 1.0 * ttl, 11, 0, final)
+            )
+    return events
+
+
+def _postings(name):
+    # Every position in a postings file, past its magic
+    with open(name, "rb") as f:
+        data = f.read()[8:]
+    return struct.unpack("<%dQ" % (len(data) // 8), data[: len(data) // 8 * 8])
+
+
+class TestHistoryStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = traceflow.history_store(os.path.join(self.dir.name, "history"))
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def _add(self, when, target, hops):
+        for event in _trace(target, hops):
+            self.store.update(event)
+        self.store.flush(when)
+
+    def test_latest(self):
+        self.assertIsNone(self.store.latest("1.1.1.1"))
+        self._add(100, "1.1.1.1", {1: ["10.0.0.1", "1.1.1.1"]})
+        self._add(200, "8.8.8.8", {1: ["10.0.0.1", "8.8.8.8"]})
+        self._add(300, "1.1.1.1", {1: ["10.0.0.2", "1.1.1.1"], 2: ["1.1.1.1"]})
+        self._add(400, "8.8.8.8", {1: ["10.0.0.1", "8.8.8.8"]})
+        trace = self.store.latest("1.1.1.1")
+        self.assertEqual(trace.time, 300)
+        self.assertDictEqual(
+            trace.traces, {1: {1: "10.0.0.2", 2: "1.1.1.1"}, 2: {1: "1.1.1.1", 2: "x"}}
+        )
+        self.assertDictEqual(trace.rtts, {1: {1: 1.0, 2: 2.0}, 2: {1: 1.0}})
+        self.assertIsNone(self.store.latest("9.9.9.9"))
+
+    def test_traces(self):
+        self._add(100, "1.1.1.1", {1: ["10.0.0.1", "1.1.1.1"]})
+        self._add(200, "8.8.8.8", {1: ["10.0.0.2", "8.8.8.8"]})
+        self._add(300, "1.1.1.1", {1: ["10.0.0.2", "1.1.1.1"]})
+        # Nothing answered, still a trace
+        self.store.update(hop_event("8.8.8.8", 1, 1))
+        self.store.flush(400)
+        self._add(500, "1.1.1.1", {1: ["10.0.0.2", "10.0.0.2", "1.1.1.1"]})
+        self.assertEqual(len(self.store), 5)
+        times = lambda traces: [t.time for t in traces]
+        self.assertListEqual(times(self.store.traces()), [100, 200, 300, 400, 500])
+        self.assertListEqual(
+            times(self.store.traces(since=200, until=400)), [200, 300, 400]
+        )
+        self.assertListEqual(times(self.store.traces("8.8.8.8")), [200, 400])
+        self.assertDictEqual(self.store.latest("8.8.8.8").traces, {})
+        # Once per trace, however many times the hop is on it
+        self.assertListEqual(
+            times(self.store.traces(through="10.0.0.2")), [200, 300, 500]
+        )
+        self.assertListEqual(
+            times(self.store.traces("1.1.1.1", since=150, through="10.0.0.2")),
+            [300, 500],
+        )
+        self.assertListEqual(times(self.store.traces(through="10.9.9.9")), [])
+        self.assertListEqual(times(self.store.traces(since=600)), [])
+
+    def test_processes(self):
+        def write(n):
+            with traceflow.history_store(self.store.path) as store:
+                for i in range(200):
+                    for event in _trace(
+                        f"10.1.{n}.1", {1: ["10.0.0.1", f"10.1.{n}.1"]}
+                    ):
+                        store.update(event)
+                    store.flush(i)
+
+        workers = [multiprocessing.Process(target=write, args=(n,)) for n in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(len(self.store), 800)
+        for trace in self.store.traces():
+            self.assertDictEqual(
+                trace.traces, {1: {1: "10.0.0.1", 2: trace.target}}, trace
+            )
+
+    def test_unaligned(self):
+        # 10.0.0.1 as a responder straddling two records, made up of an RTT and what follows it
+        rtt = struct.unpack("<f", bytes([2, 10, 0, 0]))[0]
+        self.store.update(hop_event("1.1.1.1", 1, 1, "10.0.0.3", rtt, 11, 0))
+        self.store.flush(100)
+        self.assertListEqual(list(self.store.traces(through="10.0.0.1")), [])
+        self.assertEqual(len(list(self.store.traces(through="10.0.0.3"))), 1)
+
+    def test_reopen(self):
+        self._add(100, "1.1.1.1", {1: ["10.0.0.1", "1.1.1.1"]})
+        self._add(200, "1.1.1.1", {1: ["10.0.0.2", "1.1.1.1"]})
+        self.store.close()
+        # Half written, as if cut off: only the first trace made it to the index in full
+        with open(self.store.index_file, "r+b") as f:
+            f.truncate(os.path.getsize(self.store.index_file) - 3)
+        store = traceflow.history_store(self.store.path)
+        self.assertEqual(len(store), 1)
+        # The clock went backwards, still appended in order
+        for event in _trace("1.1.1.1", {1: ["10.0.0.3", "1.1.1.1"]}):
+            store.update(event)
+        store.flush(50)
+        self.assertListEqual([t.time for t in store.traces()], [100, 100])
+        self.assertEqual(store.latest("1.1.1.1").traces[1][1], "10.0.0.3")
+        # The cut off trace was posted to its hops, but is not what now has its place in the index
+        self.assertListEqual(list(store.traces(through="10.0.0.2")), [])
+        self.assertEqual(len(list(store.traces(through="10.0.0.3"))), 1)
+        store.close()
+
+    def test_postings(self):
+        self._add(100, "1.1.1.1", {1: ["10.0.0.1", "1.1.1.1"]})
+        self._add(200, "8.8.8.8", {1: ["10.0.0.1", "10.0.0.1", "8.8.8.8"]})
+        self.assertTupleEqual(
+            _postings(os.path.join(self.store.targets_dir, "8.8.8.8")), (1,)
+        )
+        # Once per trace, however many times the hop is on it
+        self.assertTupleEqual(
+            _postings(os.path.join(self.store.hops_dir, "10.0.0.1")), (0, 1)
+        )
+        # Left behind by a write cut off before it got to the index: 2 is about to be taken, and 1 is already
+        # taken by a trace to another target
+        with open(os.path.join(self.store.targets_dir, "1.1.1.1"), "ab") as f:
+            f.write(struct.pack("<QQ", 1, 2) + b"\x00")
+        self.assertEqual(self.store.latest("1.1.1.1").time, 100)
+        self._add(300, "1.1.1.1", {1: ["10.0.0.2", "1.1.1.1"]})
+        self.assertTupleEqual(
+            _postings(os.path.join(self.store.targets_dir, "1.1.1.1")), (0, 1, 2)
+        )
+        self.assertListEqual([t.time for t in self.store.traces("1.1.1.1")], [100, 300])
+        self.assertEqual(self.store.latest("1.1.1.1").time, 300)
+
+    def test_watch(self):
+        events = _trace("1.1.1.1", {1: ["10.0.0.1", "1.1.1.1"]})
+        self.assertEqual(len(list(self.store.watch(iter(events)))), 2)
+        self.assertEqual(self.store.latest("1.1.1.1").traces[1][2], "1.1.1.1")
+        # Nothing stored for a stream given up on part way
+        stream = self.store.watch(iter(events))
+        next(stream)
+        stream.close()
+        self.assertEqual(len(self.store), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import traceflow
+from traceflow import helpers, printer, trace_matrix
+
+
+class TestTraceMatrix(unittest.TestCase):
+    def test_views(self):
+        m = trace_matrix()
+        m.set(2, 3, "10.0.0.3")
+        m.setdefault(1, 1, "10.0.0.1")
+        # Only the first answer is kept
+        m.setdefault(1, 1, "10.0.0.9")
+        self.assertEqual(len(m), 2)
+        self.assertListEqual(list(m), [2, 1])
+        self.assertListEqual(list(m[2]), [3])
+        self.assertEqual(m[1][1], "10.0.0.1")
+        self.assertNotIn(2, m[1])
+        self.assertEqual(m[1].get(3, "x"), "x")
+        self.assertEqual(m, {1: {1: "10.0.0.1"}, 2: {3: "10.0.0.3"}})
+        self.assertDictEqual(m.to_dict(), {2: {3: "10.0.0.3"}, 1: {1: "10.0.0.1"}})
+
+    def test_grow(self):
+        m = trace_matrix([1], 2)
+        for ttl in range(1, 65):
+            m.set(1, ttl, f"10.0.0.{ttl}")
+            m.set(2, 65 - ttl, f"10.0.1.{ttl}")
+        self.assertEqual(m.width, 64)
+        self.assertEqual(m[1][64], "10.0.0.64")
+        self.assertEqual(m[2][1], "10.0.1.64")
+        self.assertEqual(m.nbytes, 4 * m.stride * 2)
+
+    def test_pad(self):
+        traces = {
+            1: {1: "10.0.0.1", 3: "1.1.1.1", 4: "1.1.1.1", 6: "1.1.1.1"},
+            2: {1: "10.0.0.1", 2: "*"},
+            3: {2: "1.1.1.1"},
+        }
+        padded = {
+            1: {1: "10.0.0.1", 2: "*", 3: "1.1.1.1"},
+            2: {1: "10.0.0.1", 2: "*", 3: "x"},
+            3: {1: "*", 2: "1.1.1.1", 3: "x"},
+        }
+        m = trace_matrix.from_dict(traces).pad("1.1.1.1")
+        self.assertEqual(m.width, 3)
+        self.assertDictEqual(m.to_dict(), padded)
+        self.assertDictEqual(helpers.pad_traces(traces, "1.1.1.1"), padded)
+        self.assertEqual(printer.format_vertical(m), printer.format_vertical(padded))
+        self.assertEqual(trace_matrix().pad("1.1.1.1").to_dict(), {})
+
+    def test_collect(self):
+        events = [
+            traceflow.hop_event("1.1.1.1", 1, 1, "10.0.0.1"),
+            traceflow.hop_event("1.1.1.1", 1, 2, "1.1.1.1", final=True),
+        ]
+        results = traceflow.collect_traces(events, ["1.1.1.1"], matrix=True)
+        self.assertIsInstance(results["1.1.1.1"], trace_matrix)
+        self.assertEqual(results["1.1.1.1"][1][2], "1.1.1.1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import http.client
+import os
+import tempfile
+import unittest
+import traceflow
+from traceflow.metrics import registry
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = registry()
+        self.sent = self.registry.counter("probes_total", "Probes")
+        self.rtt = self.registry.histogram(
+            "rtt_seconds", "RTT", (0.001, 0.01), {"phase": 'a"b'}
+        )
+
+    def test_exposition(self):
+        self.sent.inc()
+        self.sent.inc(2)
+        for value in [0.0005, 0.001, 0.005, 1.0]:
+            self.rtt.observe(value)
+        self.assertEqual(
+            self.registry.exposition(),
+            "# HELP probes_total Probes\n"
+            "# TYPE probes_total counter\n"
+            "probes_total 3\n"
+            "# HELP rtt_seconds RTT\n"
+            "# TYPE rtt_seconds histogram\n"
+            'rtt_seconds_bucket{phase="a\\"b",le="0.001"} 2\n'
+            'rtt_seconds_bucket{phase="a\\"b",le="0.01"} 3\n'
+            'rtt_seconds_bucket{phase="a\\"b",le="+Inf"} 4\n'
+            'rtt_seconds_sum{phase="a\\"b"} 1.0065\n'
+            'rtt_seconds_count{phase="a\\"b"} 4\n',
+        )
+
+    def test_families(self):
+        self.registry.gauge("up", "Up", {"a": 1}).set(1)
+        self.registry.gauge("up", "", {"a": 2}).set(0)
+        text = self.registry.exposition()
+        self.assertEqual(text.count("# TYPE up gauge"), 1)
+        self.assertIn('up{a="1"} 1\nup{a="2"} 0\n', text)
+
+    def test_textfile(self):
+        self.sent.inc()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "traceflow.prom")
+            self.registry.write_textfile(path)
+            self.assertListEqual(os.listdir(d), ["traceflow.prom"])
+            with open(path) as f:
+                self.assertEqual(f.read(), self.registry.exposition())
+
+
+class TestMetricsServer(unittest.TestCase):
+    def test_scrape(self):
+        server = traceflow.metrics_server("127.0.0.1", 0)
+        server.start()
+        try:
+            with traceflow.socket_listener(udp_dst_port=33452) as listener:
+                with traceflow.socket_handler() as sender:
+                    stream = traceflow.hop_stream(
+                        ["127.0.0.1"],
+                        listener,
+                        sender,
+                        traceflow.probe_id_table(),
+                        2,
+                        to_wait=0.5,
+                    )
+                    list(stream)
+            c = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+            c.request("GET", "/metrics")
+            r = c.getresponse()
+            body = r.read().decode()
+            c.close()
+        finally:
+            server.close()
+        self.assertEqual(r.status, 200)
+        self.assertTrue(
+            r.getheader("Content-Type").startswith("text/plain; version=0.0.4")
+        )
+        samples = dict(
+            line.rsplit(" ", 1)
+            for line in body.splitlines()
+            if not line.startswith("#")
+        )
+        self.assertGreaterEqual(int(samples["traceflow_probes_sent_total"]), 2)
+        self.assertGreaterEqual(int(samples["traceflow_replies_matched_total"]), 2)
+        self.assertGreaterEqual(int(samples["traceflow_rtt_seconds_count"]), 1)
+        self.assertGreaterEqual(
+            int(samples['traceflow_phase_seconds_count{phase="decode"}']), 2
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -135,5 +135,97 @@ class TestPacketEncode(unittest.TestCase):
         self.assertEqual(udp_len, struct.pack("!H", 18))
 
 
+class TestFastDecode(unittest.TestCase):
+    def setUp(self):
+        # A TTL expired from 10.0.0.1, quoting a probe to 1.1.1.1
+        probe = traceflow.packet_encode(4, "1.1.1.1", 33453, 33452, 3, 17, 259)
+        self.probe = probe.ipv4_packet + probe.udp_packet
+        icmp = struct.pack("!BBHI", 11, 0, 0, 0) + self.probe[:28]
+        outer = traceflow.packet_encode(4, "10.0.0.2", 0, 0, 64, 1, 1).ipv4_packet
+        self.reply = outer[:12] + socket.inet_aton("10.0.0.1") + outer[16:] + icmp
+
+    def test_unpack_ipv4_header(self):
+        r = traceflow.packet_decode.unpack_ipv4_header(memoryview(self.probe))
+        d = traceflow.packet_decode.decode_ipv4_header(self.probe)
+        for field in ["ip_ver", "ip_ihl", "ip_id", "ttl", "l4_proto", "ip_check"]:
+            self.assertEqual(getattr(r, field), d[field])
+        self.assertEqual(r.ip_daddr, "1.1.1.1")
+        self.assertEqual(r.daddr, traceflow.packet.ip_to_int("1.1.1.1"))
+        self.assertEqual(r.payload_offset, 20)
+
+    def test_unpack_icmp_reply(self):
+        r = traceflow.packet_decode.unpack_icmp_reply(memoryview(self.reply))
+        self.assertEqual(r.ip_saddr, "10.0.0.1")
+        self.assertEqual(r.ip_daddr, "1.1.1.1")
+        self.assertEqual((r.type, r.code), (11, 0))
+        self.assertEqual(r.ip_id, 259)
+        self.assertEqual(r.src_port, 33453)
+        self.assertEqual(r.dst_port, 33452)
+
+    def test_unpack_icmp_reply_truncated(self):
+        with self.assertRaises(struct.error):
+            traceflow.packet_decode.unpack_icmp_reply(self.reply[:50])
+
+    def test_records_have_slots(self):
+        r = traceflow.packet_decode.unpack_udp(self.probe, 20)
+        with self.assertRaises(AttributeError):
+            r.foo = 1
+
+
+class TestProbeTemplate(unittest.TestCase):
+    def setUp(self):
+        self.template = traceflow.probe_template(
+            "1.1.1.1", 35000, 53, ip_saddr="192.168.0.31"
+        )
+
+    def _udp_checksum(self, probe):
+        pseudo_header = probe[12:20] + struct.pack("!BBH", 0, 17, len(probe) - 20)
+        return traceflow.packet_encode._checksum_func(pseudo_header + probe[20:])
+
+    def test_build(self):
+        probe = self.template.build(3, 257, 35001)
+        self.assertIsInstance(probe, bytes)
+        self.assertEqual(probe[8], 3)
+        self.assertEqual(probe[4:6], struct.pack("!H", 257))
+        self.assertEqual(probe[20:22], struct.pack("!H", 35001))
+        self.assertEqual(probe[22:24], struct.pack("!H", 53))
+        self.assertEqual(probe[16:20], socket.inet_aton("1.1.1.1"))
+
+    def test_checksums(self):
+        # A valid checksum makes the ones compliment sum of the whole header come out as 0
+        for ttl, ip_id, port in [(1, 1, 35000), (64, 65535, 65535), (2, 0, 1)]:
+            probe = self.template.build(ttl, ip_id, port)
+            self.assertEqual(traceflow.packet_encode._checksum_func(probe[:20]), 0)
+            self.assertEqual(self._udp_checksum(probe), 0)
+
+    def test_matches_packet_encode(self):
+        probe = self.template.build(3, 257, 35000)
+        i = traceflow.packet_encode(4, "1.1.1.1", 35000, 53, 3, 17, 257)
+        i.ip_saddr = socket.inet_aton("192.168.0.31")
+        i.data = self.template.data
+        self.assertEqual(probe[20:], i._encode_ipv4_udp_packet())
+
+    def test_fixed_checksum(self):
+        template = traceflow.probe_template(
+            "1.1.1.1", 35000, 53, ip_saddr="192.168.0.31", fixed_checksum=True
+        )
+        for checksum in [1, 0x1234, 0xFFFF]:
+            probe = template.build(3, 257, 35001, checksum)
+            self.assertEqual(probe[26:28], struct.pack("!H", checksum))
+            self.assertEqual(self._udp_checksum(probe), 0)
+
+    def test_fixed_checksum_needs_pad(self):
+        with self.assertRaises(ValueError):
+            self.template.build(3, 257, 35001, 0x1234)
+
+    def test_checksum_update(self):
+        data = b"\x12\x34\x56\x78"
+        checksum = traceflow.packet_encode._checksum_func(data)
+        updated = traceflow.probe_template._checksum_update(checksum, 0x5678, 0xABCD)
+        self.assertEqual(
+            updated, traceflow.packet_encode._checksum_func(b"\x12\x34\xab\xcd")
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
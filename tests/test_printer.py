@@ -1,5 +1,9 @@
+import contextlib
+import io
+import json
+import time
 import unittest
-from traceflow import printer
+from traceflow import printer, live_printer, record_writer, hop_event
 
 
 class TestPrinter(unittest.TestCase):
@@ -41,6 +45,162 @@ class TestPrinter(unittest.TestCase):
             '{"nodes": [{"id": "136.243.212.25", "label": "136.243.212.25"}, {"id": "213.239.229.57", "label": "213.239.229.57"}, {"id": "213.239.203.153", "label": "213.239.203.153"}, {"id": "62.69.146.42", "label": "62.69.146.42"}, {"id": "1.1.1.1", "label": "1.1.1.1"}, {"id": "213.239.229.61", "label": "213.239.229.61"}, {"id": "213.239.229.77", "label": "213.239.229.77"}], "links": [{"from": "136.243.212.25", "to": "213.239.229.57"}, {"from": "213.239.229.57", "to": "213.239.203.153"}, {"from": "213.239.203.153", "to": "62.69.146.42"}, {"from": "62.69.146.42", "to": "1.1.1.1"}, {"from": "136.243.212.25", "to": "213.239.229.57"}, {"from": "213.239.229.57", "to": "213.239.203.153"}, {"from": "213.239.203.153", "to": "62.69.146.42"}, {"from": "62.69.146.42", "to": "1.1.1.1"}, {"from": "136.243.212.25", "to": "213.239.229.57"}, {"from": "213.239.229.57", "to": "213.239.203.153"}, {"from": "213.239.203.153", "to": "62.69.146.42"}, {"from": "62.69.146.42", "to": "1.1.1.1"}, {"from": "136.243.212.25", "to": "213.239.229.61"}, {"from": "213.239.229.61", "to": "213.239.229.77"}, {"from": "213.239.229.77", "to": "62.69.146.42"}, {"from": "62.69.146.42", "to": "1.1.1.1"}]}',
         )
 
+    def test_print_json(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            printer.print_json(self.traces, "one.one.one.one", "1.1.1.1")
+        result = json.loads(out.getvalue())
+        self.assertEqual(result["target"], "one.one.one.one")
+        self.assertEqual(result["daddr"], "1.1.1.1")
+        self.assertEqual(result["traces"]["4"]["2"], "213.239.229.61")
+        self.assertNotIn("rtts", result)
+        self.assertNotIn("groups", result)
+
+    def test_print_groups(self):
+        groups = {"00aa": [1, 3], "00bb": [2]}
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            printer.print_groups(groups, 33452)
+        self.assertEqual(
+            out.getvalue(),
+            "Path ID 1 (00aa) found from src ports 33453, 33455\n"
+            "Path ID 2 (00bb) found from src port 33454\n",
+        )
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            printer.print_json(
+                {1: {1: "a"}, 2: {1: "b"}}, groups=groups, src_port=33452
+            )
+        result = json.loads(out.getvalue())
+        self.assertDictEqual(
+            result["groups"]["1"],
+            {"fingerprint": "00aa", "paths": [1, 3], "src_ports": [33453, 33455]},
+        )
+
+    def test_print_rtts(self):
+        rtts = {4: {2: 1.5}}
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            printer.print_json(self.traces, "one.one.one.one", "1.1.1.1", rtts=rtts)
+        self.assertEqual(json.loads(out.getvalue())["rtts"], {"4": {"2": 1.5}})
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            printer.print_vertical(self.traces, rtts)
+        self.assertIn("213.239.229.61 (1.500 ms)", out.getvalue())
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            printer.print_horizontal(self.traces, rtts)
+        self.assertIn("213.239.229.61 (1.500 ms)", out.getvalue())
+
+    def test_format(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            printer.print_vertical(self.traces)
+        self.assertEqual(out.getvalue(), printer.format_vertical(self.traces))
+        self.assertEqual(len(out.getvalue().splitlines()), 5)
+        self.assertEqual(len(printer.format_horizontal(self.traces).splitlines()), 6)
+
+
+class TestLivePrinter(unittest.TestCase):
+    def test_live(self):
+        out = io.StringIO()
+        p = live_printer(fps=1e-9, out=out)
+        p.update(hop_event("1.1.1.1", 1, 2, "10.0.0.2", 1.5))
+        # The first event is drawn straight away, with the hop below it left blank.
+        # Lines are cut off at the terminal width.
+        self.assertIn("|                              | 10.0.0.2 (1.5", out.getvalue())
+        self.assertEqual(p._lines, 2)
+        p.update(hop_event("1.1.1.1", 2, 1))
+        # Too soon for another frame
+        self.assertNotIn("Path ID 2", out.getvalue())
+        self.assertEqual(p.traces["1.1.1.1"][2][1], "*")
+        p.draw()
+        self.assertIn("Path ID 2", out.getvalue())
+        self.assertIn("\x1b[2F\x1b[J", out.getvalue())
+        p.clear()
+        self.assertTrue(out.getvalue().endswith("\x1b[3F\x1b[J"))
+
+    def test_watch(self):
+        out = io.StringIO()
+        p = live_printer(horizontal=True, out=out)
+        events = [
+            hop_event("1.1.1.1", 1, 1, "10.0.0.1"),
+            hop_event("8.8.8.8", 1, 1, "10.0.0.1"),
+        ]
+        self.assertListEqual(list(p.watch(events)), events)
+        self.assertEqual(p._lines, 0)
+
+
+class TestRecordWriter(unittest.TestCase):
+    events = [
+        hop_event("1.1.1.1", 2, 1, "10.0.0.1", 1.25, 11, 0),
+        hop_event("1.1.1.1", 2, 2),
+        hop_event("1.1.1.1", 2, 3, "1.1.1.1", None, 3, 3, True),
+    ]
+
+    def test_jsonl(self):
+        out = io.StringIO()
+        w = record_writer("jsonl", out=out)
+        self.assertListEqual(list(w.watch(self.events)), self.events)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        # Probes given up on are not hops
+        self.assertEqual(len(records), 2)
+        self.assertListEqual(list(records[0]), list(record_writer.FIELDS))
+        self.assertDictEqual(
+            records[0],
+            {
+                "target": "1.1.1.1",
+                "path": 2,
+                "src_port": 33454,
+                "ttl": 1,
+                "responder": "10.0.0.1",
+                "rtt": 1.25,
+                "type": 11,
+                "code": 0,
+                "final": False,
+            },
+        )
+        self.assertIsNone(records[1]["rtt"])
+
+    def test_csv(self):
+        out = io.StringIO()
+        w = record_writer("csv", src_port=40000, out=out)
+        list(w.watch(self.events))
+        self.assertListEqual(
+            out.getvalue().splitlines(),
+            [
+                "target,path,src_port,ttl,responder,rtt,type,code,final",
+                "1.1.1.1,2,40002,1,10.0.0.1,1.25,11,0,False",
+                "1.1.1.1,2,40002,3,1.1.1.1,,3,3,True",
+            ],
+        )
+
+    def test_batch(self):
+        out = io.StringIO()
+        w = record_writer("jsonl", out=out, batch=2, interval=3600)
+        w.update(self.events[0])
+        self.assertEqual(out.getvalue(), "")
+        w.update(self.events[2])
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+    def test_interval(self):
+        out = io.StringIO()
+        w = record_writer("jsonl", out=out, interval=0.01)
+        w.start()
+        w.update(self.events[0])
+        # Written by the background thread, without another event coming in
+        deadline = time.monotonic() + 5
+        while not out.getvalue() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(out.getvalue().splitlines()), 1)
+        w.close()
+        self.assertIsNone(w._thread)
+
+    def test_close(self):
+        out = io.StringIO()
+        w = record_writer("jsonl", out=out, interval=3600)
+        w.update(self.events[0])
+        self.assertEqual(out.getvalue(), "")
+        w.close()
+        self.assertEqual(len(out.getvalue().splitlines()), 1)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            record_writer("xml")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import traceflow
+
+
+class TestProbeIdTable(unittest.TestCase):
+    def test_ipid(self):
+        t = traceflow.probe_id_table()
+        ip_id, checksum = t.allocate("1.1.1.1", 1, 1, 33453)
+        self.assertEqual(ip_id, 257)
+        self.assertIsNone(checksum)
+        self.assertTupleEqual(t.lookup("1.1.1.1", 257, 33453, 0), (1, 1))
+
+    def test_ipid_limit(self):
+        t = traceflow.probe_id_table("ipid")
+        self.assertEqual(t.max_paths(33452), 255)
+        self.assertEqual(t.max_paths(65500), 35)
+        with self.assertRaises(ValueError):
+            t.allocate("1.1.1.1", 256, 1, 33453)
+
+    def test_unknown_scheme(self):
+        with self.assertRaises(ValueError):
+            traceflow.probe_id_table("payload")
+
+    def test_srcport_limit(self):
+        t = traceflow.probe_id_table("srcport")
+        self.assertEqual(t.max_paths(33452), 32083)
+        self.assertEqual(t.max_paths(65535), 0)
+
+    def test_srcport(self):
+        t = traceflow.probe_id_table("srcport")
+        ip_id, checksum = t.allocate("1.1.1.1", 1000, 3, 34452)
+        self.assertIsNone(checksum)
+        self.assertTupleEqual(t.lookup("1.1.1.1", ip_id, 34452, 0), (1000, 3))
+        # Same IP.ID but another port, target or run is not ours
+        self.assertIsNone(t.lookup("1.1.1.1", ip_id, 34453, 0))
+        self.assertIsNone(t.lookup("8.8.8.8", ip_id, 34452, 0))
+        other = traceflow.probe_id_table("srcport")
+        self.assertIsNone(other.lookup("1.1.1.1", ip_id, 34452, 0))
+
+    def test_checksum(self):
+        t = traceflow.probe_id_table("checksum")
+        ip_id, checksum = t.allocate("1.1.1.1", 2, 7, 33454)
+        self.assertEqual(ip_id, 7)
+        self.assertNotEqual(checksum, 0)
+        self.assertTupleEqual(t.lookup("1.1.1.1", 9999, 33454, checksum), (2, 7))
+
+    def test_unique(self):
+        t = traceflow.probe_id_table("srcport")
+        ids = set(t.allocate("1.1.1.1", 1, ttl, 33453)[0] for ttl in range(1, 256))
+        self.assertEqual(len(ids), 255)
+
+    def test_release(self):
+        t = traceflow.probe_id_table("srcport")
+        ip_id, _ = t.allocate("1.1.1.1", 1, 1, 33453)
+        t.release("1.1.1.1")
+        self.assertIsNone(t.lookup("1.1.1.1", ip_id, 33453, 0))
+        self.assertDictEqual(t.probes, {})
+
+    def test_rtt(self):
+        t = traceflow.probe_id_table()
+        t.sent("1.1.1.1", 1, 1, 1_000_000_000)
+        self.assertEqual(t.rtt("1.1.1.1", 1, 1, 1_002_500_000), 2.5)
+        # No timestamp, never sent, or answered before it was sent
+        self.assertIsNone(t.rtt("1.1.1.1", 1, 1, 0))
+        self.assertIsNone(t.rtt("1.1.1.1", 1, 2, 1_002_500_000))
+        self.assertIsNone(t.rtt("1.1.1.1", 1, 1, 999_000_000))
+        # A retransmitted probe has no RTT, as the reply may be to either copy
+        t.sent("1.1.1.1", 1, 1, 1_001_000_000)
+        self.assertIsNone(t.rtt("1.1.1.1", 1, 1, 1_002_500_000))
+        t.release("1.1.1.1")
+        t.sent("1.1.1.1", 1, 1, 1_000_000_000)
+        self.assertEqual(t.rtt("1.1.1.1", 1, 1, 1_001_000_000), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
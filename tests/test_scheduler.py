@@ -0,0 +1,335 @@
+import unittest
+import traceflow
+
+
+class TestProbeScheduler(unittest.TestCase):
+    def test_window(self):
+        s = traceflow.probe_scheduler(4, 10, window=6)
+        probes = s.next_probes(0)
+        self.assertEqual(len(probes), 6)
+        self.assertEqual(s.next_probes(0), [])
+
+    def test_spread_across_paths(self):
+        s = traceflow.probe_scheduler(4, 10, window=4)
+        probes = s.next_probes(0)
+        self.assertListEqual(probes, [(1, 1), (2, 1), (3, 1), (4, 1)])
+
+    def test_reply_frees_slot(self):
+        s = traceflow.probe_scheduler(2, 10, window=2)
+        s.next_probes(0)
+        s.reply(1, 1)
+        self.assertListEqual(s.next_probes(0), [(1, 2)])
+
+    def test_pps(self):
+        s = traceflow.probe_scheduler(2, 10, window=10, pps=10)
+        self.assertEqual(len(s.next_probes(0)), 1)
+        self.assertEqual(len(s.next_probes(0.05)), 0)
+        self.assertAlmostEqual(s.next_deadline(0.05), 0.05)
+        self.assertEqual(len(s.next_probes(0.1)), 1)
+
+    def test_expire(self):
+        s = traceflow.probe_scheduler(1, 10, window=2, timeout=1.0)
+        s.next_probes(0)
+        self.assertListEqual(s.expire(0.5), [])
+        self.assertListEqual(s.expire(1.0), [(1, 1), (1, 2)])
+        self.assertDictEqual(s.outstanding, {})
+
+    def test_final_stops_path(self):
+        s = traceflow.probe_scheduler(2, 5, window=4)
+        s.next_probes(0)
+        s.reply(1, 1, final=True)
+        # (1, 2) was already in flight, there is no point waiting on it
+        self.assertNotIn((1, 2), s.outstanding)
+        for probe in s.next_probes(0):
+            self.assertNotEqual(probe[0], 1)
+
+    def test_done(self):
+        s = traceflow.probe_scheduler(1, 3, window=4)
+        self.assertFalse(s.done())
+        s.next_probes(0)
+        s.reply(1, 1)
+        s.reply(1, 2, final=True)
+        self.assertTrue(s.done())
+        self.assertEqual(s.sent, 2)
+
+    def test_retransmit(self):
+        s = traceflow.probe_scheduler(1, 3, window=4, timeout=1.0, retries=1)
+        s.next_probes(0)
+        s.reply(1, 1)
+        self.assertListEqual(s.expire(1.0), [])
+        self.assertListEqual(s.next_probes(1.0), [(1, 2)])
+        self.assertAlmostEqual(s.next_deadline(1.0), 2.0)
+        s.reply(1, 2, final=True)
+        self.assertTrue(s.done())
+        self.assertEqual(s.sent, 3)
+
+
+class TestTimeoutTracker(unittest.TestCase):
+    def test_backoff(self):
+        t = traceflow.timeout_tracker(1.0, retries=2, backoff=2.0)
+        t.add((1, 1), 0)
+        self.assertEqual(t.next_timeout(), 1.0)
+        self.assertListEqual(t.expire(1.0), [])
+        self.assertListEqual(list(t.retransmit), [(1, 1)])
+        t.add(t.retransmit.popleft(), 1.0)
+        self.assertEqual(t.next_timeout(), 3.0)
+        t.expire(3.0)
+        t.add(t.retransmit.popleft(), 3.0)
+        self.assertEqual(t.next_timeout(), 7.0)
+        self.assertListEqual(t.expire(7.0), [(1, 1)])
+        self.assertEqual(t.retransmitted, 2)
+
+    def test_deadline_order(self):
+        t = traceflow.timeout_tracker(1.0, retries=1)
+        t.add((1, 1), 0)
+        t.expire(1.0)
+        t.add(t.retransmit.popleft(), 1.0)
+        t.add((1, 2), 1.5)
+        # The retransmitted probe was sent first, but waits longer
+        t.expire(2.5)
+        self.assertListEqual(list(t.retransmit), [(1, 2)])
+        self.assertIn((1, 1), t.outstanding)
+        self.assertListEqual(t.expire(3.0), [(1, 1)])
+
+    def test_remove(self):
+        t = traceflow.timeout_tracker(1.0, retries=1)
+        t.add((1, 1), 0)
+        t.expire(1.0)
+        t.remove((1, 1))
+        self.assertFalse(t.wanted((1, 1)))
+        self.assertIsNone(t.next_timeout())
+
+
+class TestStopSet(unittest.TestCase):
+    def _learn(self, stop_set, hops):
+        previous = None
+        for ttl, hop in enumerate(hops, 1):
+            stop_set.add(ttl, hop, previous)
+            previous = hop
+
+    def test_prefix(self):
+        s = traceflow.stop_set()
+        self._learn(s, ["10.0.0.1", "10.0.1.1", "10.0.2.1"])
+        self.assertDictEqual(s.prefix(3, "10.0.2.1"), {1: "10.0.0.1", 2: "10.0.1.1"})
+        self.assertDictEqual(s.prefix(1, "10.0.0.1"), {})
+        self.assertIsNone(s.prefix(3, "10.0.9.1"))
+        self.assertEqual(s.start_ttl(), 4)
+
+    def test_conflict(self):
+        s = traceflow.stop_set()
+        self._learn(s, ["10.0.0.1", "10.0.1.1", "10.0.2.1"])
+        self._learn(s, ["10.0.0.1", "10.0.1.2", "10.0.2.1"])
+        self.assertIsNone(s.prefix(3, "10.0.2.1"))
+        self.assertDictEqual(s.prefix(2, "10.0.1.2"), {1: "10.0.0.1"})
+        self.assertEqual(s.start_ttl(), 2)
+
+    def test_scheduler_skips_known_hops(self):
+        s = traceflow.stop_set()
+        self._learn(s, ["10.0.0.1", "10.0.1.1", "10.0.2.1"])
+        p = traceflow.probe_scheduler(1, 10, window=1, stop_set=s)
+        # The path starts at TTL 4, and first works backwards from TTL 3
+        self.assertListEqual(p.next_probes(0), [(1, 3)])
+        p.reply(1, 3, responder="10.0.2.9")
+        self.assertListEqual(p.next_probes(0), [(1, 2)])
+        p.reply(1, 2, responder="10.0.1.1")
+        self.assertDictEqual(p.filled, {1: {1: "10.0.0.1"}})
+        self.assertListEqual(p.next_probes(0), [(1, 4)])
+        p.reply(1, 4, final=True, responder="10.0.3.1")
+        self.assertTrue(p.done())
+        self.assertEqual(p.sent, 3)
+
+    def test_scheduler_timeout_steps_back(self):
+        s = traceflow.stop_set()
+        self._learn(s, ["10.0.0.1", "10.0.1.1", "10.0.2.1"])
+        p = traceflow.probe_scheduler(1, 10, window=2, stop_set=s)
+        self.assertListEqual(p.next_probes(0), [(1, 3), (1, 4)])
+        p.expire(1.0)
+        self.assertListEqual(p.next_probes(1.0), [(1, 2), (1, 5)])
+
+    def test_shared_between_targets(self):
+        s = traceflow.stop_set()
+        self._learn(s, ["10.0.0.1", "10.0.1.1"])
+        b = traceflow.batch_scheduler(["1.1.1.1", "8.8.8.8"], 1, 10, stop_set=s)
+        self.assertListEqual(
+            b.next_probes(0)[:2], [("1.1.1.1", 1, 2), ("8.8.8.8", 1, 2)]
+        )
+        b.reply("1.1.1.1", 1, 2, responder="10.0.1.1")
+        self.assertDictEqual(b.schedulers["1.1.1.1"].filled, {1: {1: "10.0.0.1"}})
+        self.assertDictEqual(b.schedulers["8.8.8.8"].filled, {})
+
+    def test_no_skip_from_two(self):
+        s = traceflow.stop_set()
+        self._learn(s, ["10.0.0.1"])
+        p = traceflow.probe_scheduler(1, 10, window=2, stop_set=s)
+        # Starting at TTL 2 would probe TTL 1 backwards anyway
+        self.assertListEqual(p.next_probes(0), [(1, 1), (1, 2)])
+        self.assertDictEqual(p.start, {1: 1})
+
+    def test_batch_holds_back(self):
+        b = traceflow.batch_scheduler(
+            ["1.1.1.1", "8.8.8.8"], 2, 10, stop_set=traceflow.stop_set()
+        )
+        # Only the first path of the first target goes ahead, as far as TTL 2
+        self.assertListEqual(b.next_probes(0), [("1.1.1.1", 1, 1), ("1.1.1.1", 1, 2)])
+        self.assertEqual(b.next_deadline(0), 1.0)
+        b.reply("1.1.1.1", 1, 1, responder="10.0.0.1")
+        b.reply("1.1.1.1", 1, 2, responder="10.0.1.1")
+        # Then its other path, from TTL 3 backwards, while the other target still waits
+        probes = b.next_probes(0)
+        self.assertIn(("1.1.1.1", 2, 2), probes)
+        self.assertNotIn(("1.1.1.1", 2, 1), probes)
+        self.assertListEqual([i for i in probes if i[0] == "8.8.8.8"], [])
+
+    def test_batch_sends_fewer_probes(self):
+        targets = ["1.1.1.1", "2.2.2.2", "3.3.3.3", "4.4.4.4"]
+
+        def route(target, path):
+            # Every target shares the first five hops, then each path takes its own
+            prefix = ["10.0.0.1", "10.0.1.1", "10.0.2.1", "10.0.3.1", "10.0.4.1"]
+            return prefix + [f"10.{target[0]}.{path}.1", target]
+
+        def run(stop_set):
+            b = traceflow.batch_scheduler(targets, 2, 16, window=8, stop_set=stop_set)
+            now = 0
+            while not b.done():
+                for target, path, ttl in b.next_probes(now):
+                    hops = route(target, path)
+                    hop = hops[min(ttl, len(hops)) - 1]
+                    b.reply(target, path, ttl, hop == target, hop)
+                now += 0.01
+                b.expire(now)
+            return b
+
+        sent = run(None).sent
+        b = run(traceflow.stop_set())
+        self.assertLess(b.sent, sent * 0.75)
+        for target in targets[1:]:
+            scheduler = b.schedulers[target]
+            for path in [1, 2]:
+                self.assertEqual(scheduler.start[path], 6)
+                self.assertDictEqual(
+                    scheduler.filled[path], dict(enumerate(route(target, path)[:4], 1))
+                )
+
+
+class TestMdaScheduler(unittest.TestCase):
+    def _run(self, s, network):
+        # Answer every probe right away, from network(path, ttl), or not at all if it returns None
+        while not s.done():
+            for path, ttl in s.next_probes(0):
+                hop = network(path, ttl)
+                if hop is None:
+                    continue
+                s.reply(path, ttl, final=hop == "10.0.9.1", responder=hop)
+            s.expire(1.0)
+
+    def test_stopping_point(self):
+        # As tabulated for the Multipath Detection Algorithm at 95% confidence
+        points = [traceflow.mda_stopping_point(k) for k in range(1, 6)]
+        self.assertListEqual(points, [6, 11, 16, 21, 27])
+
+    def test_single_path(self):
+        s = traceflow.mda_scheduler(64, 10)
+        self._run(s, lambda path, ttl: ["10.0.0.1", "10.0.1.1", "10.0.9.1"][ttl - 1])
+        # One flow is enough per hop, once it is clear there is only one next hop
+        self.assertEqual(s.flows, 6)
+        self.assertEqual(s.sent, 18)
+
+    def test_diamond(self):
+        hops = [["10.0.0.1"], ["10.0.1.1", "10.0.1.2"], ["10.0.2.1"], ["10.0.9.1"]]
+        s = traceflow.mda_scheduler(64, 10)
+        self._run(s, lambda path, ttl: hops[ttl - 1][path % len(hops[ttl - 1])])
+        found = dict()
+        for path in s.hops:
+            for ttl, hop in s.hops[path].items():
+                found.setdefault(ttl, set()).add(hop)
+        self.assertSetEqual(found[2], {"10.0.1.1", "10.0.1.2"})
+        # Both branches need enough flows through them to be sure they only lead to 10.0.2.1
+        self.assertGreaterEqual(s.flows, 12)
+        self.assertLessEqual(s.flows, 24)
+        # Flows first probed past TTL 1 have the first hop filled in
+        for path in s.filled:
+            self.assertEqual(s.filled[path][1], "10.0.0.1")
+
+    def test_max_paths(self):
+        s = traceflow.mda_scheduler(3, 10)
+        self._run(s, lambda path, ttl: "10.0.9.1")
+        self.assertEqual(s.flows, 3)
+
+    def test_silent_hops(self):
+        s = traceflow.mda_scheduler(64, 5)
+        self._run(s, lambda path, ttl: None)
+        self.assertTrue(s.done())
+        self.assertEqual(s.flows, 6)
+
+
+class TestBatchScheduler(unittest.TestCase):
+    def test_shared_window(self):
+        s = traceflow.batch_scheduler(["1.1.1.1", "8.8.8.8"], 2, 10, window=4)
+        probes = s.next_probes(0)
+        self.assertListEqual(
+            probes,
+            [
+                ("1.1.1.1", 1, 1),
+                ("8.8.8.8", 1, 1),
+                ("1.1.1.1", 2, 1),
+                ("8.8.8.8", 2, 1),
+            ],
+        )
+        self.assertListEqual(s.next_probes(0), [])
+
+    def test_shared_pps(self):
+        s = traceflow.batch_scheduler(["1.1.1.1", "8.8.8.8"], 2, 10, pps=10)
+        self.assertEqual(len(s.next_probes(0)), 1)
+        self.assertEqual(len(s.next_probes(0.05)), 0)
+
+    def test_reply_and_expire(self):
+        s = traceflow.batch_scheduler(["1.1.1.1", "8.8.8.8"], 1, 10, window=4)
+        s.next_probes(0)
+        s.reply("1.1.1.1", 1, 1, final=True)
+        self.assertEqual(s.in_flight, 2)
+        self.assertListEqual(s.expire(1.0), [("8.8.8.8", 1, 1), ("8.8.8.8", 1, 2)])
+        self.assertEqual(s.in_flight, 0)
+
+    def test_retransmitted(self):
+        s = traceflow.batch_scheduler(["1.1.1.1"], 1, 3, window=4, retries=1)
+        s.next_probes(0)
+        s.expire(1.0)
+        # Counted once handed out again, not when queued up
+        self.assertEqual(s.retransmitted, 0)
+        s.reply("1.1.1.1", 1, 2)
+        self.assertEqual(len(s.next_probes(1.0)), 1)
+        self.assertEqual(s.retransmitted, 1)
+
+    def test_done(self):
+        s = traceflow.batch_scheduler(["1.1.1.1", "8.8.8.8"], 1, 3, window=4)
+        s.next_probes(0)
+        s.reply("1.1.1.1", 1, 1, final=True)
+        self.assertFalse(s.done())
+        s.reply("8.8.8.8", 1, 1, final=True)
+        self.assertTrue(s.done())
+
+    def test_mda(self):
+        b = traceflow.batch_scheduler(["1.1.1.1"], 64, 10, confidence=0.95)
+        self.assertIsInstance(b.schedulers["1.1.1.1"], traceflow.mda_scheduler)
+        self.assertEqual(len(b.next_probes(0)), 6)
+
+
+class TestRetraceSchedule(unittest.TestCase):
+    def test_spread(self):
+        s = traceflow.retrace_schedule({"1.1.1.1": 60, "8.8.8.8": 60}, now=0)
+        self.assertLessEqual(s.next_deadline(0), 60)
+        self.assertListEqual(sorted(s.due(60)), ["1.1.1.1", "8.8.8.8"])
+        self.assertListEqual(s.due(60), [])
+
+    def test_done(self):
+        s = traceflow.retrace_schedule({"1.1.1.1": 60}, jitter=0.1, now=0)
+        self.assertListEqual(s.due(60), ["1.1.1.1"])
+        s.done("1.1.1.1", 60)
+        self.assertGreaterEqual(s.next_deadline(60), 54)
+        self.assertLessEqual(s.next_deadline(60), 66)
+        self.assertListEqual(s.due(126), ["1.1.1.1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
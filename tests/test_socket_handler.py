@@ -2,6 +2,13 @@ import unittest
 import traceflow
 import struct
 import socket
+from traceflow.packet import icmp_reply, ip_to_int
+from unittest import mock
+from traceflow.socket_handler import icmp_filter, _rx_timestamp, SO_TIMESTAMPNS
+
+
+def reply(saddr, ip_id=0):
+    return icmp_reply(saddr=ip_to_int(saddr), ip_id=ip_id)
 
 
 class TestSocketHandler(unittest.TestCase):
@@ -9,6 +16,36 @@ class TestSocketHandler(unittest.TestCase):
         i = traceflow.socket_handler.get_egress_ip("1.1.1.1")
         self.assertIsInstance(i, str)
 
+    def _probes(self):
+        probes = list()
+        for ttl in range(1, 3):
+            i = traceflow.packet_encode(4, "127.0.0.1", 33453, 33452, ttl, 17, ttl)
+            probes.append(i.ipv4_packet + i.udp_packet)
+        return probes
+
+    def test_open_error(self):
+        with mock.patch("platform.system", return_value="Darwin"):
+            with self.assertRaises(OSError):
+                traceflow.socket_handler(exit_on_error=False)
+            with self.assertRaises(SystemExit):
+                traceflow.socket_handler()
+
+    def test_listener_open_error(self):
+        with mock.patch("socket.socket", side_effect=PermissionError(1, "denied")):
+            with self.assertRaises(PermissionError):
+                traceflow.socket_listener("1.1.1.1", exit_on_error=False)
+            with self.assertRaises(SystemExit):
+                traceflow.socket_listener("1.1.1.1")
+
+    def test_send_batch(self):
+        with traceflow.socket_handler("127.0.0.1") as s:
+            self.assertEqual(s.send_batch(self._probes()), 2)
+
+    def test_send_batch_sendto(self):
+        with traceflow.socket_handler("127.0.0.1") as s:
+            s._sendmmsg = None
+            self.assertEqual(s.send_batch(self._probes()), 2)
+
     def test_init(self):
         i = traceflow.socket_listener("1.1.1.1")
         self.assertIsInstance(i, traceflow.socket_listener)
@@ -18,6 +55,199 @@ class TestSocketHandler(unittest.TestCase):
         j = i.get_all_packets()
         self.assertIsInstance(j, dict)
 
+    def test_wait_for_replies(self):
+        i = traceflow.socket_listener("1.1.1.1")
+        self.assertListEqual(i.wait_for_replies(0), [])
+        i._store("1.1.1.1", 1, 3, reply("2.2.2.2"), False)
+        i._store("1.1.1.1", 2, 5, reply("1.1.1.1"), True)
+        self.assertListEqual(
+            i.wait_for_replies(1),
+            [("1.1.1.1", 1, 3, False, "2.2.2.2"), ("1.1.1.1", 2, 5, True, "1.1.1.1")],
+        )
+        self.assertListEqual(i.wait_for_replies(0), [])
+
+    def test_multiple_destinations(self):
+        i = traceflow.socket_listener(["1.1.1.1", "8.8.8.8"])
+        i.add_destination("9.9.9.9")
+        r = reply("2.2.2.2")
+        i._store("8.8.8.8", 1, 1, r, False)
+        self.assertDictEqual(i.get_packets_by_daddr("1.1.1.1"), {})
+        self.assertDictEqual(i.get_packets_by_daddr("8.8.8.8"), {(1, 1): r})
+        self.assertDictEqual(i.get_packets_by_pathid(1, "8.8.8.8"), {1: r})
+        self.assertIn("9.9.9.9", i.get_all_packets())
+
+    def test_reply_index(self):
+        i = traceflow.socket_listener("1.1.1.1")
+        first = reply("2.2.2.2", ip_id=257)
+        i._store("1.1.1.1", 1, 1, first, False)
+        i._store("1.1.1.1", 1, 1, reply("3.3.3.3", ip_id=257), False)
+        i._store("1.1.1.1", 1, 2, reply("4.4.4.4", ip_id=258), False)
+        # The first reply to a probe is the one kept
+        self.assertIs(i.get_reply(1, 1), first)
+        self.assertIs(i.get_packet_by_ipid(257), first)
+        self.assertEqual(i.get_packets_by_pathid(1)[2].ip_saddr, "4.4.4.4")
+        self.assertIsNone(i.get_reply(2, 1))
+        self.assertIsNone(i.get_packet_by_ipid(1))
+        # Neither lookup may leave the lock held
+        self.assertFalse(i.mutex.locked())
+
+    def test_forget(self):
+        i = traceflow.socket_listener(["1.1.1.1", "8.8.8.8"])
+        i._store("1.1.1.1", 1, 1, reply("1.1.1.1"), True)
+        i._store("8.8.8.8", 1, 1, reply("2.2.2.2"), False)
+        i.forget("1.1.1.1")
+        self.assertDictEqual(i.get_packets_by_daddr("1.1.1.1"), {})
+        self.assertListEqual(
+            i.wait_for_replies(0), [("8.8.8.8", 1, 1, False, "2.2.2.2")]
+        )
+
+    def test_forget_many(self):
+        i = traceflow.socket_listener(["1.1.1.1", "8.8.8.8"], capacity=2)
+        i._store("1.1.1.1", 1, 1, reply("2.2.2.2"), False)
+        i._store("8.8.8.8", 1, 1, reply("3.3.3.3"), False)
+        i.forget_many(["1.1.1.1", "8.8.8.8"])
+        # Answered again after being forgotten, so kept and handed out, and the forgotten replies take up no room
+        i._store("1.1.1.1", 1, 1, reply("4.4.4.4"), False)
+        i._store("1.1.1.1", 1, 2, reply("5.5.5.5"), False)
+        self.assertEqual(i.evicted, 0)
+        self.assertEqual(i.get_reply(1, 1, "1.1.1.1").ip_saddr, "4.4.4.4")
+        self.assertListEqual(
+            [r[4] for r in i.wait_for_replies(0)], ["4.4.4.4", "5.5.5.5"]
+        )
+        i.remove_destinations(["1.1.1.1", "8.8.8.8"])
+        self.assertDictEqual(i.get_all_packets(), {})
+        self.assertEqual(i._live, 0)
+
+    def test_remove_destination(self):
+        i = traceflow.socket_listener(["1.1.1.1", "8.8.8.8"])
+        i._store("1.1.1.1", 1, 1, reply("2.2.2.2"), False)
+        i.remove_destination("1.1.1.1")
+        self.assertNotIn("1.1.1.1", i.get_all_packets())
+        self.assertNotIn(ip_to_int("1.1.1.1"), i._daddr_ints)
+        # A reply matched up before the destination went away is dropped
+        i._store("1.1.1.1", 1, 2, reply("2.2.2.2"), False)
+        self.assertListEqual(i.wait_for_replies(0), [])
+
+    def test_capacity(self):
+        i = traceflow.socket_listener("1.1.1.1", capacity=2)
+        for ttl in range(1, 4):
+            i._store("1.1.1.1", 1, ttl, reply("2.2.2.2", ip_id=256 + ttl), False)
+        # The oldest reply made room for the newest
+        self.assertListEqual(sorted(i.get_packets_by_pathid(1)), [2, 3])
+        self.assertIsNone(i.get_packet_by_ipid(257))
+        self.assertEqual(i.evicted, 2)
+        self.assertListEqual([r[2] for r in i.wait_for_replies(0)], [2, 3])
+        i._store("1.1.1.1", 1, 3, reply("3.3.3.3"), False)
+        self.assertEqual(i.duplicates, 1)
+
+    def test_max_age(self):
+        i = traceflow.socket_listener("1.1.1.1", max_age=0)
+        i._store("1.1.1.1", 1, 1, reply("2.2.2.2"), False)
+        i._store("1.1.1.1", 1, 2, reply("2.2.2.2"), False)
+        self.assertListEqual(list(i.get_packets_by_daddr("1.1.1.1")), [(1, 2)])
+        self.assertEqual(i.evicted, 1)
+
+    def test_foreign(self):
+        i = traceflow.socket_listener("1.1.1.1")
+        i._handle(b"too short")
+        # A reply quoting a probe to some other destination
+        template = traceflow.probe_template(
+            "8.8.8.8", 33453, 33452, ip_saddr="10.0.0.1"
+        )
+        probe = template.build(1, 257, 33453)
+        header = struct.pack(
+            "!BBHHHBBHII",
+            0x45,
+            0,
+            56,
+            0,
+            0,
+            64,
+            1,
+            0,
+            ip_to_int("2.2.2.2"),
+            ip_to_int("10.0.0.1"),
+        )
+        i._handle(header + struct.pack("!BBHI", 11, 0, 0, 0) + probe[:28])
+        self.assertEqual(i.foreign, 2)
+        self.assertDictEqual(i.get_packets_by_daddr("1.1.1.1"), {})
+
+    def test_close(self):
+        with traceflow.socket_listener("1.1.1.1") as i:
+            self.assertTrue(i.thread.is_alive())
+        self.assertFalse(i.thread.is_alive())
+        self.assertEqual(i.icmp_listener.fileno(), -1)
+        # Closing again is harmless, and stored replies can still be read
+        i.close()
+        self.assertDictEqual(i.get_packets_by_daddr("1.1.1.1"), {})
+
+    def test_stop_start(self):
+        i = traceflow.socket_listener("127.0.0.1", udp_dst_port=33452)
+        i.stop()
+        self.assertFalse(i.thread.is_alive())
+        # Picks up again where it left off, this time with the recvmsg() fallback
+        i._recvmmsg = None
+        i.start()
+        self.assertTrue(i.thread.is_alive())
+        template = traceflow.probe_template("127.0.0.1", 33453, 33452)
+        with traceflow.socket_handler() as s:
+            s.send_batch([template.build(1, 257, 33453)])
+        self.assertTrue(i.wait_for_replies(0.5))
+        i.close()
+
+    def test_reuse(self):
+        # One listener, several traces in turn, each with its own probe ID table
+        template = traceflow.probe_template("127.0.0.1", 33453, 33452)
+        with traceflow.socket_listener(udp_dst_port=33452) as i:
+            for _ in range(2):
+                probe_ids = traceflow.probe_id_table("srcport")
+                i.add_destination("127.0.0.1", probe_ids)
+                ip_id, _ = probe_ids.allocate("127.0.0.1", 1, 1, 33453)
+                with traceflow.socket_handler() as s:
+                    s.send_batch([template.build(1, ip_id, 33453)])
+                self.assertTrue(i.wait_for_replies(0.5))
+                self.assertIsNotNone(i.get_reply(1, 1, "127.0.0.1"))
+                i.remove_destination("127.0.0.1")
+
+    def test_icmp_filter(self):
+        program = icmp_filter(33452)
+        # struct sock_filter is 8 bytes
+        self.assertEqual(len(program) % 8, 0)
+        self.assertIn(struct.pack("HBBI", 0x15, 0, 1, 33452), program)
+
+    def test_listener_filter(self):
+        template = traceflow.probe_template("127.0.0.1", 33453, 33452)
+        for port, expected in [(33452, True), (33999, False)]:
+            i = traceflow.socket_listener("127.0.0.1", udp_dst_port=port)
+            with traceflow.socket_handler() as s:
+                s.send_batch([template.build(1, 257, 33453)])
+            self.assertEqual(bool(i.wait_for_replies(0.5)), expected)
+
+    def test_rx_timestamp(self):
+        timespec = struct.pack("@ll", 1700000000, 250)
+        control = (
+            struct.pack(
+                "@Nii",
+                socket.CMSG_LEN(len(timespec)),
+                socket.SOL_SOCKET,
+                SO_TIMESTAMPNS,
+            )
+            + timespec
+        )
+        self.assertEqual(_rx_timestamp(control, len(control)), 1700000000_000000250)
+        self.assertEqual(_rx_timestamp(control, 0), 0)
+
+    def test_reply_timestamp(self):
+        template = traceflow.probe_template("127.0.0.1", 33453, 33452)
+        i = traceflow.socket_listener("127.0.0.1", udp_dst_port=33452)
+        sent = traceflow.helpers.time_ns()
+        with traceflow.socket_handler() as s:
+            s.send_batch([template.build(1, 257, 33453)])
+        self.assertTrue(i.wait_for_replies(0.5))
+        rx_time = i.get_reply(1, 1).rx_time
+        self.assertGreaterEqual(rx_time, sent)
+        self.assertLess(rx_time - sent, 500_000_000)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import traceflow
+from traceflow import hop_event
+
+
+class TestCollectTraces(unittest.TestCase):
+    def test_collect(self):
+        events = [
+            hop_event("1.1.1.1", 1, 1, "10.0.0.1", 1.5, 11, 0),
+            hop_event("1.1.1.1", 2, 1, "10.0.0.1", None, 11, 0),
+            hop_event("1.1.1.1", 1, 2),
+            hop_event("1.1.1.1", 1, 3, "1.1.1.1", 3.0, 3, 3, True),
+            hop_event("1.1.1.1", 2, 2, "1.1.1.1", 2.5, 3, 3, True),
+            # Beyond the end of the path, so trimmed off
+            hop_event("1.1.1.1", 2, 3, "1.1.1.1", 2.7, 3, 3, True),
+        ]
+        rtts = dict()
+        results = traceflow.collect_traces(events, ["1.1.1.1", "8.8.8.8"], rtts)
+        self.assertDictEqual(
+            results["1.1.1.1"],
+            {
+                1: {1: "10.0.0.1", 2: "*", 3: "1.1.1.1"},
+                2: {1: "10.0.0.1", 2: "1.1.1.1", 3: "x"},
+            },
+        )
+        self.assertDictEqual(results["8.8.8.8"], {})
+        self.assertDictEqual(rtts, {"1.1.1.1": {1: {1: 1.5, 3: 3.0}, 2: {2: 2.5}}})
+
+
+class TestHopStream(unittest.TestCase):
+    def test_stream(self):
+        with traceflow.socket_listener(udp_dst_port=33452) as listener:
+            with traceflow.socket_handler() as sender:
+                probe_ids = traceflow.probe_id_table()
+                stream = traceflow.hop_stream(
+                    ["127.0.0.1"], listener, sender, probe_ids, 2, to_wait=0.5
+                )
+                events = list(stream)
+        self.assertEqual(len([e for e in events if e.ttl == 1]), 2)
+        for event in [e for e in events if e.ttl == 1]:
+            self.assertEqual(event.responder, "127.0.0.1")
+            self.assertTrue(event.final)
+            self.assertEqual((event.type, event.code), (3, 3))
+            self.assertIsNotNone(event.rtt)
+        self.assertNotIn("127.0.0.1", listener.ip_daddrs)
+
+    def test_abandon(self):
+        with traceflow.socket_listener(udp_dst_port=33452) as listener:
+            with traceflow.socket_handler() as sender:
+                probe_ids = traceflow.probe_id_table()
+                stream = iter(
+                    traceflow.hop_stream(
+                        ["127.0.0.1"], listener, sender, probe_ids, 2, to_wait=0.5
+                    )
+                )
+                next(stream)
+                self.assertIn("127.0.0.1", listener.ip_daddrs)
+                # Stopping early still gives the destination back
+                stream.close()
+                self.assertNotIn("127.0.0.1", listener.ip_daddrs)
+
+
+if __name__ == "__main__":
+    unittest.main()
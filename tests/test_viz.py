@@ -0,0 +1,105 @@
+import gzip
+import http.client
+import json
+import unittest
+import traceflow
+from traceflow.viz import topology
+
+
+class TestTopology(unittest.TestCase):
+    def test_add_hop(self):
+        t = topology()
+        new = t.add_hop("1.1.1.1", 1, 2, "10.0.0.2")
+        self.assertEqual(len(new["nodes"]), 1)
+        self.assertListEqual(new["links"], [])
+        # Linked up with the hop after it, as well as before it
+        new = t.add_hop("1.1.1.1", 1, 1, "10.0.0.1")
+        self.assertListEqual(
+            new["links"],
+            [{"id": "10.0.0.1>10.0.0.2", "from": "10.0.0.1", "to": "10.0.0.2"}],
+        )
+        # Nothing new on another path through the same hops
+        t.add_hop("1.1.1.1", 2, 1, "10.0.0.1")
+        new = t.add_hop("1.1.1.1", 2, 2, "10.0.0.2")
+        self.assertDictEqual(new, {"nodes": [], "links": []})
+        self.assertDictEqual(
+            t.add_hop("1.1.1.1", 2, 3, "x"), {"nodes": [], "links": []}
+        )
+
+    def test_add_traces(self):
+        t = topology()
+        t.add_traces(
+            {1: {1: "10.0.0.1", 2: "1.1.1.1"}, 2: {1: "10.0.0.1", 2: "*", 3: "1.1.1.1"}}
+        )
+        self.assertListEqual(
+            [i["id"] for i in t.to_dict()["nodes"]], ["10.0.0.1", "1.1.1.1", "*"]
+        )
+        self.assertEqual(len(t.to_dict()["links"]), 3)
+
+
+class TestVizServer(unittest.TestCase):
+    def setUp(self):
+        self.server = traceflow.viz_server("127.0.0.1", 0)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def _get(self, path, headers={}):
+        c = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+        c.request("GET", path, headers=headers)
+        r = c.getresponse()
+        body = r.read()
+        c.close()
+        return r, body
+
+    def test_nodes(self):
+        traces = {
+            path: {ttl: f"10.0.{path}.{ttl}" for ttl in range(1, 30)}
+            for path in range(1, 30)
+        }
+        self.server.set_traces(traces)
+        r, body = self._get("/nodes.json")
+        self.assertEqual(r.status, 200)
+        self.assertEqual(len(json.loads(body)["nodes"]), 29 * 29)
+        r, compressed = self._get("/nodes.json", {"Accept-Encoding": "gzip"})
+        self.assertEqual(r.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(gzip.decompress(compressed), body)
+        self.assertLess(len(compressed), len(body))
+        etag = r.getheader("ETag")
+        r, _ = self._get("/nodes.json", {"If-None-Match": etag})
+        self.assertEqual(r.status, 304)
+        # A new hop is a new version
+        self.server.add_hop("1.1.1.1", 1, 1, "10.9.9.9")
+        r, _ = self._get("/nodes.json", {"If-None-Match": etag})
+        self.assertEqual(r.status, 200)
+
+    def test_index(self):
+        r, body = self._get("/")
+        self.assertEqual(r.status, 200)
+        self.assertIn(b"EventSource", body)
+        r, _ = self._get("/missing")
+        self.assertEqual(r.status, 404)
+
+    def test_events(self):
+        c = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+        c.request("GET", "/events")
+        r = c.getresponse()
+        self.assertEqual(r.getheader("Content-Type"), "text/event-stream")
+        self.server.update(traceflow.hop_event("1.1.1.1", 1, 1, "10.0.0.1"))
+        self.assertEqual(
+            r.fp.readline(),
+            b'data: {"nodes": [{"id": "10.0.0.1", "label": "10.0.0.1"}], "links": [], '
+            b'"version": 1}\n',
+        )
+        self.server.set_traces({1: {1: "10.0.0.1"}})
+        r.fp.readline()
+        self.assertEqual(r.fp.readline(), b'data: {"reset": true, "version": 2}\n')
+        # The JSON is tagged with the version it holds everything up to
+        r, _ = self._get("/nodes.json")
+        self.assertTrue(r.getheader("ETag").endswith('-2"'))
+        c.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
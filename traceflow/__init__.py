@@ -1,10 +1,37 @@
 from traceflow.packet import packet_encode as packet_encode
 from traceflow.packet import packet_decode as packet_decode
+from traceflow.packet import probe_template as probe_template
 
 from traceflow.socket_handler import socket_listener as socket_listener
 from traceflow.socket_handler import socket_handler as socket_handler
 
 from traceflow.printer import printer as printer
+from traceflow.printer import live_printer as live_printer
+from traceflow.printer import record_writer as record_writer
+
+from traceflow.probe_id import probe_id_table as probe_id_table
+
+from traceflow.scheduler import timeout_tracker as timeout_tracker
+from traceflow.scheduler import probe_scheduler as probe_scheduler
+from traceflow.scheduler import batch_scheduler as batch_scheduler
+from traceflow.scheduler import stop_set as stop_set
+from traceflow.scheduler import mda_scheduler as mda_scheduler
+from traceflow.scheduler import mda_stopping_point as mda_stopping_point
+from traceflow.scheduler import retrace_schedule as retrace_schedule
+
+from traceflow.matrix import trace_matrix as trace_matrix
+
+from traceflow.stream import hop_event as hop_event
+from traceflow.stream import hop_stream as hop_stream
+from traceflow.stream import collect_traces as collect_traces
+
+from traceflow.viz import viz_server as viz_server
+
+from traceflow.history import history_store as history_store
+
+import traceflow.metrics as metrics
+from traceflow.metrics import metrics_server as metrics_server
+from traceflow.history import history_trace as history_trace
 
 # logging
 import logging
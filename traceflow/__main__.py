@@ -3,155 +3,550 @@
 import traceflow
 import time
 import logging
+import os
 import socket
+import sys
 import traceflow.helpers as helpers
 
 logger = logging.getLogger()
 
 
 def main():
+    # traceflow history queries the store, rather than tracing anything
+    if sys.argv[1:2] == ["history"]:
+        run_history(helpers.get_history_help(sys.argv[2:]))
+        exit(0)
+
     # ha ha ha
     args = helpers.get_help()
 
-    daddr = resolve_address(args.destination)
     tot_runs = args.paths
+    if tot_runs is None:
+        tot_runs = 255 if args.mda else 4
     dst_port = args.dstport
     src_port = args.srcport
     max_ttl = args.ttl
     bind_ip = args.bind
     to_wait = args.wait
+    window = args.window
+    pps = args.pps
+    probe_id = args.probe_id
+    # One stop set for the whole run, so every path and destination learns from the others
+    stop_set = traceflow.stop_set() if args.stop_set else None
+    confidence = args.confidence if args.mda else None
+    retries = args.retries
+    backoff = args.backoff
 
     if args.debug:
         logger.setLevel(logging.DEBUG)
-    if tot_runs > 255:
-        logger.warning(f"Max paths we can probe is 255. Setting --paths to 255 and continuing")
-        tot_runs = 255
-
-    traces = compute_traces(daddr, tot_runs, dst_port, src_port, max_ttl, to_wait)
-
-    if args.dedup:
-        traces = helpers.remove_duplicate_paths(traces)
-    if args.format.lower() == "vert":
-        # Print horizontal results
-        traceflow.printer.print_vertical(traces)
-    if args.format.lower() == "horiz":
-        # print vertical results
-        traceflow.printer.print_horizontal(traces)
+    # Path N is sent from src_port + N, which has to stay a valid port
+    max_paths = traceflow.probe_id_table(probe_id).max_paths(src_port)
+    if max_paths < 1:
+        logger.error(f"No source ports left above --srcport {src_port}, exiting")
+        exit(1)
+    if tot_runs > max_paths:
+        logger.warning(
+            f"Max paths we can probe is {max_paths}. "
+            f"Setting --paths to {max_paths} and continuing"
+        )
+        if probe_id == "ipid" and max_paths == 255:
+            logger.warning(
+                "Use --probe-id=srcport or --probe-id=checksum to probe more"
+            )
+        tot_runs = max_paths
+    if confidence is not None and not 0 < confidence < 1:
+        logger.error("--confidence must be between 0 and 1, exiting")
+        exit(1)
+    if confidence is not None and stop_set is not None:
+        logger.warning(f"--stop-set does not apply to --mda, ignoring it")
+        stop_set = None
+    if max_ttl > 255:
+        logger.warning(
+            "Max TTL we can probe is 255. Setting --ttl to 255 and continuing"
+        )
+        max_ttl = 255
+
+    # The browser based visualisation is served from the start, and shows hops as they come in
+    viz = None
     if args.format.lower() == "viz":
-        # Experimental vis.js / browser based visualisation
-        traceflow.printer.start_viz(traces, bind_ip)
+        viz = traceflow.viz_server(bind_ip, args.port)
+        viz.start()
+        print(
+            f"Starting temp. web server on http://{bind_ip}:{viz.port}. Ctrl+C to finish/exit."
+        )
+
+    # Machine readable records, one per hop, written out as hops come in rather than once done
+    writer = None
+    if args.format.lower() in traceflow.record_writer.FORMATS:
+        writer = traceflow.record_writer(args.format.lower(), src_port)
+
+    # Metrics are kept whether or not anybody reads them, they only need exposing
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = traceflow.metrics_server(bind_ip, args.metrics_port)
+        metrics.start()
+        logger.info(f"Serving metrics on http://{bind_ip}:{metrics.port}/metrics")
+
+    # Every trace is also appended to the history store, if given, whatever is printed
+    history = None
+    if args.history is not None:
+        history = traceflow.history_store(args.history)
+
+    if args.daemon:
+        schedule = helpers.get_schedule(args)
+        if len(schedule) == 0:
+            logger.error("No destination given, exiting")
+            exit(1)
+        run_daemon(
+            schedule,
+            tot_runs,
+            dst_port,
+            src_port,
+            max_ttl,
+            to_wait,
+            window,
+            pps,
+            probe_id,
+            stop_set,
+            confidence,
+            retries,
+            backoff,
+            [r for r in (viz, writer, history) if r is not None],
+            writer is None,
+            args.metrics_file,
+        )
+        if writer is not None:
+            writer.close()
+        if viz is not None:
+            viz.close()
+        if metrics is not None:
+            metrics.close()
+        exit(0)
+
+    destinations = helpers.get_destinations(args)
+    if len(destinations) == 0:
+        logger.error("No destination given, exiting")
+        exit(1)
+
+    # results is a dict of destination -> (daddr, traces), and rtts of daddr -> path -> ttl -> RTT in milliseconds
+    results = dict()
+    rtts = dict()
+    # On a terminal, the table is drawn as hops come in, then replaced by the final one
+    renderers = [r for r in (viz, writer, history) if r is not None]
+    if args.format.lower() in ["vert", "horiz"] and sys.stdout.isatty():
+        renderers.append(
+            traceflow.live_printer(horizontal=args.format.lower() == "horiz")
+        )
+    # Records are all that goes to stdout, so they go through the batch path which prints nothing else
+    if len(destinations) == 1 and writer is None:
+        daddr = resolve_address(destinations[0])
+        traces = compute_traces(
+            daddr,
+            tot_runs,
+            dst_port,
+            src_port,
+            max_ttl,
+            to_wait,
+            window,
+            pps,
+            probe_id,
+            stop_set,
+            confidence,
+            retries,
+            backoff,
+            rtts,
+            renderers,
+        )
+        if len(traces) == 0:
+            print(f"Did not receive any TTL expired ICMP packets. Exiting")
+            exit(1)
+        results[destinations[0]] = (daddr, traces)
+    else:
+        # Batch mode: trace every destination at once, through one listener and one sender
+        targets = dict()
+        for dest in destinations:
+            daddr = resolve_address(dest, exit_on_error=False)
+            if daddr is not None:
+                targets[dest] = daddr
+        batch = compute_batch(
+            sorted(set(targets.values())),
+            tot_runs,
+            dst_port,
+            src_port,
+            max_ttl,
+            to_wait,
+            window,
+            pps,
+            probe_id,
+            stop_set,
+            confidence,
+            retries,
+            backoff,
+            rtts,
+            renderers,
+        )
+        for dest, daddr in targets.items():
+            results[dest] = (daddr, batch[daddr])
+
+    if args.metrics_file is not None:
+        traceflow.metrics.REGISTRY.write_textfile(args.metrics_file)
+    if metrics is not None:
+        metrics.close()
+
+    if writer is not None:
+        # Every hop has been written out already, bar whatever is still buffered
+        writer.close()
+        exit(0)
+
+    batch_mode = len(destinations) > 1
+    viz_traces = dict()
+    for dest, (daddr, traces) in results.items():
+        if len(traces) == 0:
+            print(f"Did not receive any TTL expired ICMP packets for {dest}")
+            continue
+        # Adaptive enumeration sends many flows down the same path, only the distinct ones are of interest
+        # Each path is fingerprinted once, and the paths which found the same hops are grouped, so we can still say
+        # which source ports each unique path was found from
+        groups = None
+        if args.dedup or confidence is not None:
+            groups = helpers.group_paths(traces)
+            traces = helpers.remove_duplicate_paths(traces, groups)
+        diamonds = None
+        if confidence is not None:
+            diamonds = helpers.find_diamonds(traces)
+        if batch_mode and args.format.lower() in ["vert", "horiz"]:
+            print(f"Trace to {dest} ({daddr})")
+        if args.format.lower() == "vert":
+            # Print horizontal results
+            traceflow.printer.print_vertical(traces, rtts.get(daddr))
+        if args.format.lower() == "horiz":
+            # print vertical results
+            traceflow.printer.print_horizontal(traces, rtts.get(daddr))
+        if groups is not None and args.format.lower() in ["vert", "horiz"]:
+            traceflow.printer.print_groups(groups, src_port)
+        if diamonds is not None and args.format.lower() in ["vert", "horiz"]:
+            traceflow.printer.print_diamonds(diamonds)
+        if args.format.lower() == "json":
+            # One JSON object per destination, per line
+            traceflow.printer.print_json(
+                traces, dest, daddr, diamonds, rtts.get(daddr), None, groups, src_port
+            )
+        if args.format.lower() == "viz":
+            # All destinations end up in the one topology
+            for path in sorted(traces):
+                viz_traces[len(viz_traces) + 1] = traces[path]
+    if viz is not None:
+        if viz_traces:
+            # Experimental vis.js / browser based visualisation, now with the finished (and padded) traces
+            viz.set_traces(viz_traces)
+            viz.serve_forever()
+        viz.close()
     exit(0)
 
 
-def resolve_address(dest):
+def resolve_address(dest, exit_on_error=True):
     try:
         daddr = socket.gethostbyname(dest)
     except socket.gaierror as e:
         if "Name or service not known" in str(e):
-            err_msg = f"Error, could not resolve {dest}, exiting\n"
+            err_msg = f"Error, could not resolve {dest}"
         else:
-            err_msg = f"General error resolving {dest}\nexiting\n"
-        logger.error(err_msg)
+            err_msg = f"General error resolving {dest}"
+        if not exit_on_error:
+            logger.error(f"{err_msg}, skipping\n")
+            return None
+        logger.error(f"{err_msg}\nexiting\n")
         exit(1)
     logger.info(f"Resolved {dest} to {daddr}")
     return daddr
 
 
-def compute_traces(daddr, tot_runs=4, dst_port=33452, src_port=33452, max_ttl=64, to_wait=0.1):
-    # Setup the background thread listener here.
-    # Note that we need to pass daddr
-    # so we can snag the dst port unreachable ICMP message.
-    listener = traceflow.socket_listener(daddr)
-
-    run_ids = dict()
-
-    # Keep track of which path we're looking to enumerate
-    for path in range(1, tot_runs + 1):
-        port = src_port + path
-        run_ids[path] = port
-        print(f"Looking at Path ID {path} (src port:{port} , dst port:{dst_port})")
-        for ttl in list(range(1, max_ttl)):
-            # Here we will combine the path we're after with the TTL,
-            # and use this to track the returning ICMP payload
-            ip_id = helpers.ints_to_ipid(path, ttl)
-            # TODO: Hide this behind a class
-            ip_ver = 4
-            ip_daddr = daddr
-            udp_src_port = port
-            udp_dst_port = dst_port
-            ttl = ttl
-            l4_proto = 17
-            ip_id = ip_id
-            additional_params = {"ip_tos": None, "ip_frag_off": None}
-            # Create our packet here.
-            i = traceflow.packet_encode(
-                ip_ver,
-                ip_daddr,
-                udp_src_port,
-                udp_dst_port,
-                ttl,
-                l4_proto,
-                ip_id,
-                **additional_params,
+def run_history(args):
+    # Prints every stored trace the query matches, as the trace itself would have been printed
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    if args.destination is None and args.through is None and args.since is None:
+        logger.error("Give a destination, --through or --since, exiting")
+        exit(1)
+    if not os.path.isdir(args.history):
+        logger.error(f"No history in {args.history}, exiting")
+        exit(1)
+    target = None
+    if args.destination is not None:
+        target = resolve_address(args.destination)
+    through = None
+    if args.through is not None:
+        through = resolve_address(args.through)
+    since = None
+    if args.since is not None:
+        since = helpers.time_ns() - int(args.since * 1e9)
+    with traceflow.history_store(args.history) as store:
+        start = time.monotonic()
+        if since is None and through is None:
+            # Just a destination, so only its latest trace
+            found = [t for t in [store.latest(target)] if t is not None]
+        else:
+            found = list(store.traces(target, since, None, through))
+        logging.debug(
+            f"Found {len(found)} of {len(store)} traces "
+            f"in {(time.monotonic() - start) * 1000:.1f} ms"
+        )
+    if len(found) == 0:
+        print(f"No traces found in {args.history}")
+        exit(1)
+    for trace in found:
+        started = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(trace.time / 1e9))
+        if args.format.lower() == "json":
+            traceflow.printer.print_json(
+                trace.traces, trace.target, trace.target, None, trace.rtts, started
             )
-            # TODO: Maybe refactor to hide these behind a single function, to be v4/v6 agnostic
-            # Combine the IPv4 and UDP headers here
-            probe = i.ipv4_packet + i.udp_packet
-
-            s = traceflow.socket_handler(ip_daddr)
-            _ = s.send_ipv4(probe)
-            time.sleep(to_wait)
-            # Since we are not running a sequential trace,
-            # we should check in to see if we've gotten a reply from the destination yet
-            packets = listener.get_packets_by_pathid(path)
-            end = [i for i in packets if i["ip_saddr"] == daddr]
-            if len(end) > 0:
-                logging.debug(f"Breaking trace to {daddr} at TTL {ttl}")
-                break
-
-    # We should get all the packets the listener received here
-    rx_icmp = listener.get_all_packets()
-    if len(rx_icmp) == 0:
-        logging.debug(f"rx_icmp is  {len(rx_icmp)}")
-        print(f"Did not receive any TTL expired ICMP packets. Exiting")
+            continue
+        print(f"Trace to {trace.target} at {started}")
+        if len(trace.traces) == 0:
+            print(f"Did not receive any TTL expired ICMP packets")
+        elif args.format.lower() == "horiz":
+            traceflow.printer.print_horizontal(trace.traces, trace.rtts)
+        else:
+            traceflow.printer.print_vertical(trace.traces, trace.rtts)
+
+
+def run_daemon(
+    schedule,
+    tot_runs=4,
+    dst_port=33452,
+    src_port=33452,
+    max_ttl=64,
+    to_wait=1.0,
+    window=32,
+    pps=0,
+    probe_id="ipid",
+    stop_set=None,
+    confidence=None,
+    retries=1,
+    backoff=2.0,
+    renderers=None,
+    changes=True,
+    metrics_file=None,
+):
+    # Resolve every destination once, rather than on every round
+    targets = dict()
+    for dest in schedule:
+        daddr = resolve_address(dest, exit_on_error=False)
+        if daddr is not None:
+            targets[dest] = daddr
+    if len(targets) == 0:
+        logger.error("None of the destinations resolved, exiting")
         exit(1)
-    traces = dict()
-
-    # For each packet the listener got, loop across the ICMP message
-    # and see what the TTL/Path combo is.
-    # Then add them to the dict traces as: traces[path][ttl]
-    for i in rx_icmp:
-        icmp_packet = traceflow.packet_decode.decode_icmp(rx_icmp[i]["payload"])
-        ipv4_packet = traceflow.packet_decode.decode_ipv4_header(icmp_packet["payload"])
-        (path, ttl) = helpers.ipid_to_ints(ipv4_packet["ip_id"])
-        if path not in traces.keys():
-            traces[path] = dict()
-        if ttl not in traces[path].keys():
-            traces[path][ttl] = rx_icmp[i]["ip_saddr"]
-        logging.debug("Run: %s TTL: %s" % (path, ttl))
-
-    # Here we will fill in missing probes with a *
-    # We should also trim any duplicate replies from daddr
-    # and also fill in an x to pad up unequal path lengths
-    traces = helpers.remove_duplicates(traces, daddr)
-    path_max = max([max(traces[i].keys()) for i in traces.keys()])
-    for path in traces.keys():
-        # Now we fill in * for any missing hops
-        last_ttl = sorted(traces[path])[-1]
-        for ttl in list(range(1, last_ttl + 1)):
-            if ttl not in traces[path]:
-                logging.debug(f"Missing TTL({ttl}) for path {path}")
-                traces[path][ttl] = "*"
-        # Now we should handle unequal length paths
-        path_length = len(traces[path])
-        if path_length < path_max:
-            for i in range(path_length, path_max + 1):
-                if i not in traces[path].keys():
-                    logging.debug(f"Insert fake hop at {i} for path {path}")
-                    traces[path][i] = "x"
 
+    # One probe ID table, listener and sender for as long as we run.
+    # Each round drops what it received once done, so memory use stays flat.
+    probe_ids = traceflow.probe_id_table(probe_id)
+    listener = traceflow.socket_listener(udp_dst_port=dst_port)
+    sender = traceflow.socket_handler()
+    rounds = traceflow.retrace_schedule(
+        {dest: schedule[dest] for dest in targets}, now=time.monotonic()
+    )
+    # Only the distinct paths of the last round are kept per destination, to compare the next one with
+    last_paths = dict()
+    try:
+        while True:
+            time.sleep(rounds.next_deadline(time.monotonic()))
+            due = rounds.due(time.monotonic())
+            # Every target of a round shares a stop set, but each round learns its own, so a route change near this
+            # host is still seen by the round after it
+            if stop_set is not None:
+                stop_set = traceflow.stop_set()
+            results = run_batch(
+                sorted({targets[dest] for dest in due}),
+                listener,
+                sender,
+                probe_ids,
+                tot_runs,
+                dst_port,
+                src_port,
+                max_ttl,
+                to_wait,
+                window,
+                pps,
+                stop_set,
+                confidence,
+                retries,
+                backoff,
+                None,
+                renderers,
+            )
+            for dest in due:
+                paths = helpers.distinct_paths(results[targets[dest]])
+                added, removed = helpers.diff_paths(last_paths.get(dest), paths)
+                if changes and (added or removed):
+                    traceflow.printer.print_changes(dest, targets[dest], added, removed)
+                last_paths[dest] = paths
+                rounds.done(dest, time.monotonic())
+            if metrics_file is not None:
+                traceflow.metrics.REGISTRY.write_textfile(metrics_file)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        sender.close()
+
+
+def compute_traces(
+    daddr,
+    tot_runs=4,
+    dst_port=33452,
+    src_port=33452,
+    max_ttl=64,
+    to_wait=1.0,
+    window=32,
+    pps=0,
+    probe_id="ipid",
+    stop_set=None,
+    confidence=None,
+    retries=1,
+    backoff=2.0,
+    rtts=None,
+    renderers=None,
+):
+    if confidence is not None:
+        print(
+            f"Enumerating paths adaptively, up to {tot_runs} flows (src port:{src_port + 1}-{src_port + tot_runs} , dst port:{dst_port})"
+        )
+    else:
+        for path in range(1, tot_runs + 1):
+            port = src_port + path
+            print(f"Looking at Path ID {path} (src port:{port} , dst port:{dst_port})")
+
+    traces = compute_batch(
+        [daddr],
+        tot_runs,
+        dst_port,
+        src_port,
+        max_ttl,
+        to_wait,
+        window,
+        pps,
+        probe_id,
+        stop_set,
+        confidence,
+        retries,
+        backoff,
+        rtts,
+        renderers,
+    )[daddr]
     return traces
 
 
+def compute_batch(
+    daddrs,
+    tot_runs=4,
+    dst_port=33452,
+    src_port=33452,
+    max_ttl=64,
+    to_wait=1.0,
+    window=32,
+    pps=0,
+    probe_id="ipid",
+    stop_set=None,
+    confidence=None,
+    retries=1,
+    backoff=2.0,
+    rtts=None,
+    renderers=None,
+):
+    # The probe ID table says which fields of each probe identify it, and maps them back to (target, path, ttl)
+    probe_ids = traceflow.probe_id_table(probe_id)
+    # Setup the background thread listener here.
+    # run_batch registers every daddr with it,
+    # so we can snag the dst port unreachable ICMP messages, and tell the replies apart.
+    # One sender for the whole run, every batch of probes goes out through it
+    with traceflow.socket_listener(
+        udp_dst_port=dst_port
+    ) as listener, traceflow.socket_handler() as sender:
+        return run_batch(
+            daddrs,
+            listener,
+            sender,
+            probe_ids,
+            tot_runs,
+            dst_port,
+            src_port,
+            max_ttl,
+            to_wait,
+            window,
+            pps,
+            stop_set,
+            confidence,
+            retries,
+            backoff,
+            rtts,
+            renderers,
+        )
+
+
+def run_batch(
+    daddrs,
+    listener,
+    sender,
+    probe_ids,
+    tot_runs=4,
+    dst_port=33452,
+    src_port=33452,
+    max_ttl=64,
+    to_wait=1.0,
+    window=32,
+    pps=0,
+    stop_set=None,
+    confidence=None,
+    retries=1,
+    backoff=2.0,
+    rtts=None,
+    renderers=None,
+):
+    # Traces every daddr once, through a listener and sender which may be reused across runs.
+    # If rtts is a dict, it is filled in with rtts[daddr][path][ttl], the RTT of each hop in milliseconds
+    start = time.perf_counter()
+    stream = traceflow.hop_stream(
+        daddrs,
+        listener,
+        sender,
+        probe_ids,
+        tot_runs,
+        dst_port,
+        src_port,
+        max_ttl,
+        to_wait,
+        window,
+        pps,
+        stop_set,
+        confidence,
+        retries,
+        backoff,
+    )
+    # The traces dict is built up as hops come in, and padded out once every path is done.
+    # Meanwhile, each of the renderers (such as a traceflow.live_printer or traceflow.viz_server) is handed them as
+    # they come in, if given.
+    events = stream
+    for renderer in renderers or ():
+        events = renderer.watch(events)
+    # Kept as a trace_matrix per daddr, which reads like a dict but takes a fraction of the memory in big batches
+    results = traceflow.collect_traces(events, daddrs, rtts, matrix=True)
+    traceflow.metrics.PHASE_TRACE.observe(time.perf_counter() - start)
+    traceflow.metrics.LAST_TRACE.set(time.time())
+    scheduler = stream.scheduler
+    logging.debug(
+        f"Sent {scheduler.sent} probes, {scheduler.retransmitted} of them retransmitted"
+    )
+    logging.debug(
+        f"Listener has seen {listener.duplicates} duplicate and {listener.foreign} "
+        f"foreign replies, and evicted {listener.evicted}"
+    )
+    if confidence is not None:
+        for daddr in daddrs:
+            s = scheduler.schedulers[daddr]
+            logging.info(f"Sent {s.sent} probes over {s.flows} flows to {daddr}")
+    return results
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+""" asyncio tracing API, for embedding traceflow in an event loop without threads """
+
+import asyncio
+import logging
+import socket
+import struct
+
+import traceflow
+import traceflow.helpers as helpers
+
+
+class _trace_state:
+    """
+    _trace_state holds the replies for a single trace() call, as handed over by _trace_io.
+    """
+
+    def __init__(self, daddr: str, ports: dict, probe_ids):
+        """
+        :param daddr: destination IPv4 address, dotted quad
+        :param ports: dict of source port -> path ID used by this trace
+        :param probe_ids: the probe_id_table this trace sends with
+        """
+        self.daddr = daddr
+        self.ports = ports
+        self.probe_ids = probe_ids
+        # (path, ttl) -> address of the responding hop
+        self.replies = dict()
+        self._new_replies = list()
+        self._event = asyncio.Event()
+
+    def on_reply(self, path: int, ttl: int, saddr: str, final: bool) -> None:
+        if (path, ttl) not in self.replies:
+            self.replies[(path, ttl)] = saddr
+        self._new_replies.append((path, ttl, final, saddr))
+        self._event.set()
+
+    async def wait_for_replies(self, timeout: float) -> list:
+        """
+        wait_for_replies waits until at least one new reply has arrived, or the timeout passes.
+
+        :param timeout: maximum time (in seconds) to wait for
+        :return: list of (path, ttl, final, responder) tuples, one per reply received since the last call
+        """
+        if not self._new_replies:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._event.clear()
+        new_replies = self._new_replies
+        self._new_replies = list()
+        return new_replies
+
+
+class _trace_io:
+    """
+    _trace_io owns the raw send socket and the ICMP receive socket for one event loop. Both are non-blocking and
+    registered with the loop, and are shared by every trace() running on it. Replies are handed to the right trace by
+    the destination address and source port quoted back in the ICMP message. Failing to open either socket raises
+    OSError, such as PermissionError when not run as root.
+    """
+
+    _instances = dict()
+
+    def __init__(self, loop):
+        self.loop = loop
+        # Raises rather than exits, this is a library call
+        self.sender = traceflow.socket_handler(exit_on_error=False)
+        self.sender.raw_sock.setblocking(False)
+        try:
+            self.icmp_sock = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP
+            )
+        except OSError:
+            self.sender.close()
+            raise
+        self.icmp_sock.setblocking(False)
+        # daddr -> list of _trace_state
+        self.traces = dict()
+        self.loop.add_reader(self.icmp_sock.fileno(), self._on_readable)
+
+    @classmethod
+    def get(cls, loop) -> "_trace_io":
+        if loop not in cls._instances:
+            cls._instances[loop] = cls(loop)
+        return cls._instances[loop]
+
+    def register(self, state: _trace_state) -> None:
+        self.traces.setdefault(state.daddr, list()).append(state)
+
+    def deregister(self, state: _trace_state) -> None:
+        self.traces[state.daddr].remove(state)
+        if not self.traces[state.daddr]:
+            self.traces.pop(state.daddr)
+        if not self.traces:
+            # Last trace on this loop is done, give the sockets back
+            self.close()
+
+    def close(self) -> None:
+        self.loop.remove_reader(self.icmp_sock.fileno())
+        self.icmp_sock.close()
+        self.sender.close()
+        _trace_io._instances.pop(self.loop, None)
+
+    async def send(self, probes: list) -> None:
+        """
+        send puts a batch of probes on the wire, waiting for the socket to become writable if the kernel pushes back.
+        Only the probes which did not make it are sent again.
+
+        :param probes: list of bytes objects, each containing an IPv4 packet
+        """
+        while True:
+            try:
+                probes = probes[self.sender.send_batch(probes) :]
+            except BlockingIOError:
+                pass
+            if not probes:
+                return
+            writable = self.loop.create_future()
+            fd = self.sender.raw_sock.fileno()
+            self.loop.add_writer(fd, writable.set_result, None)
+            try:
+                await writable
+            finally:
+                self.loop.remove_writer(fd)
+
+    def _on_readable(self) -> None:
+        # Drain everything which is queued up, the reader callback only fires once per wakeup
+        while True:
+            try:
+                icmp_packet = self.icmp_sock.recv(512)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self._dispatch(icmp_packet)
+            except struct.error:
+                logging.debug("Dropping truncated ICMP packet")
+
+    def _dispatch(self, icmp_packet: bytes) -> None:
+        reply = traceflow.packet_decode.unpack_icmp_reply(icmp_packet)
+        daddr = reply.ip_daddr
+        if daddr not in self.traces:
+            return
+        # Same rules as socket_listener: TTL expired, or an answer from (or on behalf of) the destination
+        final = reply.saddr == reply.daddr or (reply.type == 3 and reply.code == 3)
+        if reply.type != 11 and not final:
+            return
+        for state in self.traces[daddr]:
+            probe = state.probe_ids.lookup(
+                daddr, reply.ip_id, reply.src_port, reply.udp_checksum
+            )
+            if probe is not None and state.ports.get(reply.src_port) == probe[0]:
+                state.on_reply(probe[0], probe[1], reply.ip_saddr, final)
+
+
+async def trace(
+    daddr,
+    tot_runs=4,
+    dst_port=33452,
+    src_port=33452,
+    max_ttl=64,
+    to_wait=1.0,
+    window=32,
+    pps=0,
+    probe_id="ipid",
+    stop_set=None,
+    retries=1,
+    backoff=2.0,
+) -> dict:
+    """
+    trace is the asyncio equivalent of compute_traces. All sockets are registered with the running event loop, so many
+    traces can be interleaved in one loop without threads. Concurrent traces to the same destination must use
+    different source ports.
+
+    :param daddr: destination hostname or IPv4 address
+    :param tot_runs: number of paths to enumerate
+    :param dst_port: UDP destination port
+    :param src_port: UDP source port, path N uses src_port + N
+    :param max_ttl: Max TTL to reach
+    :param to_wait: time (in seconds) to wait for a reply to each probe
+    :param window: maximum number of probes in flight at once
+    :param pps: maximum number of probes per second, 0 for no limit
+    :param probe_id: probe ID scheme, see probe_id_table
+    :param stop_set: traceflow.stop_set to skip hops already known with, may be shared between traces
+    :param retries: number of times to retransmit a probe which got no reply
+    :param backoff: factor the wait grows by with each retransmission
+    :return: dict: traces[path][ttl], as used by traceflow.printer. Empty if nothing answered.
+    :raises OSError: if the raw sockets cannot be opened, such as PermissionError when not run as root
+    """
+    # get_event_loop() is deprecated inside a coroutine from Python 3.10, get_running_loop() only came with 3.7
+    if hasattr(asyncio, "get_running_loop"):
+        loop = asyncio.get_running_loop()
+    else:
+        loop = asyncio.get_event_loop()
+    addrinfo = await loop.getaddrinfo(daddr, None, family=socket.AF_INET)
+    daddr = addrinfo[0][4][0]
+
+    ports = {src_port + path: path for path in range(1, tot_runs + 1)}
+    run_ids = {path: port for port, path in ports.items()}
+    probe_ids = traceflow.probe_id_table(probe_id)
+    state = _trace_state(daddr, ports, probe_ids)
+    io = _trace_io.get(loop)
+    io.register(state)
+    try:
+        scheduler = traceflow.probe_scheduler(
+            tot_runs, max_ttl, window, pps, to_wait, stop_set, retries, backoff
+        )
+        template = traceflow.probe_template(
+            daddr, src_port + 1, dst_port, fixed_checksum=probe_id == "checksum"
+        )
+        while not scheduler.done():
+            probes = list()
+            for path, ttl in scheduler.next_probes(loop.time()):
+                port = run_ids[path]
+                ip_id, checksum = probe_ids.allocate(daddr, path, ttl, port)
+                probes.append(template.build(ttl, ip_id, port, checksum))
+            if probes:
+                await io.send(probes)
+            timeout = scheduler.next_deadline(loop.time())
+            for path, ttl, final, saddr in await state.wait_for_replies(timeout):
+                scheduler.reply(path, ttl, final, saddr)
+            scheduler.expire(loop.time())
+    finally:
+        io.deregister(state)
+    logging.debug(f"Sent {scheduler.sent} probes to {daddr}")
+
+    traces = dict()
+    for (path, ttl), saddr in state.replies.items():
+        traces.setdefault(path, dict())[ttl] = saddr
+    for path, hops in scheduler.filled.items():
+        for ttl, saddr in hops.items():
+            traces.setdefault(path, dict()).setdefault(ttl, saddr)
+    return helpers.pad_traces(traces, daddr)
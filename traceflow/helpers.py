@@ -3,8 +3,28 @@
 """ Generic collection of helpers for __main__.py """
 
 import argparse
+import hashlib
+import http.server
+import socketserver
 import struct
 import logging
+import time
+
+from traceflow.matrix import trace_matrix
+
+
+def _time_ns() -> int:
+    """
+    _time_ns returns the time in ns since the epoch, for Python 3.6 which has no time.time_ns(). A double only holds
+    the time to within a few hundred ns, which is close enough for an RTT.
+
+    :return: int
+    """
+    return int(time.time() * 1e9)
+
+
+# Same clock as the kernel timestamps replies with
+time_ns = getattr(time, "time_ns", _time_ns)
 
 
 def help_text() -> str:
@@ -25,7 +45,10 @@ def get_help() -> argparse:
 
     # Named Arguments
     parser.add_argument(
-        "--paths", help="Number of paths to enumerate", default=4, type=int
+        "--paths",
+        help="Number of paths to enumerate (default 4), or the most to use with --mda (default 255)",
+        default=None,
+        type=int,
     )
     parser.add_argument("--ttl", help="Max TTL to reach", default=64, type=int)
     parser.add_argument(
@@ -36,13 +59,37 @@ def get_help() -> argparse:
     )
     parser.add_argument(
         "--wait",
-        help="Set the time (in seconds) to wait between sending probes",
-        default=0.1,
+        help="Set the time (in seconds) to wait for a reply to each probe",
+        default=1.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--retries",
+        help="Number of times to retransmit a probe which got no reply",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--backoff",
+        help="Factor the wait grows by with each retransmission",
+        default=2.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--window",
+        help="Maximum number of probes in flight at once, across all paths",
+        default=32,
         type=int,
     )
+    parser.add_argument(
+        "--pps",
+        help="Maximum number of probes to send per second (0 for no limit)",
+        default=0,
+        type=float,
+    )
     parser.add_argument(
         "--format",
-        help="Print the results vertically (--format=vert) or horizontally (--format=horiz), or even represented in a web browser (--format=viz)",
+        help="Print the results vertically (--format=vert) or horizontally (--format=horiz), as one JSON object per destination (--format=json), as one JSON Lines (--format=jsonl) or CSV (--format=csv) record per hop as soon as it is known, or even represented in a web browser (--format=viz)",
         default="vert",
         type=str,
     )
@@ -52,18 +99,183 @@ def get_help() -> argparse:
         default="127.0.0.1",
         type=str,
     )
+    parser.add_argument(
+        "--port",
+        help="TCP port for the vis.js web server to listen on",
+        default=8081,
+        type=int,
+    )
     parser.add_argument(
         "--dedup", help="De-duplicate the traceflow results", action="store_true"
     )
+    parser.add_argument(
+        "--probe-id",
+        help="Which probe fields identify a probe: IP.ID only (--probe-id=ipid, max 255 paths), source port and IP.ID (--probe-id=srcport) or source port and UDP checksum (--probe-id=checksum)",
+        default="ipid",
+        choices=["ipid", "srcport", "checksum"],
+        type=str,
+    )
+    parser.add_argument(
+        "--stop-set",
+        help="Skip probing hops near this host which other paths have already found, Doubletree style",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--mda",
+        help="Enumerate paths adaptively, using as many flows as needed to find every next hop (--paths becomes the maximum)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--confidence",
+        help="Confidence that every next hop has been found, for --mda",
+        default=0.95,
+        type=float,
+    )
+    parser.add_argument(
+        "--daemon",
+        help="Keep tracing every destination at its interval, and print only the paths which changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--interval",
+        help="Time (in seconds) between traces of a destination in --daemon mode, unless the --targets file says otherwise",
+        default=300.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--targets",
+        help="File with a list of destinations to trace, one per line",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--history",
+        help="Directory to append every trace to, for traceflow history to query later",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="Serve metrics for Prometheus to scrape on this TCP port, at /metrics on --bind",
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="File to write metrics to in the Prometheus text format once done (every round with --daemon), for the node_exporter textfile collector",
+        default=None,
+        type=str,
+    )
     parser.add_argument("--debug", help="Enable Debug Logging", action="store_true")
 
     # Positional Arguments
-    parser.add_argument("destination", action="store", type=str)
+    parser.add_argument("destination", action="store", type=str, nargs="*")
 
     args = parser.parse_args()
     return args
 
 
+def get_history_help(argv: list = None) -> argparse:
+    """
+    Helper function to handle CLI arguments of traceflow history, which queries the traces stored with --history.
+
+    :param argv: arguments after history, defaults to sys.argv[2:]
+    :return: argparse: parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        "traceflow history",
+        description="Query the traces stored with --history. With just a destination, its latest trace is printed.",
+    )
+    parser.add_argument(
+        "--history", help="Directory the traces were stored in", required=True, type=str
+    )
+    parser.add_argument(
+        "--through",
+        help="Only traces with this hop on any of their paths",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--since",
+        help="Only traces from this long ago or later, in seconds or with a unit (30m, 6h, 1d, 2w)",
+        default=None,
+        type=parse_duration,
+    )
+    parser.add_argument(
+        "--format",
+        help="Print the traces vertically (--format=vert), horizontally (--format=horiz) or as one JSON object per trace (--format=json)",
+        default="vert",
+        choices=["vert", "horiz", "json"],
+        type=str,
+    )
+    parser.add_argument("--debug", help="Enable Debug Logging", action="store_true")
+    parser.add_argument("destination", action="store", type=str, nargs="?")
+    return parser.parse_args(argv)
+
+
+def parse_duration(text: str) -> float:
+    """
+    parse_duration reads a length of time, as a number of seconds with an optional s, m, h, d or w unit.
+
+    :param text: such as 90, 30m or 1d
+    :return: float: the length of time in seconds
+    """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    scale = units.get(text[-1:].lower())
+    try:
+        if scale is None:
+            return float(text)
+        return float(text[:-1]) * scale
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid length of time: {text}")
+
+
+def get_destinations(args: argparse.Namespace) -> list:
+    """
+    get_destinations collects every destination to trace, from the positional arguments and the --targets file.
+    Blank lines and lines starting with # in the file are skipped, and duplicates are dropped.
+
+    :param args: parsed arguments, as returned by get_help()
+    :return: list: destinations, in the order given
+    """
+    destinations = list(args.destination)
+    if args.targets:
+        with open(args.targets) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    # Anything after the destination is for get_schedule()
+                    destinations.append(line.split()[0])
+    # dict keeps the order, while dropping duplicates
+    return list(dict.fromkeys(destinations))
+
+
+def get_schedule(args: argparse.Namespace) -> dict:
+    """
+    get_schedule collects every destination to monitor, and how often to trace it. Lines in the --targets file may give
+    an interval (in seconds) after the destination, the rest are traced every --interval seconds.
+
+    :param args: parsed arguments, as returned by get_help()
+    :return: dict: destination -> interval, in the order given
+    """
+    schedule = {dest: args.interval for dest in args.destination}
+    if args.targets:
+        with open(args.targets) as f:
+            for number, line in enumerate(f, 1):
+                fields = line.split()
+                if not fields or fields[0].startswith("#"):
+                    continue
+                try:
+                    interval = float(fields[1]) if len(fields) > 1 else args.interval
+                except ValueError:
+                    logging.error(
+                        f"{args.targets}:{number}: {fields[1]} is not an interval in seconds, exiting"
+                    )
+                    exit(1)
+                schedule[fields[0]] = interval
+    return schedule
+
+
 def ipid_to_ints(ipid: int) -> tuple:
     """
     ipid_to_ints splits the ip.id of an ingress packet (Half Word, aka 16 bits) into two ints between 0 and 255.
@@ -105,28 +317,128 @@ def remove_duplicates(traces: dict, daddr: str) -> dict:
     return traces
 
 
-def remove_duplicate_paths(traces: dict) -> dict:
+def pad_traces(traces: dict, daddr: str) -> dict:
+    """
+    pad_traces trims duplicate replies from daddr, fills in a * for any hop which did not answer, and pads out shorter
+    paths with an x so every path is as long as the longest one.
+
+    :param traces: a dict of paths and traces, as traces[path][ttl]
+    :param daddr: A string, destination IP address
+    :return: dict: the padded traces dict
+    """
+    if not traces:
+        return traces
+    # Packed into a trace_matrix, trimming, filling in and padding is one pass over an array
+    return trace_matrix.from_dict(traces).pad(daddr).to_dict()
+
+
+def path_fingerprint(hops) -> str:
+    """
+    path_fingerprint gives a path a short canonical fingerprint, a hash of its hops in TTL order. The same hops always
+    get the same fingerprint, whichever path ID or run found them.
+
+    :param hops: sequence of the hops of one path in TTL order, including any * or x
+    :return: str: 16 hex digits
     """
-    remove_duplicate_paths takes traces (dict containing traces) and removes any duplicate path.
+    return hashlib.blake2b("\n".join(hops).encode(), digest_size=8).hexdigest()
+
+
+def group_paths(traces: dict) -> dict:
+    """
+    group_paths groups the path IDs of traces by the path they found, fingerprinting each path only once.
+
+    :param traces: a dict of paths and traces, as traces[path][ttl]
+    :return: dict of fingerprint -> list of path IDs with those hops, both in the order of the lowest path ID
+    """
+    groups = dict()
+    for path in sorted(traces):
+        hops = [traces[path][ttl] for ttl in sorted(traces[path])]
+        groups.setdefault(path_fingerprint(hops), list()).append(path)
+    return groups
+
+
+def remove_duplicate_paths(traces: dict, groups: dict = None) -> dict:
+    """
+    remove_duplicate_paths takes traces (dict containing traces) and removes any duplicate path, keeping the lowest
+    path ID which found it.
 
     :param traces: a dict of paths and traces
+    :param groups: the traces grouped by path, as returned by group_paths, worked out if None
     :return: dict: a deduplicated list of paths
     """
+    if groups is None:
+        groups = group_paths(traces)
     dedup = dict()
-    seen = list()
-    for path in sorted(traces.keys()):
-        # Create a list (ordered) which we'll insert the hop at index of TTL-1
-        total_path = list()
-        for ttl in sorted(traces[path].keys()):
-            total_path.append(traces[path][ttl])
-        # If we have not seen this list before, insert it into seen, then
-        if total_path not in seen:
-            seen.append(total_path)
-            # we recreate the dict in dedup
-            for ttl, hop in enumerate(total_path):
-                # And add the trace with the first path we've seen it at
-                if path not in dedup.keys():
-                    dedup[path] = dict()
-                dedup[path].update({ttl + 1: hop})
-        logging.debug(f"Found unique path: {path}")
+    for paths in groups.values():
+        path = paths[0]
+        dedup[path] = {ttl: traces[path][ttl] for ttl in sorted(traces[path])}
+        logging.debug(f"Found unique path: {path}, also found by {paths[1:]}")
     return dedup
+
+
+def find_diamonds(traces: dict) -> list:
+    """
+    find_diamonds finds the load balanced diamonds in traces: a hop where the paths split up, and the hop where they
+    come back together again. Hops which did not answer (* or x) are ignored.
+
+    :param traces: a dict of paths and traces, as traces[path][ttl]
+    :return: list of dicts, with the ttl and address the diamond opens and closes at, and its width. A diamond which
+    opens at the first hop has no start, and one which does not close again has no end.
+    """
+    interfaces = dict()
+    for path in traces:
+        for ttl, hop in traces[path].items():
+            if hop not in ["*", "x"]:
+                interfaces.setdefault(ttl, set()).add(hop)
+
+    diamonds = list()
+    diamond = {"start_ttl": None, "start": None, "width": 1}
+    for ttl in sorted(interfaces):
+        if len(interfaces[ttl]) > 1:
+            diamond["width"] = max(diamond["width"], len(interfaces[ttl]))
+            continue
+        hop = next(iter(interfaces[ttl]))
+        if diamond["width"] > 1:
+            diamonds.append(dict(diamond, end_ttl=ttl, end=hop))
+        diamond = {"start_ttl": ttl, "start": hop, "width": 1}
+    if diamond["width"] > 1:
+        diamonds.append(dict(diamond, end_ttl=None, end=None))
+    return diamonds
+
+
+def distinct_paths(traces: dict) -> frozenset:
+    """
+    distinct_paths reduces traces to the set of distinct paths in them, regardless of which path ID found each one.
+    The x padding is dropped, as it only depends on how long the other paths are.
+
+    :param traces: a dict of paths and traces, as traces[path][ttl]
+    :return: frozenset of tuples, each holding the hops of one path in TTL order
+    """
+    paths = set()
+    for path in traces:
+        hops = [traces[path][ttl] for ttl in sorted(traces[path])]
+        paths.add(tuple(hop for hop in hops if hop != "x"))
+    return frozenset(paths)
+
+
+def diff_paths(old: frozenset, new: frozenset) -> tuple:
+    """
+    diff_paths compares two sets of paths, as returned by distinct_paths.
+
+    :param old: the paths seen before, or None if there were none
+    :param new: the paths seen now
+    :return: tuple of (added, removed), each a sorted list of paths
+    """
+    old = old or frozenset()
+    return sorted(new - old), sorted(old - new)
+
+
+class threaded_server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    threaded_server is an HTTP server with a thread per connection, as used for the metrics and the visualisation.
+    Connections such as event streams stay open for as long as the browser does, so they are never waited for on
+    exit.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+""" On-disk trace history: an append-only log of hop records, indexed by time, target and hop, memory mapped for reads """
+
+import bisect
+import fcntl
+import math
+import mmap
+import os
+import socket
+import struct
+
+import traceflow
+import traceflow.helpers as helpers
+
+# Every file starts with a magic, so a store is never mixed up with anything else
+MAGIC = b"TFHIST1\n"
+# One hop: responder, RTT (NaN if not known), path, TTL, flags, ICMP type and code (-1 if not known)
+RECORD = struct.Struct("<4sfHBBhh")
+# One trace: time (ns since the epoch), index of its first record, number of records, target
+ENTRY = struct.Struct("<qQI4s")
+# One posting: position in the index of a trace to a target, or through a hop
+POSTING = struct.Struct("<Q")
+# Offset of the responder within a record, as searched on
+_RESPONDER = 0
+_FINAL = 0x01
+
+
+class history_trace:
+    """
+    history_trace is one trace to one target, as read back from a history_store.
+    """
+
+    __slots__ = ("time", "target", "traces", "rtts")
+
+    def __init__(self, time: int, target: str, traces: dict, rtts: dict):
+        """
+        :param time: when the trace was started, in ns since the epoch
+        :param target: destination address, dotted quad
+        :param traces: dict: traces[path][ttl], as used by traceflow.printer
+        :param rtts: dict: rtts[path][ttl], the RTT of each hop in milliseconds
+        """
+        self.time = time
+        self.target = target
+        self.traces = traces
+        self.rtts = rtts
+
+    def __repr__(self) -> str:
+        return f"history_trace({self.target} at {self.time}: {len(self.traces)} paths)"
+
+
+class _mapped:
+    # A file mapped read-only, up to whole units of size past the magic
+    def __init__(self, name: str, size: int):
+        self.size = size
+        self.count = 0
+        self.mm = None
+        with open(name, "rb") as f:
+            length = os.fstat(f.fileno()).st_size
+            self.count = max(length - len(MAGIC), 0) // size
+            if self.count:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.mm[: len(MAGIC)] != MAGIC:
+                    self.mm.close()
+                    raise ValueError(f"{name} is not a traceflow history file")
+
+    def offset(self, i: int) -> int:
+        return len(MAGIC) + i * self.size
+
+    def find(self, needle: bytes, field: int, start: int, end: int):
+        # Yields the number of every unit from start up to end whose field at offset field is needle.
+        # mmap.find does the scanning, only the hits are looked at from Python.
+        lo = self.offset(start) + field
+        hi = self.offset(end)
+        while True:
+            pos = self.mm.find(needle, lo, hi)
+            if pos == -1:
+                return
+            i, rem = divmod(pos - len(MAGIC) - field, self.size)
+            if rem:
+                # Straddles two units
+                lo = pos + 1
+                continue
+            yield i
+            lo = self.offset(i + 1) + field
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+class _column:
+    # A read-only sequence of one field of a mapped file, the index unless told otherwise, for bisect
+    def __init__(self, index: _mapped, field: int, unit: struct.Struct = ENTRY):
+        self.index = index
+        self.field = field
+        self.unit = unit
+
+    def __len__(self) -> int:
+        return self.index.count
+
+    def __getitem__(self, i: int) -> int:
+        return self.unit.unpack_from(self.index.mm, self.index.offset(i))[self.field]
+
+
+class history_store:
+    """
+    history_store keeps every trace in a directory, as an append-only log of fixed size hop records
+    (records.bin) and an index holding the time, target and records of each trace (index.bin). Traces are only
+    ever appended, and in time order, so a time window is found by bisecting the index. Every target and every hop
+    also gets a postings file (targets/ADDRESS and hops/ADDRESS), listing the position in the index of each trace
+    to or through it, in order. A query by target or hop bisects its postings for the time window, so it only
+    touches the traces it returns, however big the store grows. Every file is memory mapped for reads.
+
+    It is also a renderer, like traceflow.live_printer: watch() stores one trace per target every time a stream
+    of hop events ends. Records only count once their trace is in the index, so a store cut off half way through
+    a write reads back as if the write never happened. Several processes may share a store: writes hold an
+    exclusive flock() on the index file, and mapping it for reads a shared one.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: directory to keep the store in, created if it does not exist
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.records_file = os.path.join(path, "records.bin")
+        self.index_file = os.path.join(path, "index.bin")
+        self.targets_dir = os.path.join(path, "targets")
+        self.hops_dir = os.path.join(path, "hops")
+        os.makedirs(self.targets_dir, exist_ok=True)
+        os.makedirs(self.hops_dir, exist_ok=True)
+        for name in [self.records_file, self.index_file]:
+            with open(name, "ab") as f:
+                # Another process may be creating the same store
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if os.fstat(f.fileno()).st_size == 0:
+                    f.write(MAGIC)
+        self._records = None
+        self._index = None
+        # target -> list of hop_event, for the stream being watched
+        self._pending = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        """
+        close unmaps the store. It is mapped again by the next query.
+        """
+        for mapped in [self._records, self._index]:
+            if mapped is not None:
+                mapped.close()
+        self._records = None
+        self._index = None
+
+    def _map(self) -> None:
+        # Mapped once, and again after every append. Appends never touch what is mapped already, only a flush half
+        # way through dropping a half written tail has to be kept out while both are sized up.
+        if self._index is None:
+            with open(self.index_file, "rb") as lock:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                self._index = _mapped(self.index_file, ENTRY.size)
+                self._records = _mapped(self.records_file, RECORD.size)
+
+    def __len__(self) -> int:
+        self._map()
+        return self._index.count
+
+    def update(self, event) -> None:
+        """
+        update holds on to a hop event, until the stream it is part of ends.
+
+        :param event: traceflow.hop_event
+        """
+        hops = self._pending.setdefault(event.target, list())
+        # Probes given up on are not stored, but the target still gets a trace, if an empty one
+        if event.responder is not None:
+            hops.append(event)
+
+    def watch(self, events):
+        """
+        watch passes a stream of hop events through, and stores a trace for each target in it once the stream ends.
+        Nothing is stored if the stream is abandoned part way, as the traces would be incomplete.
+
+        :param events: iterable of hop_event, such as a hop_stream
+        :return: generator of the same hop_event
+        """
+        started = helpers.time_ns()
+        self._pending = dict()
+        for event in events:
+            self.update(event)
+            yield event
+        self.flush(started)
+
+    def flush(self, when: int = None) -> None:
+        """
+        flush stores a trace for each target held on to. Their records go to the log in one write, then their
+        positions to the postings of their target and hops, and last their entries to the index in one write.
+
+        :param when: when the traces were started, in ns since the epoch
+        """
+        if not self._pending:
+            return
+        when = when if when is not None else helpers.time_ns()
+        self.close()
+        with open(self.records_file, "r+b") as records, open(
+            self.index_file, "r+b"
+        ) as index:
+            # Held until the index is closed, by when everything is written. No other process writes or maps the
+            # store in the meantime.
+            fcntl.flock(index, fcntl.LOCK_EX)
+            count, first, last = self._tail(records, index)
+            # The index has to stay in time order, even if the clock went backwards
+            when = max(when, last)
+            entries = list()
+            # address -> positions in the index of the traces to it, and of those through it
+            targets = dict()
+            hops = dict()
+            for target, events in self._pending.items():
+                data = b"".join(self._pack(event) for event in events)
+                records.write(data)
+                i = count + len(entries)
+                entries.append(
+                    ENTRY.pack(when, first, len(events), socket.inet_aton(target))
+                )
+                first += len(events)
+                targets.setdefault(target, list()).append(i)
+                for responder in {event.responder for event in events}:
+                    hops.setdefault(responder, list()).append(i)
+            records.flush()
+            # Posted before the traces are in the index, so a trace is never in the index without them
+            for directory, postings in [
+                (self.targets_dir, targets),
+                (self.hops_dir, hops),
+            ]:
+                for address, positions in postings.items():
+                    self._post(os.path.join(directory, address), positions, count)
+            index.write(b"".join(entries))
+        self._pending = dict()
+
+    @staticmethod
+    def _tail(records, index) -> tuple:
+        """
+        _tail drops whatever was left half written at the end of either file, and seeks both to the end.
+
+        :return: tuple of (number of traces, number of the next record, time of the last trace)
+        """
+        length = os.fstat(index.fileno()).st_size - len(MAGIC)
+        count = length // ENTRY.size
+        first, last = 0, 0
+        if count:
+            index.seek(len(MAGIC) + (count - 1) * ENTRY.size)
+            last, offset, n, _ = ENTRY.unpack(index.read(ENTRY.size))
+            first = offset + n
+        index.truncate(len(MAGIC) + count * ENTRY.size)
+        index.seek(0, os.SEEK_END)
+        records.truncate(len(MAGIC) + first * RECORD.size)
+        records.seek(0, os.SEEK_END)
+        return count, first, last
+
+    @staticmethod
+    def _post(name: str, positions: list, count: int) -> None:
+        """
+        _post appends positions in the index to a postings file. Whatever was left behind by a write cut off before
+        its traces made it to the index is dropped first: half written postings, and postings for positions from count
+        on, which are about to be taken by other traces. Caller must hold the lock on the index.
+
+        :param name: postings file, created if it does not exist
+        :param positions: positions in the index to append, in order
+        :param count: number of traces in the index
+        """
+        with open(name, "r+b" if os.path.exists(name) else "w+b") as f:
+            length = os.fstat(f.fileno()).st_size - len(MAGIC)
+            if length < 0:
+                f.truncate(0)
+                f.write(MAGIC)
+                length = 0
+            n = length // POSTING.size
+            while n:
+                f.seek(len(MAGIC) + (n - 1) * POSTING.size)
+                if POSTING.unpack(f.read(POSTING.size))[0] < count:
+                    break
+                n -= 1
+            f.truncate(len(MAGIC) + n * POSTING.size)
+            f.seek(0, os.SEEK_END)
+            f.write(b"".join(POSTING.pack(i) for i in positions))
+
+    def _postings(self, name: str, lo: int, hi: int, last: int = None) -> list:
+        """
+        _postings reads the positions in the index from lo up to hi out of a postings file. A write cut off before
+        its traces made it to the index may have left postings for positions since taken by other traces, so every
+        one has to be checked against the trace it points to.
+
+        :param name: postings file
+        :param lo: first position in the index
+        :param hi: position in the index to stop at
+        :param last: only this many positions, the last ones, if not None
+        :return: list of positions in the index, in order
+        """
+        # Read under the same lock as mapping the index, as a write may drop the tail of a postings file
+        with open(self.index_file, "rb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                postings = _mapped(name, POSTING.size)
+            except FileNotFoundError:
+                return []
+            try:
+                if not postings.count:
+                    return []
+                positions = _column(postings, 0, POSTING)
+                start = bisect.bisect_left(positions, lo)
+                end = bisect.bisect_left(positions, hi, start)
+                if last is not None:
+                    start = max(start, end - last)
+                return [positions[i] for i in range(start, end)]
+            finally:
+                postings.close()
+
+    def _is_to(self, i: int, target: bytes) -> bool:
+        # Whether the trace at position i of the index is to target
+        return ENTRY.unpack_from(self._index.mm, self._index.offset(i))[3] == target
+
+    def _is_through(self, i: int, hop: bytes) -> bool:
+        # Whether the trace at position i of the index has hop on any of its paths
+        _, first, count, _ = ENTRY.unpack_from(self._index.mm, self._index.offset(i))
+        if not count or first + count > self._records.count:
+            return False
+        return (
+            next(self._records.find(hop, _RESPONDER, first, first + count), None)
+            is not None
+        )
+
+    @staticmethod
+    def _pack(event) -> bytes:
+        return RECORD.pack(
+            socket.inet_aton(event.responder),
+            math.nan if event.rtt is None else event.rtt,
+            event.path,
+            event.ttl,
+            _FINAL if event.final else 0,
+            -1 if event.type is None else event.type,
+            -1 if event.code is None else event.code,
+        )
+
+    def _read(self, i: int) -> history_trace:
+        """
+        _read rebuilds the trace at position i of the index, padded out as it was when traced.
+
+        :param i: position in the index
+        :return: history_trace
+        """
+        when, first, count, target = ENTRY.unpack_from(
+            self._index.mm, self._index.offset(i)
+        )
+        daddr = socket.inet_ntoa(target)
+        events = list()
+        if count:
+            start = self._records.offset(first)
+            for responder, rtt, path, ttl, flags, type, code in RECORD.iter_unpack(
+                self._records.mm[start : start + count * RECORD.size]
+            ):
+                events.append(
+                    traceflow.hop_event(
+                        daddr,
+                        path,
+                        ttl,
+                        socket.inet_ntoa(responder),
+                        None if math.isnan(rtt) else round(rtt, 6),
+                        None if type < 0 else type,
+                        None if code < 0 else code,
+                        bool(flags & _FINAL),
+                    )
+                )
+        rtts = dict()
+        traces = traceflow.collect_traces(events, [daddr], rtts)[daddr]
+        return history_trace(when, daddr, traces, rtts.get(daddr, dict()))
+
+    def _window(self, since: int = None, until: int = None) -> tuple:
+        # Positions in the index of the first trace at or after since, and the first one after until
+        times = _column(self._index, 0)
+        lo = 0 if since is None else bisect.bisect_left(times, since)
+        hi = len(times) if until is None else bisect.bisect_right(times, until)
+        return lo, max(lo, hi)
+
+    def latest(self, target: str):
+        """
+        latest returns the most recent trace to a target.
+
+        :param target: destination address, dotted quad
+        :return: history_trace, or None if the target was never traced
+        """
+        self._map()
+        if not self._index.count:
+            return None
+        needle = socket.inet_aton(target)
+        name = os.path.join(self.targets_dir, socket.inet_ntoa(needle))
+        # Only the last posting is read, and the one before it for as long as they turn out not to be to target
+        hi = self._index.count
+        while True:
+            positions = self._postings(name, 0, hi, 1)
+            if not positions:
+                return None
+            hi = positions[-1]
+            if self._is_to(hi, needle):
+                return self._read(hi)
+
+    def traces(
+        self,
+        target: str = None,
+        since: int = None,
+        until: int = None,
+        through: str = None,
+    ):
+        """
+        traces yields every stored trace matching all of the given conditions, oldest first.
+
+        :param target: only traces to this destination address, dotted quad
+        :param since: only traces started at or after this time, in ns since the epoch
+        :param until: only traces started at or before this time, in ns since the epoch
+        :param through: only traces with this hop, dotted quad, on any of their paths
+        :return: generator of history_trace
+        """
+        self._map()
+        if not self._index.count:
+            return
+        lo, hi = self._window(since, until)
+        if lo == hi:
+            return
+        if target is None and through is None:
+            for i in range(lo, hi):
+                yield self._read(i)
+            return
+        target = None if target is None else socket.inet_aton(target)
+        through = None if through is None else socket.inet_aton(through)
+        # Whichever postings are given, those through a hop if both are, checked against the other condition
+        if through is None:
+            name = os.path.join(self.targets_dir, socket.inet_ntoa(target))
+        else:
+            name = os.path.join(self.hops_dir, socket.inet_ntoa(through))
+        for i in self._postings(name, lo, hi):
+            if target is not None and not self._is_to(i, target):
+                continue
+            if through is not None and not self._is_through(i, through):
+                continue
+            yield self._read(i)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+""" Compact traces: a dense paths x TTLs array of IPv4 addresses, with dict style views onto it """
+
+import array
+import collections.abc
+import socket
+
+# Sentinels, none of which can be the source of a reply: 0.0.0.0 and addresses in 240.0.0.0/4
+UNSET = 0
+MISSING = 0xFFFFFFFF
+PADDING = 0xFFFFFFFE
+# 32 bits wide, wherever the C int is big enough
+_TYPECODE = "I" if array.array("I").itemsize >= 4 else "L"
+_NAMES = {MISSING: "*", PADDING: "x"}
+_VALUES = {"*": MISSING, "x": PADDING}
+
+
+def _pack(hop: str) -> int:
+    if hop in _VALUES:
+        return _VALUES[hop]
+    return int.from_bytes(socket.inet_aton(hop), "big")
+
+
+def _unpack(value: int) -> str:
+    if value in _NAMES:
+        return _NAMES[value]
+    return socket.inet_ntoa(value.to_bytes(4, "big"))
+
+
+class _row(collections.abc.Mapping):
+    # traces[path] of a trace_matrix: TTL -> hop, for every TTL which has been set
+    __slots__ = ("matrix", "start")
+
+    def __init__(self, matrix, start: int):
+        self.matrix = matrix
+        self.start = start
+
+    def __getitem__(self, ttl: int) -> str:
+        if not 0 < ttl <= self.matrix.width:
+            raise KeyError(ttl)
+        value = self.matrix.cells[self.start + ttl - 1]
+        if value == UNSET:
+            raise KeyError(ttl)
+        return _unpack(value)
+
+    def __iter__(self):
+        cells = self.matrix.cells
+        for ttl in range(1, self.matrix.width + 1):
+            if cells[self.start + ttl - 1] != UNSET:
+                yield ttl
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class trace_matrix(collections.abc.Mapping):
+    """
+    trace_matrix holds the traces to one target as a dense paths x TTLs array of IPv4 addresses packed into 32 bit
+    integers, with reserved values for hops which were not set yet, did not answer (*), or are past the end of the
+    path (x). That is 4 bytes a hop, rather than a dict entry and a string. It reads like the traces[path][ttl] dict
+    used everywhere else, so it can be handed to traceflow.printer and traceflow.helpers as it is, and to_dict()
+    gives the dict back.
+    """
+
+    def __init__(self, paths=(), max_ttl: int = 0):
+        """
+        :param paths: path IDs to start out with rows for
+        :param max_ttl: TTLs to start out with room for in each row
+        """
+        # Rows are stride cells apart, of which the first width are in use. Both grow as needed.
+        self.stride = max(max_ttl, 1)
+        self.width = 0
+        self.rows = dict()
+        self.cells = array.array(_TYPECODE)
+        for path in paths:
+            self._add_row(path)
+
+    @classmethod
+    def from_dict(cls, traces: dict):
+        """
+        from_dict packs a traces[path][ttl] dict.
+
+        :param traces: dict of paths and traces
+        :return: trace_matrix
+        """
+        max_ttl = max([max(hops) for hops in traces.values() if hops], default=0)
+        matrix = cls(traces, max_ttl)
+        for path, hops in traces.items():
+            for ttl, hop in hops.items():
+                matrix.set(path, ttl, hop)
+        return matrix
+
+    def to_dict(self) -> dict:
+        """
+        to_dict unpacks the matrix into a traces[path][ttl] dict.
+
+        :return: dict of paths and traces
+        """
+        return {path: dict(self[path]) for path in self.rows}
+
+    @property
+    def nbytes(self) -> int:
+        return self.cells.itemsize * len(self.cells)
+
+    def _add_row(self, path: int) -> int:
+        self.rows[path] = len(self.cells)
+        self.cells.extend([UNSET] * self.stride)
+        return self.rows[path]
+
+    def _grow(self, ttl: int) -> None:
+        # Re-lays the rows out at least twice as far apart, so growing one TTL at a time stays linear
+        stride = max(ttl, 2 * self.stride)
+        cells = array.array(_TYPECODE, [UNSET]) * (stride * len(self.rows))
+        for i, start in enumerate(self.rows.values()):
+            cells[i * stride : i * stride + self.width] = self.cells[
+                start : start + self.width
+            ]
+        self.rows = {path: i * stride for i, path in enumerate(self.rows)}
+        self.cells = cells
+        self.stride = stride
+
+    def _cell(self, path: int, ttl: int) -> int:
+        # Index of the cell for (path, ttl), making room for it if need be
+        if ttl > self.stride:
+            self._grow(ttl)
+        start = self.rows.get(path)
+        if start is None:
+            start = self._add_row(path)
+        self.width = max(self.width, ttl)
+        return start + ttl - 1
+
+    def set(self, path: int, ttl: int, hop: str) -> None:
+        """
+        set sets the hop of path at ttl, whether it was set before or not.
+
+        :param path: path ID
+        :param ttl: TTL, from 1
+        :param hop: address of the hop, dotted quad, or * or x
+        """
+        # Made room for first, as that may swap the array out
+        i = self._cell(path, ttl)
+        self.cells[i] = _pack(hop)
+
+    def setdefault(self, path: int, ttl: int, hop: str) -> None:
+        """
+        setdefault sets the hop of path at ttl, unless it was set already.
+
+        :param path: path ID
+        :param ttl: TTL, from 1
+        :param hop: address of the hop, dotted quad, or * or x
+        """
+        i = self._cell(path, ttl)
+        if self.cells[i] == UNSET:
+            self.cells[i] = _pack(hop)
+
+    def pad(self, daddr: str):
+        """
+        pad does what helpers.pad_traces does to a dict, in one pass over the array: replies from daddr past the
+        first one on each path are trimmed, hops which did not answer are filled in with a *, and shorter paths are
+        padded out with an x up to the longest one.
+
+        :param daddr: A string, destination IP address
+        :return: the same trace_matrix
+        """
+        target = _pack(daddr)
+        cells = self.cells
+        lasts = dict()
+        for path, start in self.rows.items():
+            seen = False
+            last = 0
+            for i in range(start, start + self.width):
+                value = cells[i]
+                if value == target:
+                    if seen:
+                        cells[i] = UNSET
+                        continue
+                    seen = True
+                if value != UNSET:
+                    last = i - start + 1
+            lasts[path] = last
+        # Only as wide as the longest path, once trimmed
+        self.width = max(lasts.values(), default=0)
+        for path, start in self.rows.items():
+            last = lasts[path]
+            for i in range(start, start + self.width):
+                if cells[i] == UNSET:
+                    cells[i] = MISSING if i - start < last else PADDING
+        return self
+
+    def __getitem__(self, path: int) -> _row:
+        return _row(self, self.rows[path])
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __repr__(self) -> str:
+        return f"trace_matrix({self.to_dict()})"
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+""" In-process metrics: counters, gauges and histograms, exposed in the Prometheus text format """
+
+import bisect
+import http.server
+import logging
+import os
+import threading
+
+import traceflow.helpers as helpers
+
+# Latency buckets (in seconds), from a fast loopback RTT or packet decode up to a slow trace
+BUCKETS = (
+    0.00001,
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _labels(labels: dict, extra: str = "") -> str:
+    # {name="value",...} as the exposition format has it, or nothing if there are no labels
+    pairs = [
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels.items()
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class counter:
+    """
+    counter only ever goes up. No lock is taken, so an increment costs no more than an attribute update, at the price
+    of the odd increment being lost should two threads update the same counter at the very same moment.
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: dict = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or dict()
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def samples(self) -> list:
+        return [(self.name, _labels(self.labels), self.value)]
+
+
+class gauge(counter):
+    """
+    gauge holds a value which may go up or down, such as when something last happened.
+    """
+
+    type = "gauge"
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class histogram:
+    """
+    histogram counts observations into buckets, as well as their number and sum. Buckets are counted on their own
+    and only made cumulative when exposed, so an observation is a bisect and two additions.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=BUCKETS, labels: dict = None):
+        """
+        :param name: metric name
+        :param help: description of the metric
+        :param buckets: upper bounds of the buckets, in increasing order. +Inf is added.
+        :param labels: dict of label name -> value, the same for every sample
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels or dict()
+        # One more, for everything above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> list:
+        samples = list()
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            le = 'le="%s"' % _value(bound)
+            samples.append((self.name + "_bucket", _labels(self.labels, le), total))
+        samples.append((self.name + "_sum", _labels(self.labels), self.sum))
+        samples.append((self.name + "_count", _labels(self.labels), self.count))
+        return samples
+
+
+class registry:
+    """
+    registry holds every metric of a process, and writes them out in the Prometheus text format. Metrics with the
+    same name but different labels make up one family.
+    """
+
+    def __init__(self):
+        self.metrics = list()
+        self.mutex = threading.Lock()
+
+    def register(self, metric):
+        """
+        register adds a metric to the registry.
+
+        :param metric: counter, gauge or histogram
+        :return: the same metric
+        """
+        with self.mutex:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: dict = None) -> counter:
+        return self.register(counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: dict = None) -> gauge:
+        return self.register(gauge(name, help, labels))
+
+    def histogram(
+        self, name: str, help: str, buckets=BUCKETS, labels: dict = None
+    ) -> histogram:
+        return self.register(histogram(name, help, buckets, labels))
+
+    def exposition(self) -> str:
+        """
+        exposition writes out every metric in the Prometheus text format (version 0.0.4).
+
+        :return: str
+        """
+        families = dict()
+        with self.mutex:
+            for metric in self.metrics:
+                families.setdefault(metric.name, list()).append(metric)
+        lines = list()
+        for name, metrics in families.items():
+            lines.append(f"# HELP {name} {metrics[0].help}")
+            lines.append(f"# TYPE {name} {metrics[0].type}")
+            for metric in metrics:
+                for sample, labels, value in metric.samples():
+                    lines.append(f"{sample}{labels} {_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """
+        write_textfile writes every metric to a file, for the node_exporter textfile collector to pick up. The file
+        is replaced in one go, so it is never read half written.
+
+        :param path: file to write, should end in .prom
+        """
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.exposition())
+        os.replace(tmp, path)
+
+
+# The registry of this process, and every metric traceflow keeps in it
+REGISTRY = registry()
+PROBES_SENT = REGISTRY.counter("traceflow_probes_sent_total", "Probes put on the wire")
+PROBES_RETRANSMITTED = REGISTRY.counter(
+    "traceflow_probes_retransmitted_total", "Probes sent again after getting no reply"
+)
+PROBES_TIMED_OUT = REGISTRY.counter(
+    "traceflow_probes_timed_out_total", "Probes given up on after every retry"
+)
+REPLIES_MATCHED = REGISTRY.counter(
+    "traceflow_replies_matched_total", "ICMP replies matched up to one of our probes"
+)
+REPLIES_DUPLICATE = REGISTRY.counter(
+    "traceflow_replies_duplicate_total",
+    "ICMP replies to a probe which was answered already",
+)
+REPLIES_FOREIGN = REGISTRY.counter(
+    "traceflow_replies_foreign_total",
+    "ICMP packets received which were not for any of our probes",
+)
+REPLIES_EVICTED = REGISTRY.counter(
+    "traceflow_replies_evicted_total",
+    "Replies dropped by the listener to stay within its capacity or max age",
+)
+RTT = REGISTRY.histogram(
+    "traceflow_rtt_seconds", "Round trip time of the probes which were answered"
+)
+PHASE_SEND = REGISTRY.histogram(
+    "traceflow_phase_seconds",
+    "Time taken by each phase: sending a batch of probes, decoding a reply, tracing a batch of targets",
+    labels={"phase": "send"},
+)
+PHASE_DECODE = REGISTRY.histogram(
+    "traceflow_phase_seconds", "", labels={"phase": "decode"}
+)
+PHASE_TRACE = REGISTRY.histogram(
+    "traceflow_phase_seconds", "", labels={"phase": "trace"}
+)
+LAST_TRACE = REGISTRY.gauge(
+    "traceflow_last_trace_timestamp_seconds",
+    "When the last batch of targets finished tracing, in seconds since the epoch",
+)
+
+
+class _metrics_handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            body = b"404: not found"
+            self.send_response(404)
+            self.send_header("Content-Type", "text/plain")
+        else:
+            body = self.server.registry.exposition().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class metrics_server:
+    """
+    metrics_server serves a registry at /metrics for Prometheus to scrape, from a background thread.
+    """
+
+    def __init__(self, bind_ip: str = "127.0.0.1", port: int = 9469, registry=None):
+        """
+        :param bind_ip: IP address to bind to
+        :param port: TCP port to listen on
+        :param registry: registry to serve, defaults to the one traceflow keeps its metrics in
+        """
+        self.httpd = helpers.threaded_server((bind_ip, port), _metrics_handler)
+        self.httpd.registry = registry or REGISTRY
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self) -> None:
+        """
+        start serves requests on a background thread.
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        """
+        close stops serving.
+        """
+        if self.thread is not None:
+            self.httpd.shutdown()
+        self.httpd.server_close()
@@ -123,9 +123,7 @@ class packet_encode:
         self.data = str(int(time.time())).encode()
         # UDP is a bit stupid, and takes a lower layer info as part of it's checksum. Specifically src/dst IP addr.
         # This is called the pseudo header
-        pseudo_header = struct.pack(
-            "!BBH", 0, socket.getprotobyname("udp"), len(self.data) + 8
-        )
+        pseudo_header = struct.pack("!BBH", 0, socket.IPPROTO_UDP, len(self.data) + 8)
         pseudo_header = self.ip_saddr + self.ip_daddr + pseudo_header
         # Set the checksum to 0, so we can generate a header, then calculate the checksum and re-apply
         checksum = 0
@@ -148,25 +146,377 @@ class packet_encode:
         :return: checksum: an int representing the checksum of the bytes/header.
         """
         # https://github.com/houluy/UDP/blob/master/udp.py#L120
-        checksum = 0
         data_len = len(data)
         if data_len % 2:
             data_len += 1
             data += struct.pack("!B", 0)
 
-        for i in range(0, data_len, 2):
-            w = (data[i] << 8) + (data[i + 1])
-            checksum += w
+        # Sum up every 16 bit word in one go, rather than walking the bytes
+        checksum = sum(struct.unpack("!%dH" % (data_len // 2), data))
 
+        checksum = (checksum >> 16) + (checksum & 0xFFFF)
         checksum = (checksum >> 16) + (checksum & 0xFFFF)
         checksum = ~checksum & 0xFFFF
         return checksum
 
 
+class probe_template:
+    """
+    probe_template pre-packs an IPv4 + UDP probe for a single flow, so that each probe only needs the TTL, IP.ID and
+    source port patched in place. Checksums are updated incrementally (RFC 1624) rather than recomputed.
+    """
+
+    # Offsets of the fields we patch, from the start of the IPv4 header
+    IP_ID = 4
+    IP_TTL = 8
+    IP_CHECK = 10
+    UDP_SRC_PORT = 20
+    UDP_CHECK = 26
+
+    def __init__(self, ip_daddr, udp_src_port, udp_dst_port, ip_saddr=None, **kwargs):
+        """
+        :param ip_daddr: destination address or hostname, resolved once here
+        :param udp_src_port: the source port to start with
+        :param udp_dst_port: the destination port, fixed for the flow
+        :param ip_saddr: source address, looked up from the routing table if not set
+        :param kwargs: ip_tos and ip_frag_off may be overridden. fixed_checksum=True adds a 2 byte pad word to the
+        payload, so build() can be asked for a given UDP checksum.
+        """
+        self.ip_daddr = socket.gethostbyname(ip_daddr)
+        if ip_saddr is None:
+            ip_saddr = traceflow.socket_handler.get_egress_ip(self.ip_daddr)
+        self.ip_saddr = ip_saddr
+        self.udp_dst_port = udp_dst_port
+        ip_tos = kwargs.get("ip_tos") if kwargs.get("ip_tos") else 0
+        ip_frag_off = kwargs.get("ip_frag_off") if kwargs.get("ip_frag_off") else 0
+        # put the current timestamp into the UDP payload, as packet_encode does.
+        self.data = str(int(time.time())).encode()
+        self.fixed_checksum = bool(kwargs.get("fixed_checksum"))
+        if self.fixed_checksum:
+            self.data += b"\x00\x00"
+
+        saddr = socket.inet_aton(self.ip_saddr)
+        daddr = socket.inet_aton(self.ip_daddr)
+        udp_len = len(self.data) + 8
+        # TTL and IP.ID start at 0, they are patched in for every probe.
+        ip_header = struct.pack(
+            "!BBHHHBBH4s4s",
+            (4 << 4) + 5,
+            ip_tos,
+            20 + udp_len,
+            0,
+            ip_frag_off,
+            0,
+            socket.IPPROTO_UDP,
+            0,
+            saddr,
+            daddr,
+        )
+        pseudo_header = struct.pack("!BBH", 0, socket.IPPROTO_UDP, udp_len)
+        pseudo_header = saddr + daddr + pseudo_header
+        udp_header = struct.pack("!4H", udp_src_port, udp_dst_port, udp_len, 0)
+        udp_check = packet_encode._checksum_func(pseudo_header + udp_header + self.data)
+        if udp_check == 0:
+            udp_check = 0xFFFF
+
+        self.packet = bytearray(ip_header + udp_header + self.data)
+        self._put(self.IP_CHECK, packet_encode._checksum_func(ip_header))
+        self._put(self.UDP_CHECK, udp_check)
+        self.ttl = 0
+        self.ip_id = 0
+        self.udp_src_port = udp_src_port
+        # The pad word, if any, is the last 16 bits of the payload
+        self._pad = len(self.packet) - 2
+
+    def _get(self, offset: int) -> int:
+        return (self.packet[offset] << 8) + self.packet[offset + 1]
+
+    def _put(self, offset: int, value: int) -> None:
+        self.packet[offset] = value >> 8
+        self.packet[offset + 1] = value & 0xFF
+
+    @staticmethod
+    def _checksum_update(checksum: int, old: int, new: int) -> int:
+        """
+        _checksum_update applies a change of a single 16 bit word to an existing checksum, as per RFC 1624 eqn. 3:
+        HC' = ~(~HC + ~m + m')
+
+        :param checksum: the current checksum
+        :param old: the old value of the 16 bit word which changed
+        :param new: the new value of that word
+        :return: int: the updated checksum
+        """
+        checksum = (~checksum & 0xFFFF) + (~old & 0xFFFF) + new
+        checksum = (checksum >> 16) + (checksum & 0xFFFF)
+        checksum = (checksum >> 16) + (checksum & 0xFFFF)
+        return ~checksum & 0xFFFF
+
+    def _patch(self, offset: int, value: int, check_offset: int) -> None:
+        old = self._get(offset)
+        if old == value:
+            return
+        self._put(offset, value)
+        checksum = self._checksum_update(self._get(check_offset), old, value)
+        if check_offset == self.UDP_CHECK and checksum == 0:
+            # A UDP checksum of 0 means "no checksum", so it is sent as all ones instead (RFC 768)
+            checksum = 0xFFFF
+        self._put(check_offset, checksum)
+
+    def _force_checksum(self, checksum: int) -> None:
+        """
+        _force_checksum rewrites the pad word so that the UDP checksum comes out as the value given.
+        If S is the sum of everything but the pad word P, then P' = ~C - S = ~C + HC + P in 1s compliment.
+
+        :param checksum: the UDP checksum wanted, must not be 0
+        """
+        pad = (~checksum & 0xFFFF) + self._get(self.UDP_CHECK) + self._get(self._pad)
+        pad = (pad >> 16) + (pad & 0xFFFF)
+        pad = (pad >> 16) + (pad & 0xFFFF)
+        self._put(self._pad, pad)
+        self._put(self.UDP_CHECK, checksum)
+
+    def build(
+        self, ttl: int, ip_id: int, udp_src_port: int = None, udp_checksum: int = None
+    ) -> bytes:
+        """
+        build patches TTL, IP.ID and (optionally) the source port into the template and returns the finished probe.
+
+        :param ttl: the TTL of the probe
+        :param ip_id: the IP.ID of the probe
+        :param udp_src_port: the source port of the probe, if it differs from the last one built
+        :param udp_checksum: the UDP checksum the probe should carry, needs fixed_checksum=True
+        :return: bytes: IPv4 header + UDP header + payload, ready for socket_handler
+        """
+        # TTL shares its 16 bit word with the protocol field
+        self._patch(self.IP_TTL, (ttl << 8) + socket.IPPROTO_UDP, self.IP_CHECK)
+        self._patch(self.IP_ID, ip_id, self.IP_CHECK)
+        if udp_src_port is not None:
+            self._patch(self.UDP_SRC_PORT, udp_src_port, self.UDP_CHECK)
+            self.udp_src_port = udp_src_port
+        if udp_checksum is not None:
+            if not self.fixed_checksum:
+                raise ValueError(
+                    "udp_checksum needs a template with fixed_checksum=True"
+                )
+            self._force_checksum(udp_checksum)
+        self.ttl = ttl
+        self.ip_id = ip_id
+        return bytes(self.packet)
+
+
+# Precompiled, so decoding a packet does not have to parse a format string each time
+_IPV4_HEADER = struct.Struct("!BBHHHBBHII")
+_ICMP_HEADER = struct.Struct("!BBHH")
+_UDP_HEADER = struct.Struct("!4H")
+_ADDR = struct.Struct("!I")
+
+
+def int_to_ip(addr: int) -> str:
+    """
+    int_to_ip turns an IPv4 address kept as an int back into a dotted quad.
+
+    :param addr: the address as an int, in host order
+    :return: str
+    """
+    return socket.inet_ntoa(_ADDR.pack(addr))
+
+
+def ip_to_int(addr: str) -> int:
+    """
+    ip_to_int turns a dotted quad into an int, to compare with the addresses in decoded records.
+
+    :param addr: the address as a dotted quad
+    :return: int
+    """
+    return _ADDR.unpack(socket.inet_aton(addr))[0]
+
+
+class ipv4_record:
+    """
+    ipv4_record holds a decoded IPv4 header. Addresses are kept as ints, ip_saddr and ip_daddr give them as text.
+    """
+
+    __slots__ = (
+        "ip_ver",
+        "ip_ihl",
+        "ip_tos",
+        "ip_tot_len",
+        "ip_id",
+        "ip_frag_off",
+        "ttl",
+        "l4_proto",
+        "ip_check",
+        "saddr",
+        "daddr",
+        "payload_offset",
+    )
+
+    @property
+    def ip_saddr(self) -> str:
+        return int_to_ip(self.saddr)
+
+    @property
+    def ip_daddr(self) -> str:
+        return int_to_ip(self.daddr)
+
+
+class icmp_record:
+    """
+    icmp_record holds a decoded ICMP header.
+    """
+
+    __slots__ = ("type", "code", "checksum", "unused", "payload_offset")
+
+
+class udp_record:
+    """
+    udp_record holds a decoded UDP header.
+    """
+
+    __slots__ = ("src_port", "dst_port", "length", "checksum", "payload_offset")
+
+
+class icmp_reply:
+    """
+    icmp_reply holds what matters in an ICMP error quoting one of our probes: who sent it, what it says, and the
+    identifying fields of the probe it quotes. Addresses are kept as ints, ip_saddr and ip_daddr give them as text.
+    rx_time is when the message was received, in nanoseconds since the epoch, or 0 if not known.
+    """
+
+    __slots__ = (
+        "saddr",
+        "type",
+        "code",
+        "daddr",
+        "ip_id",
+        "src_port",
+        "dst_port",
+        "udp_checksum",
+        "rx_time",
+    )
+
+    def __init__(
+        self,
+        saddr: int = 0,
+        type: int = 0,
+        code: int = 0,
+        daddr: int = 0,
+        ip_id: int = 0,
+        src_port: int = 0,
+        dst_port: int = 0,
+        udp_checksum: int = 0,
+        rx_time: int = 0,
+    ):
+        self.saddr = saddr
+        self.type = type
+        self.code = code
+        self.daddr = daddr
+        self.ip_id = ip_id
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.udp_checksum = udp_checksum
+        self.rx_time = rx_time
+
+    def __repr__(self) -> str:
+        return (
+            f"icmp_reply({self.ip_saddr} type {self.type} code {self.code}, quoting "
+            f"{self.ip_daddr} ip_id {self.ip_id} src_port {self.src_port})"
+        )
+
+    @property
+    def ip_saddr(self) -> str:
+        return int_to_ip(self.saddr)
+
+    @property
+    def ip_daddr(self) -> str:
+        return int_to_ip(self.daddr)
+
+
 class packet_decode:
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
+    @staticmethod
+    def unpack_ipv4_header(buf, offset: int = 0) -> ipv4_record:
+        """
+        unpack_ipv4_header decodes the IPv4 header at offset in buf, without copying anything.
+
+        :param buf: bytes, bytearray or memoryview
+        :param offset: where the header starts in buf
+        :return: ipv4_record, with payload_offset pointing past the header (and any options) in buf
+        """
+        r = ipv4_record()
+        (
+            ihl_ver,
+            r.ip_tos,
+            r.ip_tot_len,
+            r.ip_id,
+            r.ip_frag_off,
+            r.ttl,
+            r.l4_proto,
+            r.ip_check,
+            r.saddr,
+            r.daddr,
+        ) = _IPV4_HEADER.unpack_from(buf, offset)
+        r.ip_ver = ihl_ver >> 4
+        r.ip_ihl = ihl_ver & 0x0F
+        r.payload_offset = offset + r.ip_ihl * 4
+        return r
+
+    @staticmethod
+    def unpack_icmp(buf, offset: int = 0) -> icmp_record:
+        """
+        unpack_icmp decodes the ICMP header at offset in buf, without copying anything.
+
+        :param buf: bytes, bytearray or memoryview
+        :param offset: where the header starts in buf
+        :return: icmp_record, with payload_offset pointing at the quoted packet in buf
+        """
+        r = icmp_record()
+        r.type, r.code, r.checksum, r.unused = _ICMP_HEADER.unpack_from(buf, offset)
+        r.payload_offset = offset + 8
+        return r
+
+    @staticmethod
+    def unpack_udp(buf, offset: int = 0) -> udp_record:
+        """
+        unpack_udp decodes the UDP header at offset in buf, without copying anything.
+
+        :param buf: bytes, bytearray or memoryview
+        :param offset: where the header starts in buf
+        :return: udp_record, with length being the length of the data only
+        """
+        r = udp_record()
+        r.src_port, r.dst_port, length, r.checksum = _UDP_HEADER.unpack_from(
+            buf, offset
+        )
+        r.length = length - 8
+        r.payload_offset = offset + 8
+        return r
+
+    @staticmethod
+    def unpack_icmp_reply(buf) -> icmp_reply:
+        """
+        unpack_icmp_reply decodes an ICMP message as read from a raw socket (outer IPv4 header, ICMP header, and the
+        quoted IPv4 and UDP headers of the probe) in one go, without copying anything.
+
+        :param buf: bytes, bytearray or memoryview
+        :return: icmp_reply
+        :raises struct.error: if buf is too short to hold all of it
+        """
+        r = icmp_reply()
+        outer = _IPV4_HEADER.unpack_from(buf, 0)
+        r.saddr = outer[8]
+        offset = (outer[0] & 0x0F) * 4
+        r.type, r.code, _, _ = _ICMP_HEADER.unpack_from(buf, offset)
+        offset += 8
+        inner = _IPV4_HEADER.unpack_from(buf, offset)
+        r.ip_id = inner[3]
+        r.daddr = inner[9]
+        offset += (inner[0] & 0x0F) * 4
+        r.src_port, r.dst_port, _, r.udp_checksum = _UDP_HEADER.unpack_from(buf, offset)
+        return r
+
     @staticmethod
     def decode_ipv4_header(header: bytes) -> dict:
         """
@@ -192,40 +542,21 @@ class packet_decode:
         :return: ret: a dict containing the fields in the IPv4 header
         """
 
-        # Decode the first 20 bytes, rest will most likely be payload (We'll re-base with ip_ihl later on)
         logging.debug("Decoding IPv4 Header")
-        ip_header = header[0:20]
-        (
-            ip_ihl_ver,
-            ip_tos,
-            ip_tot_len,
-            ip_id,
-            ip_frag_off,
-            ttl,
-            l4_proto,
-            ip_check,
-            ip_saddr,
-            ip_daddr,
-        ) = struct.unpack("!BBHHHBBH4s4s", ip_header)
-        # since we cannot read nibbles easy, we need to take the first byte and take the high/low nibble out
-        ip_ver = ip_ihl_ver >> 4
-        ip_ihl = ip_ihl_ver & 0x0F  # 0x0F == 15
-        # Internet Header Length is the length of the internet header in 32bit words, and thus points to the beginning of the data.
-        # Note that the minimum value for a correct header is 5. We are re-basing this here to ensure we read the correct offset for payload
-        ip_payload_offset = int((ip_ihl * 32) / 8)
+        r = packet_decode.unpack_ipv4_header(header)
         ret = {
-            "ip_ihl": ip_ihl,
-            "ip_ver": ip_ver,
-            "ip_tos": ip_tos,
-            "ip_tot_len": ip_tot_len,
-            "ip_id": ip_id,
-            "ip_frag_off": ip_frag_off,
-            "ttl": ttl,
-            "l4_proto": l4_proto,
-            "ip_check": ip_check,
-            "ip_saddr": socket.inet_ntoa(ip_saddr),
-            "ip_daddr": socket.inet_ntoa(ip_daddr),
-            "payload": header[ip_payload_offset:],
+            "ip_ihl": r.ip_ihl,
+            "ip_ver": r.ip_ver,
+            "ip_tos": r.ip_tos,
+            "ip_tot_len": r.ip_tot_len,
+            "ip_id": r.ip_id,
+            "ip_frag_off": r.ip_frag_off,
+            "ttl": r.ttl,
+            "l4_proto": r.l4_proto,
+            "ip_check": r.ip_check,
+            "ip_saddr": r.ip_saddr,
+            "ip_daddr": r.ip_daddr,
+            "payload": header[r.payload_offset :],
         }
         return ret
 
@@ -252,17 +583,13 @@ class packet_decode:
         """
 
         logging.debug("Decoding UDP Header")
-        udp_src_port, udp_dst_port, len_data, checksum = struct.unpack(
-            "!4H", header[:8]
-        )
-        # UDP strikes again.
-        len_data = len_data - 8
-        data = header[8:]
+        r = packet_decode.unpack_udp(header)
         ret = {
-            "src_port": udp_src_port,
-            "dst_port": udp_dst_port,
-            "length": len_data,
-            "payload": data,
+            "src_port": r.src_port,
+            "dst_port": r.dst_port,
+            "length": r.length,
+            "checksum": r.checksum,
+            "payload": header[r.payload_offset :],
         }
         return ret
 
@@ -285,14 +612,12 @@ class packet_decode:
         """
 
         logging.debug("Decoding ICMP Header")
-        type, code, checksum, unused = struct.unpack("!BBHH", header[:6])
-        # Payload should start after 2 machine words, which is 2 * 4 * 8
-        payload = header[8:]
+        r = packet_decode.unpack_icmp(header)
         ret = {
-            "type": type,
-            "code": code,
-            "checksum": checksum,
-            "unused": unused,
-            "payload": payload,
+            "type": r.type,
+            "code": r.code,
+            "checksum": r.checksum,
+            "unused": r.unused,
+            "payload": header[r.payload_offset :],
         }
         return ret
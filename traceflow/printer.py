@@ -1,4 +1,10 @@
+import csv
+import io
 import json
+import shutil
+import sys
+import threading
+import time
 
 
 class printer:
@@ -6,93 +12,218 @@ class printer:
         pass
 
     @staticmethod
-    def print_vertical(traces):
+    def print_vertical(traces, rtts=None):
         """
         print_vertical prints the results in a vertical manner.
 
         :param traces: dict
+        :param rtts: dict of path -> ttl -> RTT in milliseconds, printed next to each hop if given
+        """
+        # The whole table goes out in one write, rather than one per cell
+        sys.stdout.write(printer.format_vertical(traces, rtts))
+        return None
+
+    @staticmethod
+    def format_vertical(traces, rtts=None) -> str:
+        """
+        format_vertical lays the results out in a vertical manner, as print_vertical prints them.
+
+        :param traces: dict
+        :param rtts: dict of path -> ttl -> RTT in milliseconds, shown next to each hop if given
+        :return: str, the table
         """
         max_ttl = max([max(traces[i].keys()) for i in traces.keys()])
-        row_format = "%-17s | "
-        # Print header
-        print(row_format % "TTL: ", end="")
-        _ = [print(row_format % i, end="") for i in range(1, max_ttl + 1)]
-        print("")
-        # Print Body
+        row_format = "%-17s | " if not rtts else "%-28s | "
+        # Header
+        rows = [
+            row_format % "TTL: "
+            + "".join(row_format % i for i in range(1, max_ttl + 1))
+        ]
+        # Body
         for path_id in sorted(traces.keys()):
-            print(row_format % f"Path ID {path_id} ", end="")
-            for hop in sorted(traces[path_id]):
-                print(row_format % traces[path_id][hop], end="")
-            print("")
-        return None
+            rows.append(
+                row_format % f"Path ID {path_id} "
+                + "".join(
+                    row_format % printer._hop(traces, rtts, path_id, hop)
+                    for hop in sorted(traces[path_id])
+                )
+            )
+        return "\n".join(rows) + "\n"
 
     @staticmethod
-    def print_horizontal(traces):
+    def print_horizontal(traces, rtts=None):
         """
         print_horizontal prints the results in a horizontal manner.
 
         :param traces: dict
+        :param rtts: dict of path -> ttl -> RTT in milliseconds, printed next to each hop if given
+        """
+        # The whole table goes out in one write, rather than one per cell
+        sys.stdout.write(printer.format_horizontal(traces, rtts))
+        return None
+
+    @staticmethod
+    def format_horizontal(traces, rtts=None) -> str:
+        """
+        format_horizontal lays the results out in a horizontal manner, as print_horizontal prints them.
+
+        :param traces: dict
+        :param rtts: dict of path -> ttl -> RTT in milliseconds, shown next to each hop if given
+        :return: str, the table
         """
         # Get the MAX TTL value from the results
         max_ttl = max([max(traces[i].keys()) for i in traces.keys()])
-        col_format = "%-17s | "
-        # Print header
-        # Spacer for the TTL column
-        print(col_format % "", end="")
-        for i in sorted(traces.keys()):
-            print(col_format % format("Path ID: {0} ".format(i)), end="")
-        print("")
-        # Print Body
+        col_format = "%-17s | " if not rtts else "%-28s | "
+        # Header, with a spacer for the TTL column
+        rows = [
+            col_format % ""
+            + "".join(
+                col_format % format("Path ID: {0} ".format(i))
+                for i in sorted(traces.keys())
+            )
+        ]
+        # Body
         for ttl in range(1, max_ttl + 1):
-            print(col_format % format("TTL: {0}".format(ttl)), end="")
-            for path_id in traces.keys():
-                print(col_format % traces[path_id][ttl], end="")
-            print("")
+            rows.append(
+                col_format % format("TTL: {0}".format(ttl))
+                + "".join(
+                    col_format % printer._hop(traces, rtts, path_id, ttl)
+                    for path_id in traces.keys()
+                )
+            )
+        return "\n".join(rows) + "\n"
+
+    @staticmethod
+    def _hop(traces, rtts, path_id, ttl) -> str:
+        # A hop, followed by its RTT if there is one
+        rtt = (rtts or dict()).get(path_id, dict()).get(ttl)
+        if rtt is None:
+            return traces[path_id][ttl]
+        return f"{traces[path_id][ttl]} ({rtt:.3f} ms)"
+
+    @staticmethod
+    def print_json(
+        traces,
+        target=None,
+        daddr=None,
+        diamonds=None,
+        rtts=None,
+        started=None,
+        groups=None,
+        src_port=33452,
+    ):
+        """
+        print_json prints the results as a single line JSON object, so it can be read by other tools.
+
+        :param traces: dict
+        :param target: the destination as it was given
+        :param daddr: the address the destination resolved to
+        :param diamonds: list of diamonds, as returned by helpers.find_diamonds, left out if None
+        :param rtts: dict of path -> ttl -> RTT in milliseconds, left out if None
+        :param started: when the trace was started, as a string, left out if None
+        :param groups: the paths grouped by fingerprint, as returned by helpers.group_paths, left out if None
+        :param src_port: UDP source port the trace was started with, path N uses src_port + N
+        """
+        # Plain dicts, whatever mapping traces is (a traceflow.trace_matrix, say)
+        traces = {path: dict(traces[path]) for path in traces}
+        result = {"target": target, "daddr": daddr, "traces": traces}
+        if started is not None:
+            result = {"time": started, **result}
+        if diamonds is not None:
+            result["diamonds"] = diamonds
+        if rtts is not None:
+            # Only the hops which answered, and whose probe was not retransmitted, have an RTT
+            result["rtts"] = rtts
+        if groups is not None:
+            # Which paths (and so source ports) found each unique path, keyed by the path ID it is kept under
+            result["groups"] = {
+                paths[0]: {
+                    "fingerprint": fingerprint,
+                    "paths": paths,
+                    "src_ports": [src_port + path for path in paths],
+                }
+                for fingerprint, paths in groups.items()
+            }
+        print(json.dumps(result))
+        return None
+
+    @staticmethod
+    def print_changes(target, daddr, added, removed):
+        """
+        print_changes prints the paths which appeared or disappeared since the last trace, as a single line JSON
+        object.
+
+        :param target: the destination as it was given
+        :param daddr: the address the destination resolved to
+        :param added: list of paths, each a list of hops in TTL order
+        :param removed: list of paths, each a list of hops in TTL order
+        """
+        change = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "target": target,
+            "daddr": daddr,
+            "added": added,
+            "removed": removed,
+        }
+        print(json.dumps(change), flush=True)
+        return None
+
+    @staticmethod
+    def print_groups(groups, src_port=33452):
+        """
+        print_groups prints which source ports found each unique path, one path per line.
+
+        :param groups: dict of fingerprint -> list of path IDs, as returned by helpers.group_paths
+        :param src_port: UDP source port the trace was started with, path N uses src_port + N
+        """
+        for fingerprint, paths in groups.items():
+            ports = ", ".join(str(src_port + path) for path in paths)
+            plural = "s" if len(paths) > 1 else ""
+            print(
+                f"Path ID {paths[0]} ({fingerprint}) found from src port{plural} {ports}"
+            )
+        return None
+
+    @staticmethod
+    def print_diamonds(diamonds):
+        """
+        print_diamonds prints the load balanced diamonds found, one per line.
+
+        :param diamonds: list, as returned by helpers.find_diamonds
+        """
+        if not diamonds:
+            print("No load balancing found")
+        for diamond in diamonds:
+            start = "this host"
+            if diamond["start"] is not None:
+                start = f"{diamond['start']} (TTL {diamond['start_ttl']})"
+            end = "unknown"
+            if diamond["end"] is not None:
+                end = f"{diamond['end']} (TTL {diamond['end_ttl']})"
+            print(f"Diamond from {start} to {end}, up to {diamond['width']} wide")
         return None
 
     @staticmethod
-    def start_viz(traces, bind_ip) -> None:
-        ## TODO: Break apart into different classes?
-        # TODO: Need to re-home the http server to serve out of a tmp directory, or serve from
-        import http.server
-
-        port = 8081
-        NODES = printer._build_nodes(traces)
-
-        class nodesHandler(http.server.BaseHTTPRequestHandler):
-            def __init__(self, *args, **kwargs):
-                super().__init__(*args, **kwargs)
-
-            def do_GET(self):
-                if self.path in ["/"]:
-                    self.send_response(200)
-                    self.send_header("Content-type", "text/html")
-                    self.end_headers()
-
-                    f = open("index.html")
-                    self.wfile.write(bytes(f.read(), "utf-8"))
-                    f.close()
-                elif self.path in ["/nodes.json"]:
-                    self.send_response(200)
-                    self.send_header("Content-type", "application/json")
-                    self.end_headers()
-
-                    self.wfile.write(bytes("data = '{0}'".format(NODES), "utf-8"))
-                else:
-                    self.send_response(404)
-                    self.wfile.write(bytes("404: not found", "utf-8"))
+    def start_viz(traces, bind_ip, port=8081) -> None:
+        """
+        start_viz serves the results to a web browser, as a vis.js topology, until interrupted.
 
+        :param traces: dict
+        :param bind_ip: IP address to bind the web server to
+        :param port: TCP port for the web server to listen on
+        """
+        from traceflow.viz import viz_server
+
+        server = viz_server(bind_ip, port)
+        server.set_traces(traces)
         print(
             f"Starting temp. web server on http://{bind_ip}:{port}. Ctrl+C to finish/exit."
         )
-        httpd = http.server.HTTPServer((bind_ip, port), nodesHandler)
-        httpd.handle_request
-        httpd.serve_forever()
+        server.serve_forever()
         return None
 
     @staticmethod
     def _build_nodes(traces: dict) -> dict:
-        max_ttl = max([max(traces[i].keys()) for i in traces.keys()])
         nodes = dict()
         nodes["nodes"] = list()
         nodes["links"] = list()
@@ -103,9 +234,260 @@ class printer:
                 node["label"] = traces[path][hop]
                 if node not in nodes["nodes"]:
                     nodes["nodes"].append(node)
-                if hop < max_ttl:
+                # Paths from different destinations may not be padded to the same length
+                if hop + 1 in traces[path]:
                     link = dict()
                     link["from"] = traces[path][hop]
                     link["to"] = traces[path][hop + 1]
                     nodes["links"].append(link)
         return json.dumps(nodes)
+
+
+class record_writer:
+    """
+    record_writer writes one record per hop as soon as it is answered, as JSON Lines (jsonl) or CSV (csv), for other
+    tools to consume as a stream. Records are buffered, and written and flushed in batches of up to batch records, or
+    whatever has built up every interval seconds. While a stream is watched, the interval is kept by a background
+    thread, so records still go out when no hop events come in for a while. Every record has the same fields, in the
+    order of FIELDS, with rtt, type and code left empty (or null) where not known.
+    """
+
+    FIELDS = (
+        "target",
+        "path",
+        "src_port",
+        "ttl",
+        "responder",
+        "rtt",
+        "type",
+        "code",
+        "final",
+    )
+    FORMATS = ("jsonl", "csv")
+
+    def __init__(
+        self, format="jsonl", src_port=33452, out=None, batch=256, interval=1.0
+    ):
+        """
+        :param format: jsonl or csv
+        :param src_port: UDP source port the trace was started with, path N uses src_port + N
+        :param out: file to write to, defaults to sys.stdout
+        :param batch: most records buffered before they are written
+        :param interval: most time (in seconds) a record is buffered for before it is written
+        """
+        if format not in self.FORMATS:
+            raise ValueError(f"Unknown record format {format}")
+        self.format = format
+        self.src_port = src_port
+        self.out = out or sys.stdout
+        self.batch = batch
+        self.interval = interval
+        self._buf = io.StringIO()
+        self._csv = csv.writer(self._buf, lineterminator="\n")
+        self._pending = 0
+        self._flushed = time.monotonic()
+        # Held while the buffer is touched, as the flushing thread shares it
+        self.mutex = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if format == "csv":
+            self._csv.writerow(self.FIELDS)
+
+    def update(self, event) -> None:
+        """
+        update writes out the record for a hop event, once the batch is full or the interval is up.
+
+        :param event: traceflow.hop_event
+        """
+        if event.responder is not None:
+            self._write(event)
+        # Probes given up on are not hops, but still a chance to write out what has been waiting too long
+        now = time.monotonic()
+        if self._pending >= self.batch or now - self._flushed >= self.interval:
+            self.flush(now)
+
+    def _write(self, event) -> None:
+        # Buffers the record for a hop event
+        record = (
+            event.target,
+            event.path,
+            self.src_port + event.path,
+            event.ttl,
+            event.responder,
+            event.rtt,
+            event.type,
+            event.code,
+            event.final,
+        )
+        with self.mutex:
+            if self.format == "csv":
+                self._csv.writerow(record)
+            else:
+                self._buf.write(json.dumps(dict(zip(self.FIELDS, record))) + "\n")
+            self._pending += 1
+
+    def start(self) -> None:
+        """
+        start writes out whatever has built up every interval seconds from a background thread, until close().
+        watch() does this for as long as its stream lasts.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._flusher, daemon=True)
+        self._thread.start()
+
+    def _flusher(self) -> None:
+        while not self._stop.wait(self.interval):
+            if self._pending:
+                self.flush()
+
+    def close(self) -> None:
+        """
+        close stops the background thread, and writes out every buffered record. The writer may be started again.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def watch(self, events):
+        """
+        watch passes a stream of hop events through, writing a record for each along the way. Whatever is still
+        buffered is written once the stream ends.
+
+        :param events: iterable of hop_event, such as a hop_stream
+        :return: generator of the same hop_event
+        """
+        self.start()
+        try:
+            for event in events:
+                self.update(event)
+                yield event
+        finally:
+            self.close()
+
+    def flush(self, now: float = None) -> None:
+        """
+        flush writes out every buffered record, in one write.
+
+        :param now: current time, as returned by time.monotonic()
+        """
+        with self.mutex:
+            data = self._buf.getvalue()
+            if data:
+                self.out.write(data)
+                self.out.flush()
+                self._buf.seek(0)
+                self._buf.truncate()
+            self._pending = 0
+            self._flushed = now if now is not None else time.monotonic()
+
+
+class live_printer:
+    """
+    live_printer redraws the results table in place on a terminal as hop events come in, at most fps times a
+    second. Each frame is built as one string and written in one go. Hops not known yet are left blank, and hops
+    given up on are shown as a *. The last frame is cleared once done, so the final table can take its place.
+    """
+
+    def __init__(self, horizontal=False, fps=10.0, out=None):
+        """
+        :param horizontal: lay the table out as print_horizontal does, rather than print_vertical
+        :param fps: most frames drawn per second
+        :param out: file to draw to, defaults to sys.stdout
+        """
+        self.horizontal = horizontal
+        self.interval = 1 / fps
+        self.out = out or sys.stdout
+        # target -> path -> ttl -> hop, and target -> path -> ttl -> RTT, as known so far
+        self.traces = dict()
+        self.rtts = dict()
+        # Number of lines the frame on screen takes up, and when it was drawn
+        self._lines = 0
+        self._drawn = None
+
+    def update(self, event) -> None:
+        """
+        update records a hop event, and redraws the table unless it was drawn too recently.
+
+        :param event: traceflow.hop_event
+        """
+        hops = self.traces.setdefault(event.target, dict()).setdefault(
+            event.path, dict()
+        )
+        if event.responder is not None:
+            hops[event.ttl] = event.responder
+        else:
+            # A reply may still turn up after the probe was given up on
+            hops.setdefault(event.ttl, "*")
+        if event.rtt is not None:
+            self.rtts.setdefault(event.target, dict()).setdefault(event.path, dict())[
+                event.ttl
+            ] = event.rtt
+        now = time.monotonic()
+        if self._drawn is None or now - self._drawn >= self.interval:
+            self.draw(now)
+
+    def watch(self, events):
+        """
+        watch passes a stream of hop events through, drawing them along the way, and clears the table once the
+        stream ends.
+
+        :param events: iterable of hop_event, such as a hop_stream
+        :return: generator of the same hop_event
+        """
+        try:
+            for event in events:
+                self.update(event)
+                yield event
+        finally:
+            self.clear()
+
+    def draw(self, now: float = None) -> None:
+        """
+        draw replaces the frame on screen with the table as it stands.
+
+        :param now: current time, as returned by time.monotonic()
+        """
+        frame = self._frame()
+        self.out.write(self._erase() + frame)
+        self.out.flush()
+        self._lines = frame.count("\n")
+        self._drawn = now if now is not None else time.monotonic()
+
+    def clear(self) -> None:
+        """
+        clear removes the frame on screen.
+        """
+        if self._lines:
+            self.out.write(self._erase())
+            self.out.flush()
+            self._lines = 0
+
+    def _erase(self) -> str:
+        # Back up to the first line of the frame, and clear everything from there down
+        if not self._lines:
+            return ""
+        return f"\x1b[{self._lines}F\x1b[J"
+
+    def _frame(self) -> str:
+        # Lines wider than the terminal would wrap, and throw off the count of lines to erase
+        width = shutil.get_terminal_size().columns - 1
+        lines = list()
+        for target in sorted(self.traces):
+            paths = self.traces[target]
+            max_ttl = max(max(hops) for hops in paths.values())
+            table = {
+                path: {ttl: hops.get(ttl, "") for ttl in range(1, max_ttl + 1)}
+                for path, hops in sorted(paths.items())
+            }
+            if len(self.traces) > 1:
+                lines.append(f"Trace to {target}")
+            if self.horizontal:
+                text = printer.format_horizontal(table, self.rtts.get(target))
+            else:
+                text = printer.format_vertical(table, self.rtts.get(target))
+            lines.extend(text.splitlines())
+        return "".join(line[:width] + "\n" for line in lines)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+""" Probe identity: which fields of a probe say what (target, path, ttl) it was sent for """
+
+import random
+import threading
+
+import traceflow.helpers as helpers
+
+
+class probe_id_table:
+    """
+    probe_id_table hands out the identifying fields for every probe, and maps them back to (target, path, ttl) when
+    they are quoted back in an ICMP message. Only the IPv4 header and first 8 bytes of UDP are guaranteed to be quoted
+    (RFC 792), so the UDP payload is never used to carry the ID.
+
+    Schemes:
+      ipid      path and TTL packed into the 16 bit IP.ID, as 8 bits each. Limited to 255 paths and 255 TTLs. Stateless.
+      srcport   path carried by the source port offset, and a sequence number in the IP.ID. Paths are only limited by
+                the port range.
+      checksum  as srcport, but the sequence number is carried in the UDP checksum, and the IP.ID holds the TTL. For
+                paths which rewrite the IP.ID.
+    """
+
+    SCHEMES = ("ipid", "srcport", "checksum")
+
+    def __init__(self, scheme: str = "ipid"):
+        if scheme not in self.SCHEMES:
+            raise ValueError(f"Unknown probe ID scheme {scheme}")
+        self.scheme = scheme
+        self.mutex = threading.Lock()
+        # key -> (target, path, ttl)
+        self.probes = dict()
+        # target -> list of keys, so a finished target can be dropped in one go
+        self._by_target = dict()
+        # target -> (path, ttl) -> when the probe was sent, in nanoseconds since the epoch
+        self._sent_at = dict()
+        # Start somewhere random, so runs in other processes are unlikely to hand out the same IDs
+        self._seq = random.randint(1, 0xFFFF)
+
+    def max_paths(self, src_port: int) -> int:
+        """
+        max_paths returns how many paths can be told apart, given that path N is sent from src_port + N.
+
+        :param src_port: UDP source port, as passed to --srcport
+        :return: int
+        """
+        ports = max(0xFFFF - src_port, 0)
+        return min(255, ports) if self.scheme == "ipid" else ports
+
+    def _next_seq(self) -> int:
+        # 0 is skipped, as a UDP checksum of 0 means "no checksum"
+        self._seq = self._seq % 0xFFFF + 1
+        return self._seq
+
+    def allocate(self, target: str, path: int, ttl: int, udp_src_port: int) -> tuple:
+        """
+        allocate picks the identifying fields for a new probe and remembers them.
+
+        :param target: destination address of the probe
+        :param path: path ID of the probe
+        :param ttl: TTL of the probe
+        :param udp_src_port: the source port of the probe
+        :return: tuple of (ip_id, udp_checksum). udp_checksum is None unless the checksum scheme is used.
+        """
+        if self.scheme == "ipid":
+            if path > 255 or ttl > 255:
+                raise ValueError("The ipid scheme is limited to 255 paths and TTLs")
+            return helpers.ints_to_ipid(path, ttl), None
+        with self.mutex:
+            # Skip over any ID still in use for this target and port
+            for _ in range(0xFFFF):
+                seq = self._next_seq()
+                key = (target, udp_src_port, seq)
+                if key not in self.probes:
+                    break
+            else:
+                raise RuntimeError(f"No probe IDs left for {target}:{udp_src_port}")
+            self.probes[key] = (target, path, ttl)
+            self._by_target.setdefault(target, list()).append(key)
+        if self.scheme == "srcport":
+            return seq, None
+        return ttl, seq
+
+    def lookup(self, target: str, ip_id: int, udp_src_port: int, udp_checksum: int):
+        """
+        lookup maps the fields quoted back in an ICMP message to the probe they came from.
+
+        :param target: destination address of the quoted probe
+        :param ip_id: IP.ID of the quoted probe
+        :param udp_src_port: source port of the quoted probe
+        :param udp_checksum: UDP checksum of the quoted probe
+        :return: tuple of (path, ttl), or None if this is not one of our probes
+        """
+        if self.scheme == "ipid":
+            return helpers.ipid_to_ints(ip_id)
+        # Either way, the sequence number is what makes the key unique for a target and port
+        seq = ip_id if self.scheme == "srcport" else udp_checksum
+        probe = self.probes.get((target, udp_src_port, seq))
+        if probe is None:
+            return None
+        return probe[1:]
+
+    def sent(self, target: str, path: int, ttl: int, when: int) -> None:
+        """
+        sent records when a probe was put on the wire. If the same probe is sent again, a reply cannot be told apart
+        from a reply to the first one (Karn's algorithm), so no RTT is measured for it at all.
+
+        :param target: destination address of the probe
+        :param path: path ID of the probe
+        :param ttl: TTL of the probe
+        :param when: time the probe was sent, in nanoseconds since the epoch
+        """
+        with self.mutex:
+            sent_at = self._sent_at.setdefault(target, dict())
+            sent_at[(path, ttl)] = None if (path, ttl) in sent_at else when
+
+    def rtt(self, target: str, path: int, ttl: int, rx_time: int):
+        """
+        rtt works out the round trip time of a probe, from when it was sent and when its reply was received.
+
+        :param target: destination address of the probe
+        :param path: path ID of the probe
+        :param ttl: TTL of the probe
+        :param rx_time: time the reply was received, in nanoseconds since the epoch, 0 if not known
+        :return: float, the RTT in milliseconds, or None if it cannot be measured
+        """
+        with self.mutex:
+            when = self._sent_at.get(target, dict()).get((path, ttl))
+        if when is None or not rx_time or rx_time < when:
+            return None
+        return (rx_time - when) / 1e6
+
+    def release(self, target: str) -> None:
+        """
+        release forgets every probe sent to target, once no more replies are expected.
+
+        :param target: destination address
+        """
+        with self.mutex:
+            for key in self._by_target.pop(target, list()):
+                self.probes.pop(key, None)
+            self._sent_at.pop(target, None)
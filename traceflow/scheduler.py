@@ -0,0 +1,978 @@
+# -*- coding: utf-8 -*-
+
+""" Probe scheduling for compute_traces """
+
+import collections
+import heapq
+import logging
+import math
+import random
+
+
+# Marks a (ttl, interface) whose paths disagree on the hop before it
+_CONFLICT = object()
+# How often (in seconds) a scheduler held back by a stop set looks again whether it may start
+HOLD_POLL = 0.01
+
+
+class stop_set:
+    """
+    stop_set learns which interface sits at each TTL near this host, and which interface precedes it, Doubletree style.
+    Once a path runs into a known (ttl, interface) with an unambiguous chain back to TTL 1, the hops before it can be
+    filled in from here instead of being probed again.
+    """
+
+    def __init__(self):
+        # (ttl, interface) -> interface at ttl - 1 (None at TTL 1), or _CONFLICT if paths through it disagree
+        self.links = dict()
+        # ttl -> set of interfaces seen at that ttl
+        self.by_ttl = dict()
+        # The probe_scheduler which started out on an empty stop set. Every other path waits for it to learn the
+        # prefix first, see probe_scheduler.
+        self.leader = None
+        # Set once the leader has learned what it can, from then on nobody waits
+        self.released = False
+        # Schedulers waiting on the leader, which keeps its probes close to the prefix until there are none
+        self.waiting = set()
+
+    def add(self, ttl: int, interface: str, previous) -> None:
+        """
+        add records that interface was seen at ttl, with previous at ttl - 1 on the same path.
+
+        :param ttl: the TTL interface answered at
+        :param interface: the responding address
+        :param previous: the responding address at ttl - 1, or None at TTL 1
+        """
+        key = (ttl, interface)
+        if key in self.links and self.links[key] != previous:
+            self.links[key] = _CONFLICT
+        elif key not in self.links:
+            self.links[key] = previous
+            self.by_ttl.setdefault(ttl, set()).add(interface)
+
+    def prefix(self, ttl: int, interface: str):
+        """
+        prefix returns the hops before (ttl, interface), if they are known without any doubt.
+
+        :param ttl: the TTL interface answered at
+        :param interface: the responding address
+        :return: dict of ttl -> interface for every TTL below ttl, or None if the stop set cannot tell
+        """
+        hops = dict()
+        while True:
+            previous = self.links.get((ttl, interface), _CONFLICT)
+            if previous is _CONFLICT:
+                return None
+            if ttl == 1:
+                return hops
+            ttl -= 1
+            interface = previous
+            hops[ttl] = interface
+
+    def start_ttl(self) -> int:
+        """
+        start_ttl returns the first TTL past the prefix every path seen so far shares.
+
+        :return: int
+        """
+        ttl = 1
+        while len(self.by_ttl.get(ttl, ())) == 1:
+            ttl += 1
+        return ttl
+
+
+class timeout_tracker:
+    """
+    timeout_tracker keeps the deadline of every outstanding probe in a heap, so the next one to time out is always at
+    hand, even when retransmitted probes wait longer than fresh ones. A lost probe is queued up for retransmission,
+    waiting backoff times longer on each attempt, until it has been retried retries times.
+    """
+
+    def __init__(self, timeout: float = 1.0, retries: int = 0, backoff: float = 2.0):
+        """
+        :param timeout: time (in seconds) to wait for a reply to the first attempt
+        :param retries: number of times to retransmit a lost probe
+        :param backoff: factor the timeout grows by with each retransmission
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # probe -> deadline
+        self.outstanding = dict()
+        # probe -> number of times sent, dropped once answered
+        self.attempts = dict()
+        self.retransmit = collections.deque()
+        # Retransmissions handed out, not counting those answered while still queued
+        self.retransmitted = 0
+        # (deadline, probe), entries no longer matching outstanding are stale and skipped
+        self._heap = list()
+
+    def add(self, probe: tuple, now: float) -> None:
+        """
+        add starts the clock on a probe which was just sent.
+
+        :param probe: tuple of (path, ttl)
+        :param now: current time, as returned by time.monotonic()
+        """
+        attempt = self.attempts.get(probe, 0)
+        self.attempts[probe] = attempt + 1
+        if attempt:
+            self.retransmitted += 1
+        deadline = now + self.timeout * self.backoff ** attempt
+        self.outstanding[probe] = deadline
+        heapq.heappush(self._heap, (deadline, probe))
+
+    def remove(self, probe: tuple) -> None:
+        """
+        remove stops waiting on a probe, as it was answered or is no longer of interest.
+
+        :param probe: tuple of (path, ttl)
+        """
+        self.outstanding.pop(probe, None)
+        self.attempts.pop(probe, None)
+
+    def wanted(self, probe: tuple) -> bool:
+        # A probe queued for retransmission may have been answered late in the meantime
+        return probe in self.attempts
+
+    def _prune(self) -> None:
+        while self._heap and self.outstanding.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_timeout(self):
+        """
+        next_timeout returns the deadline of the probe which times out first.
+
+        :return: float, or None if nothing is outstanding
+        """
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def expire(self, now: float) -> list:
+        """
+        expire takes every probe past its deadline off the outstanding list. Those with retries left are queued up
+        for retransmission, the rest are given up on.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: list of (path, ttl) tuples given up on
+        """
+        expired = list()
+        self._prune()
+        while self._heap and self._heap[0][0] <= now:
+            _, probe = heapq.heappop(self._heap)
+            self.outstanding.pop(probe)
+            if self.attempts[probe] <= self.retries:
+                logging.debug(f"Retransmitting {probe}, attempt {self.attempts[probe]}")
+                self.retransmit.append(probe)
+            else:
+                self.attempts.pop(probe)
+                expired.append(probe)
+            self._prune()
+        return expired
+
+
+class probe_scheduler:
+    """
+    probe_scheduler keeps a window of outstanding probes spread across every path and TTL at once.
+
+    It does no I/O of its own: the caller asks it which (path, ttl) probes to put on the wire next, and tells it which
+    probes have been answered. This way the same scheduler can be driven by a thread, a poll loop or an event loop.
+
+    With a stop_set, each path starts past the prefix already known, and probes backwards from there one TTL at a time
+    until it runs into a known interface. The hops below that are filled in from the stop set. Paths starting at TTL 2
+    or below would not save a probe, and start at TTL 1 instead.
+
+    When the stop set starts out empty, as it does for a batch of targets traced at once, the first scheduler to use it
+    leads. Its first path goes ahead on its own until TTLs 1 and 2 have been answered or timed out, then its other
+    paths start, from TTL 3 at most as only one path has been seen. Every other scheduler holds back all of its paths
+    until the leader has settled the prefix its paths share, and then starts past it. While others wait, the leader
+    probes no further than one TTL past the prefix.
+    """
+
+    def __init__(
+        self,
+        tot_runs: int,
+        max_ttl: int,
+        window: int = 32,
+        pps: float = 0,
+        timeout: float = 1.0,
+        stop_set: stop_set = None,
+        retries: int = 0,
+        backoff: float = 2.0,
+    ):
+        """
+        :param tot_runs: number of paths to enumerate
+        :param max_ttl: probes are sent for TTL 1 up to (but not including) max_ttl
+        :param window: maximum number of probes which may be outstanding at any one time
+        :param pps: maximum number of probes per second, 0 for no limit
+        :param timeout: time (in seconds) an unanswered probe holds its slot in the window
+        :param stop_set: stop_set to learn from and skip known hops with, may be shared with other schedulers
+        :param retries: number of times to retransmit a lost probe, see timeout_tracker
+        :param backoff: factor the timeout grows by with each retransmission
+        """
+        self.max_ttl = max_ttl
+        self.window = max(1, window)
+        self.pps = pps
+        self.timeout = timeout
+        # Queue probes TTL first, so that any window of probes is spread across all paths
+        self.queue = collections.deque(
+            (path, ttl) for ttl in range(1, max_ttl) for path in range(1, tot_runs + 1)
+        )
+        self.timeouts = timeout_tracker(timeout, retries, backoff)
+        # (path, ttl) -> deadline
+        self.outstanding = self.timeouts.outstanding
+        # path -> lowest TTL the destination answered at
+        self.path_end = dict()
+        self.sent = 0
+        self._next_send = 0.0
+
+        self.stop_set = stop_set
+        # Only used with a stop set:
+        # path -> first TTL probed forwards, TTLs below it are probed backwards one at a time
+        self.start = dict()
+        # path -> TTL currently being probed backwards
+        self._backward_at = dict()
+        self.backward = collections.deque()
+        # path -> ttl -> interface, as answered and as filled in from the stop set
+        self.hops = dict()
+        self.filled = dict()
+        # Probes held back for the stop set, in the order they were queued, and _hold_state() when they were
+        self.held = collections.deque()
+        self._held_in = None
+
+    def _beyond_end(self, probe: tuple) -> bool:
+        """
+        _beyond_end returns True if a probe lies beyond the point where its path already reached the destination
+
+        :param probe: tuple of (path, ttl)
+        :return: bool
+        """
+        path, ttl = probe
+        return path in self.path_end and ttl > self.path_end[path]
+
+    def _skip(self, probe: tuple) -> bool:
+        """
+        _skip returns True if a probe from the queue does not need to be sent. Besides probes beyond the destination,
+        this covers probes below where a path started, which are left to backwards probing.
+
+        :param probe: tuple of (path, ttl)
+        :return: bool
+        """
+        path, ttl = probe
+        return self._beyond_end(probe) or ttl < self.start.get(path, 1)
+
+    def _resolved(self, ttl: int, path: int = None) -> bool:
+        """
+        _resolved returns True once every probe at or below ttl has been answered or timed out. Retransmissions are
+        not waited for, so a hop which does not answer holds nobody up for longer than one timeout.
+
+        :param ttl: highest TTL to look at
+        :param path: only look at this path, rather than all of them
+        :return: bool
+        """
+
+        def pending(probe):
+            return probe[1] <= ttl and (path is None or probe[0] == path)
+
+        attempts = self.timeouts.attempts
+        if any(pending(i) and attempts[i] == 1 for i in self.outstanding):
+            return False
+        if any(pending(i) for i in self.backward if not self._beyond_end(i)):
+            return False
+        if any(pending(i) for i in self.held):
+            return False
+        # The queue is in TTL order
+        for probe in self.queue:
+            if probe[1] > ttl:
+                break
+            if pending(probe) and not self._skip(probe):
+                return False
+        return True
+
+    def _holding(self) -> bool:
+        """
+        _holding returns True while paths which have not started yet have to wait for the stop set to learn from the
+        paths ahead of them. The first path of the leader never waits.
+
+        :return: bool
+        """
+        stop_set = self.stop_set
+        if stop_set.leader is None:
+            # Whatever the stop set knew already was learned from paths traced before, nothing to wait for
+            if stop_set.links:
+                return False
+            stop_set.leader = self
+        leader = stop_set.leader
+        if leader is self:
+            return not self._resolved(2, 1)
+        if not stop_set.released and leader._resolved(2, 1):
+            # Nothing to be saved below TTL 3, otherwise wait for every path of the leader to get past the prefix
+            start = stop_set.start_ttl()
+            if start <= 2 or leader._resolved(start):
+                stop_set.released = True
+                stop_set.waiting.clear()
+        if stop_set.released:
+            return False
+        stop_set.waiting.add(self)
+        return True
+
+    def _reach(self):
+        """
+        _reach returns the highest TTL the leader probes while others wait on it: TTL 2 until its first path knows
+        TTLs 1 and 2, and one TTL past the prefix learned so far after that. Probing any further ahead would only
+        find the destination many times over before anybody else starts.
+
+        :return: int, or None if there is no limit
+        """
+        if self.stop_set is None or self.stop_set.leader is not self:
+            return None
+        if self._holding():
+            return 2
+        if not self.stop_set.waiting:
+            return None
+        return max(2, self.stop_set.start_ttl()) + 1
+
+    def _hold_state(self) -> tuple:
+        # Whether paths which did not start yet are held back, and how far the leader may probe
+        if self.stop_set is None:
+            return False, None
+        return self._holding(), self._reach()
+
+    def _start_path(self, path: int) -> None:
+        # Start past the prefix which is already known, and work backwards from there
+        start = self.stop_set.start_ttl()
+        if self.stop_set.leader is self:
+            # Only the first path has been seen, which says nothing about where paths part ways
+            start = min(start, 3)
+        start = min(start, max(1, self.max_ttl - 1))
+        # Probing backwards from TTL 2 sends TTL 1 anyway
+        if start <= 2:
+            start = 1
+        self.start[path] = start
+        if start > 1:
+            logging.debug(f"Path {path} starts at TTL {start}")
+            self._step_back(path, start)
+
+    def _step_back(self, path: int, ttl: int) -> None:
+        # Queue the next backwards probe for path, below ttl
+        if ttl <= 1 or self._backward_at.get(path, ttl) < ttl:
+            return
+        self._backward_at[path] = ttl - 1
+        self.backward.append((path, ttl - 1))
+
+    def _learn(self, path: int, ttl: int, responder: str, final: bool = False) -> None:
+        hops = self.hops.setdefault(path, dict())
+        # The destination is no part of a prefix other targets could share, and is left out
+        if not final:
+            hops[ttl] = responder
+            if ttl == 1:
+                self.stop_set.add(1, responder, None)
+            elif ttl - 1 in hops:
+                self.stop_set.add(ttl, responder, hops[ttl - 1])
+            if ttl + 1 in hops:
+                self.stop_set.add(ttl + 1, hops[ttl + 1], responder)
+        if ttl != self._backward_at.get(path):
+            return
+        # A backwards probe: stop as soon as it hits an interface the stop set knows the way back from
+        prefix = None if final else self.stop_set.prefix(ttl, responder)
+        if prefix is None:
+            self._step_back(path, ttl)
+            return
+        logging.debug(f"Path {path} joins the stop set at TTL {ttl}")
+        self.filled[path] = prefix
+        for i in sorted(prefix, reverse=True):
+            hops[i] = prefix[i]
+        self._backward_at[path] = 0
+
+    def has_probes(self) -> bool:
+        """
+        has_probes returns True if there are probes waiting to be handed out.
+
+        :return: bool
+        """
+        return bool(
+            self.timeouts.retransmit or self.backward or self.queue or self.held
+        )
+
+    def can_send(self) -> bool:
+        """
+        can_send returns True if there are probes which could be handed out right now, window and rate permitting.
+        Unlike has_probes, probes of paths held back for the stop set do not count until they may start.
+
+        :return: bool
+        """
+        if self.held and self._hold_state() != self._held_in:
+            return True
+        return bool(self.timeouts.retransmit or self.backward or self.queue)
+
+    def next_probes(self, now: float, limit: int = None) -> list:
+        """
+        next_probes hands out the probes which may be sent right now, given the window and packet rate.
+        Every probe returned is considered outstanding from now on.
+
+        :param now: current time, as returned by time.monotonic()
+        :param limit: hand out at most this many probes
+        :return: list of (path, ttl) tuples
+        """
+        probes = list()
+        state = self._hold_state()
+        if self.held and state != self._held_in:
+            # Back at the front of the queue, still in TTL order, to be held back again if need be
+            self.queue.extendleft(reversed(self.held))
+            self.held.clear()
+        holding, reach = state
+        leads = self.stop_set is not None and self.stop_set.leader is self
+        while len(self.outstanding) < self.window:
+            if not (self.timeouts.retransmit or self.backward or self.queue):
+                break
+            if limit is not None and len(probes) >= limit:
+                break
+            if self.pps and now < self._next_send:
+                break
+            if self.timeouts.retransmit:
+                probe = self.timeouts.retransmit.popleft()
+                if not self.timeouts.wanted(probe) or self._beyond_end(probe):
+                    continue
+            elif self.backward:
+                probe = self.backward.popleft()
+                if self._beyond_end(probe):
+                    continue
+            else:
+                probe = self.queue.popleft()
+                if (reach is not None and probe[1] > reach) or (
+                    holding and not (leads and probe[0] == 1)
+                ):
+                    self.held.append(probe)
+                    self._held_in = state
+                    continue
+                if self.stop_set is not None and probe[0] not in self.start:
+                    self._start_path(probe[0])
+                if self._skip(probe):
+                    continue
+            self.timeouts.add(probe, now)
+            self.sent += 1
+            if self.pps:
+                self._next_send = max(self._next_send, now) + 1 / self.pps
+            probes.append(probe)
+        return probes
+
+    def reply(
+        self, path: int, ttl: int, final: bool = False, responder: str = None
+    ) -> None:
+        """
+        reply marks the probe for (path, ttl) as answered, freeing up its slot in the window.
+
+        :param path: the path ID of the probe
+        :param ttl: the TTL of the probe
+        :param final: True if the reply came from the destination itself
+        :param responder: the address which answered, needed to learn the stop set
+        """
+        self.timeouts.remove((path, ttl))
+        if self.stop_set is not None and responder is not None:
+            self._learn(path, ttl, responder, final)
+        if not final:
+            return
+        if path in self.path_end and ttl >= self.path_end[path]:
+            return
+        self.path_end[path] = ttl
+        logging.debug(f"Path {path} reached the destination at TTL {ttl}")
+        # Probes still in flight beyond the destination can only produce duplicate answers, stop waiting on them
+        for probe in [i for i in self.outstanding if self._beyond_end(i)]:
+            self.timeouts.remove(probe)
+
+    def expire(self, now: float) -> list:
+        """
+        expire retransmits or gives up on any outstanding probe which has waited longer than its timeout.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: list of (path, ttl) tuples given up on
+        """
+        expired = self.timeouts.expire(now)
+        for probe in expired:
+            # A hop which does not answer cannot stop backwards probing, carry on below it
+            if probe[1] == self._backward_at.get(probe[0]):
+                self._step_back(*probe)
+        return expired
+
+    def next_deadline(self, now: float) -> float:
+        """
+        next_deadline returns how long the caller can wait before the scheduler has something new to do,
+        either a probe to send or an outstanding probe to time out.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: float: seconds to wait, 0 if there is work to do right away
+        """
+        deadlines = list()
+        if self.can_send() and len(self.outstanding) < self.window:
+            deadlines.append(self._next_send - now if self.pps else 0)
+        if self.outstanding:
+            deadlines.append(self.timeouts.next_timeout() - now)
+        if self.held and self.stop_set.leader is not self:
+            # The leader may run off another loop, nothing tells us when it is done
+            deadlines.append(HOLD_POLL)
+        if not deadlines:
+            return 0
+        return max(0, min(deadlines))
+
+    def done(self) -> bool:
+        """
+        done returns True once there is nothing left to send and nothing left to wait for.
+
+        :return: bool
+        """
+        while self.queue and self._skip(self.queue[0]):
+            self.queue.popleft()
+        while self.backward and self._beyond_end(self.backward[0]):
+            self.backward.popleft()
+        return not self.has_probes() and not self.outstanding
+
+
+def mda_stopping_point(k: int, confidence: float = 0.95) -> int:
+    """
+    mda_stopping_point returns how many flows must have been probed through a vertex with k known next hops, before
+    the chance that a k + 1th next hop was missed drops below 1 - confidence. Next hops are assumed to be picked
+    uniformly at random per flow, as in the Multipath Detection Algorithm.
+
+    :param k: number of next hops found so far
+    :param confidence: wanted confidence that every next hop has been found
+    :return: int
+    """
+    alpha = 1 - confidence
+    return math.ceil(math.log(alpha / (k + 1)) / math.log(k / (k + 1)))
+
+
+class mda_scheduler:
+    """
+    mda_scheduler enumerates paths adaptively, in the style of the Multipath Detection Algorithm, rather than probing a
+    fixed number of paths. Each path is still a flow, told apart by its source port.
+
+    Hops are probed one TTL at a time. For every interface at the previous TTL, flows known to pass through it are
+    probed until mda_stopping_point() says all of its next hops have been found. If there are not enough such flows,
+    new flows are probed at the previous TTL to find some. Up to max_paths flows are used.
+
+    It has the same interface as probe_scheduler, and needs the responder passed to reply().
+    """
+
+    def __init__(
+        self,
+        max_paths: int,
+        max_ttl: int,
+        window: int = 32,
+        pps: float = 0,
+        timeout: float = 1.0,
+        confidence: float = 0.95,
+        retries: int = 0,
+        backoff: float = 2.0,
+    ):
+        """
+        :param max_paths: maximum number of flows to use
+        :param max_ttl: probes are sent for TTL 1 up to (but not including) max_ttl
+        :param window: maximum number of probes which may be outstanding at any one time
+        :param pps: maximum number of probes per second, 0 for no limit
+        :param timeout: time (in seconds) an unanswered probe holds its slot in the window
+        :param confidence: wanted confidence that every next hop has been found, per interface
+        :param retries: number of times to retransmit a lost probe, see timeout_tracker
+        :param backoff: factor the timeout grows by with each retransmission
+        """
+        self.max_paths = max_paths
+        self.max_ttl = max_ttl
+        self.window = max(1, window)
+        self.pps = pps
+        self.timeout = timeout
+        self.confidence = confidence
+        # Flows in use are path IDs 1 up to and including flows
+        self.flows = 0
+        # The TTL being probed
+        self.ttl = 1
+        self.queue = collections.deque()
+        self.timeouts = timeout_tracker(timeout, retries, backoff)
+        # (path, ttl) -> deadline
+        self.outstanding = self.timeouts.outstanding
+        # path -> ttl -> interface, None if the probe timed out
+        self.hops = dict()
+        # path -> lowest TTL the destination answered at
+        self.path_end = dict()
+        self.sent = 0
+        self._next_send = 0.0
+        self._finished = False
+
+    def _plan_hop(self, ttl: int) -> list:
+        # Group the flows still going by the interface they passed at the previous TTL
+        groups = dict()
+        if ttl == 1:
+            groups[None] = list()
+        for path in range(1, self.flows + 1):
+            hops = self.hops.get(path, dict())
+            if self.path_end.get(path, ttl) < ttl:
+                continue
+            if ttl == 1:
+                groups[None].append(path)
+            elif ttl - 1 in hops:
+                groups.setdefault(hops[ttl - 1], list()).append(path)
+
+        probes = list()
+        new_flows = 0
+        for interface, paths in groups.items():
+            probed = [i for i in paths if ttl in self.hops.get(i, ())]
+            found = {self.hops[i][ttl] for i in probed} - {None}
+            need = mda_stopping_point(max(1, len(found)), self.confidence)
+            need -= len(probed)
+            if need <= 0:
+                continue
+            unprobed = [i for i in paths if ttl not in self.hops.get(i, ())]
+            probes.extend((i, ttl) for i in unprobed[:need])
+            # Nothing is known about what lies behind a hop which did not answer, so only chase real interfaces
+            if interface is not None or ttl == 1:
+                new_flows += max(0, need - len(unprobed))
+
+        # New flows are probed a TTL early, to find out which interface they pass through there
+        for _ in range(min(new_flows, self.max_paths - self.flows)):
+            self.flows += 1
+            probes.append((self.flows, max(1, ttl - 1)))
+        return probes
+
+    def _plan(self) -> list:
+        # Only called once every probe handed out so far has been answered or timed out
+        while not self._finished:
+            probes = self._plan_hop(self.ttl)
+            if probes:
+                return probes
+            logging.debug(f"TTL {self.ttl} done, {self.flows} flows so far")
+            self.ttl += 1
+            alive = [i for i in range(1, self.flows + 1) if i not in self.path_end]
+            if self.ttl >= self.max_ttl or not alive:
+                self._finished = True
+        return list()
+
+    def has_probes(self) -> bool:
+        """
+        has_probes returns True if there are probes waiting to be handed out.
+
+        :return: bool
+        """
+        if self.timeouts.retransmit:
+            return True
+        if not self.queue and not self.outstanding:
+            self.queue.extend(self._plan())
+        return bool(self.queue)
+
+    def can_send(self) -> bool:
+        """
+        can_send returns True if there are probes which could be handed out right now, see probe_scheduler.can_send
+
+        :return: bool
+        """
+        return self.has_probes()
+
+    def next_probes(self, now: float, limit: int = None) -> list:
+        """
+        next_probes hands out the probes which may be sent right now, see probe_scheduler.next_probes
+
+        :param now: current time, as returned by time.monotonic()
+        :param limit: hand out at most this many probes
+        :return: list of (path, ttl) tuples
+        """
+        probes = list()
+        while self.has_probes() and len(self.outstanding) < self.window:
+            if limit is not None and len(probes) >= limit:
+                break
+            if self.pps and now < self._next_send:
+                break
+            if self.timeouts.retransmit:
+                probe = self.timeouts.retransmit.popleft()
+                if not self.timeouts.wanted(probe):
+                    continue
+            else:
+                probe = self.queue.popleft()
+            self.timeouts.add(probe, now)
+            self.sent += 1
+            if self.pps:
+                self._next_send = max(self._next_send, now) + 1 / self.pps
+            probes.append(probe)
+        return probes
+
+    def reply(
+        self, path: int, ttl: int, final: bool = False, responder: str = None
+    ) -> None:
+        """
+        reply marks the probe for (path, ttl) as answered, freeing up its slot in the window.
+
+        :param path: the path ID of the probe
+        :param ttl: the TTL of the probe
+        :param final: True if the reply came from the destination itself
+        :param responder: the address which answered
+        """
+        self.timeouts.remove((path, ttl))
+        self.hops.setdefault(path, dict())[ttl] = responder
+        if final and ttl < self.path_end.get(path, ttl + 1):
+            self.path_end[path] = ttl
+
+    def expire(self, now: float) -> list:
+        """
+        expire retransmits or gives up on any outstanding probe which has waited longer than its timeout.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: list of (path, ttl) tuples given up on
+        """
+        expired = self.timeouts.expire(now)
+        for path, ttl in expired:
+            self.hops.setdefault(path, dict()).setdefault(ttl, None)
+        return expired
+
+    def next_deadline(self, now: float) -> float:
+        """
+        next_deadline returns how long the caller can wait before the scheduler has something new to do.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: float: seconds to wait, 0 if there is work to do right away
+        """
+        deadlines = list()
+        if self.has_probes() and len(self.outstanding) < self.window:
+            deadlines.append(self._next_send - now if self.pps else 0)
+        if self.outstanding:
+            deadlines.append(self.timeouts.next_timeout() - now)
+        if not deadlines:
+            return 0
+        return max(0, min(deadlines))
+
+    def done(self) -> bool:
+        """
+        done returns True once every interface found has been probed through enough flows.
+
+        :return: bool
+        """
+        return not self.has_probes() and not self.outstanding
+
+    @property
+    def filled(self) -> dict:
+        """
+        filled fills in the hops below the TTL each flow was first probed at, where every other flow agrees on the
+        interface before it.
+
+        :return: dict of path -> ttl -> interface
+        """
+        # (ttl, interface) -> interfaces seen right before it
+        before = dict()
+        for hops in self.hops.values():
+            for ttl, interface in hops.items():
+                if interface is not None and hops.get(ttl - 1) is not None:
+                    before.setdefault((ttl, interface), set()).add(hops[ttl - 1])
+        filled = dict()
+        for path, hops in self.hops.items():
+            ttl = min(hops)
+            interface = hops[ttl]
+            while ttl > 1 and len(before.get((ttl, interface), ())) == 1:
+                ttl -= 1
+                interface = next(iter(before[(ttl + 1, interface)]))
+                filled.setdefault(path, dict())[ttl] = interface
+        return filled
+
+
+class batch_scheduler:
+    """
+    batch_scheduler runs one probe_scheduler per target, but shares a single window and packet rate between all of
+    them. Targets take turns, so every target makes progress at the same time.
+    """
+
+    def __init__(
+        self,
+        targets: list,
+        tot_runs: int,
+        max_ttl: int,
+        window: int = 32,
+        pps: float = 0,
+        timeout: float = 1.0,
+        stop_set: stop_set = None,
+        confidence: float = None,
+        retries: int = 0,
+        backoff: float = 2.0,
+    ):
+        """
+        :param targets: list of destination addresses
+        :param tot_runs: number of paths to enumerate per target
+        :param max_ttl: probes are sent for TTL 1 up to (but not including) max_ttl
+        :param window: maximum number of probes which may be outstanding at any one time, across all targets
+        :param pps: maximum number of probes per second across all targets, 0 for no limit
+        :param timeout: time (in seconds) an unanswered probe holds its slot in the window
+        :param stop_set: stop_set shared by all targets, the hops near this host are common to most of them
+        :param confidence: enumerate paths adaptively with mda_scheduler, using up to tot_runs flows per target
+        :param retries: number of times to retransmit a lost probe, see timeout_tracker
+        :param backoff: factor the timeout grows by with each retransmission
+        """
+        self.window = max(1, window)
+        self.pps = pps
+        self.timeout = timeout
+        # Each target may use the whole window, the limit is enforced here across all of them
+        self.schedulers = dict()
+        for target in targets:
+            if confidence is not None:
+                self.schedulers[target] = mda_scheduler(
+                    tot_runs, max_ttl, window, 0, timeout, confidence, retries, backoff
+                )
+            else:
+                self.schedulers[target] = probe_scheduler(
+                    tot_runs, max_ttl, window, 0, timeout, stop_set, retries, backoff
+                )
+        # Targets which are not done yet, in round robin order
+        self.active = collections.deque(self.schedulers)
+        self.in_flight = 0
+        # Kept up to date as probes are handed out, so the caller can count them as they go
+        self.retransmitted = 0
+        self._next_send = 0.0
+
+    @property
+    def sent(self) -> int:
+        return sum(s.sent for s in self.schedulers.values())
+
+    def next_probes(self, now: float) -> list:
+        """
+        next_probes hands out the probes which may be sent right now, one target at a time.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: list of (target, path, ttl) tuples
+        """
+        probes = list()
+        # Number of targets in a row which had nothing to send
+        idle = 0
+        while self.active and idle < len(self.active) and self.in_flight < self.window:
+            if self.pps and now < self._next_send:
+                break
+            target = self.active[0]
+            self.active.rotate(-1)
+            timeouts = self.schedulers[target].timeouts
+            before = timeouts.retransmitted
+            probe = self.schedulers[target].next_probes(now, limit=1)
+            if not probe:
+                idle += 1
+                continue
+            idle = 0
+            self.retransmitted += timeouts.retransmitted - before
+            self.in_flight += 1
+            if self.pps:
+                self._next_send = max(self._next_send, now) + 1 / self.pps
+            probes.append((target,) + probe[0])
+        return probes
+
+    def reply(
+        self,
+        target: str,
+        path: int,
+        ttl: int,
+        final: bool = False,
+        responder: str = None,
+    ) -> None:
+        """
+        reply marks the probe for (target, path, ttl) as answered, see probe_scheduler.reply
+
+        :param target: the destination address of the probe
+        :param path: the path ID of the probe
+        :param ttl: the TTL of the probe
+        :param final: True if the reply came from the destination itself
+        :param responder: the address which answered
+        """
+        scheduler = self.schedulers[target]
+        before = len(scheduler.outstanding)
+        scheduler.reply(path, ttl, final, responder)
+        self.in_flight -= before - len(scheduler.outstanding)
+
+    def expire(self, now: float) -> list:
+        """
+        expire gives up on any outstanding probe which has waited longer than the timeout.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: list of (target, path, ttl) tuples which timed out
+        """
+        expired = list()
+        for target in self.active:
+            scheduler = self.schedulers[target]
+            before = len(scheduler.outstanding)
+            for probe in scheduler.expire(now):
+                expired.append((target,) + probe)
+            # Probes queued up for retransmission leave the window too, until they are sent again
+            self.in_flight -= before - len(scheduler.outstanding)
+        return expired
+
+    def next_deadline(self, now: float) -> float:
+        """
+        next_deadline returns how long the caller can wait before any target has something new to do.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: float: seconds to wait, 0 if there is work to do right away
+        """
+        deadlines = list()
+        for target in self.active:
+            scheduler = self.schedulers[target]
+            if scheduler.can_send() and self.in_flight < self.window:
+                deadlines.append(self._next_send - now if self.pps else 0)
+            if scheduler.outstanding:
+                deadlines.append(scheduler.timeouts.next_timeout() - now)
+        if not deadlines:
+            return 0
+        return max(0, min(deadlines))
+
+    def done(self) -> bool:
+        """
+        done returns True once every target is done.
+
+        :return: bool
+        """
+        for target in [i for i in self.active if self.schedulers[i].done()]:
+            self.active.remove(target)
+        return not self.active
+
+
+class retrace_schedule:
+    """
+    retrace_schedule decides when each target is due to be traced again, for long running monitoring. Targets start at
+    a random point within their first interval, and every interval after that is stretched or shrunk by up to jitter, so
+    targets with the same interval do not end up being traced in lock step.
+    """
+
+    def __init__(self, targets: dict, jitter: float = 0.1, now: float = 0.0):
+        """
+        :param targets: dict of target -> interval (in seconds) between traces
+        :param jitter: fraction of the interval each round may be moved by, either way
+        :param now: current time, as returned by time.monotonic()
+        """
+        self.intervals = dict(targets)
+        self.jitter = jitter
+        # (time due, target)
+        self._heap = [
+            (now + random.uniform(0, interval), target)
+            for target, interval in self.intervals.items()
+        ]
+        heapq.heapify(self._heap)
+
+    def due(self, now: float) -> list:
+        """
+        due hands out every target whose turn it is. Each of them must be passed to done() once traced.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: list of targets
+        """
+        targets = list()
+        while self._heap and self._heap[0][0] <= now:
+            targets.append(heapq.heappop(self._heap)[1])
+        return targets
+
+    def done(self, target, now: float) -> None:
+        """
+        done schedules the next trace of target, one interval (give or take the jitter) from now.
+
+        :param target: a target handed out by due()
+        :param now: current time, as returned by time.monotonic()
+        """
+        interval = self.intervals[target]
+        interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        heapq.heappush(self._heap, (now + interval, target))
+
+    def next_deadline(self, now: float) -> float:
+        """
+        next_deadline returns how long the caller can wait before the next target is due.
+
+        :param now: current time, as returned by time.monotonic()
+        :return: float: seconds to wait, 0 if a target is due right away
+        """
+        if not self._heap:
+            return 0
+        return max(0, self._heap[0][0] - now)
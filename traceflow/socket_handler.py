@@ -3,40 +3,200 @@ import threading
 import logging
 import platform
 import traceflow
+import traceflow.helpers as helpers
+import traceflow.metrics as metrics
 import struct
+import ctypes
+import collections
+import errno
+import os
+import select
+import time
+
+
+# Linux allows at most UIO_MAXIOV messages per sendmmsg() call
+UIO_MAXIOV = 1024
+# Replies drained per recvmmsg() call, and the room for each. An ICMP error quoting a probe fits easily.
+RECV_BATCH = 64
+RECV_SIZE = 512
+MSG_WAITFORONE = 0x10000
+SO_ATTACH_FILTER = 26
+# Replies a socket_listener keeps by default, enough for 255 paths of 255 hops
+REPLY_CAPACITY = 65536
+# Receive timestamps, taken by the kernel as each packet comes in and handed over as a struct timespec
+SO_TIMESTAMPNS = 35
+_TIMESPEC = struct.Struct("@ll")
+_CMSGHDR = struct.Struct("@Nii")
+CONTROL_SIZE = socket.CMSG_SPACE(_TIMESPEC.size)
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_char * 4),
+        ("sin_zero", ctypes.c_char * 8),
+    ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _get_libc_function(name: str, argtypes: list):
+    """
+    _get_libc_function looks up a function in libc.
+
+    :param name: name of the function
+    :param argtypes: ctypes types of its arguments
+    :return: the ctypes function, or None if this libc does not have it
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError):
+        logging.debug(f"{name} not available, falling back")
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_int
+    return function
+
+
+def _get_sendmmsg():
+    """
+    _get_sendmmsg looks up sendmmsg() in libc.
+
+    :return: the ctypes function, or None if this libc does not have it
+    """
+    return _get_libc_function(
+        "sendmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    )
+
+
+def _get_recvmmsg():
+    """
+    _get_recvmmsg looks up recvmmsg() in libc.
+
+    :return: the ctypes function, or None if this libc does not have it
+    """
+    return _get_libc_function(
+        "recvmmsg",
+        [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p],
+    )
+
+
+def _rx_timestamp(control, length: int) -> int:
+    """
+    _rx_timestamp finds the SO_TIMESTAMPNS timestamp in the control messages of a received packet.
+
+    :param control: buffer holding the control messages
+    :param length: length of the control messages, as returned by the kernel
+    :return: int, nanoseconds since the epoch, or 0 if there is no timestamp
+    """
+    offset = 0
+    while offset + _CMSGHDR.size <= length:
+        cmsg_len, level, type = _CMSGHDR.unpack_from(control, offset)
+        if cmsg_len < _CMSGHDR.size:
+            break
+        if level == socket.SOL_SOCKET and type == SO_TIMESTAMPNS:
+            sec, nsec = _TIMESPEC.unpack_from(control, offset + socket.CMSG_LEN(0))
+            return sec * 1_000_000_000 + nsec
+        offset += socket.CMSG_SPACE(cmsg_len - socket.CMSG_LEN(0))
+    return 0
+
+
+def icmp_filter(udp_dst_port: int) -> bytes:
+    """
+    icmp_filter builds a classic BPF program for a raw ICMP socket, which only passes time exceeded and destination
+    unreachable messages quoting a UDP probe to udp_dst_port. Everything else is dropped in the kernel, before it
+    takes up room in the socket buffer. Our probes never carry IP options, so the quoted UDP header is taken to sit
+    right after a 20 byte IPv4 header.
+
+    :param udp_dst_port: the UDP destination port of our probes
+    :return: bytes, an array of struct sock_filter
+    """
+    program = [
+        # X = length of the outer IPv4 header, A = ICMP type
+        (0xB1, 0, 0, 0),
+        (0x50, 0, 0, 0),
+        # Time exceeded or destination unreachable, or drop
+        (0x15, 1, 0, 11),
+        (0x15, 0, 5, 3),
+        # The quoted packet is UDP, or drop
+        (0x50, 0, 0, 8 + 9),
+        (0x15, 0, 3, socket.IPPROTO_UDP),
+        # The quoted destination port is ours, or drop
+        (0x48, 0, 0, 8 + 20 + 2),
+        (0x15, 0, 1, udp_dst_port),
+        (0x06, 0, 0, 0xFFFF),
+        (0x06, 0, 0, 0),
+    ]
+    return b"".join(struct.pack("HBBI", *i) for i in program)
 
 
 class socket_handler:
-    def __init__(self, daddr):
+    def __init__(self, daddr=None, exit_on_error=True):
+        """
+        :param daddr: destination address for send_ipv4
+        :param exit_on_error: print the error and exit if the raw socket cannot be set up, rather than raising it
+        """
+        self.ip_daddr = daddr
+        self._sendmmsg = None
         try:
-            self.raw_sock = socket.socket(
-                socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW
-            )
-        except PermissionError as e:
+            self.raw_sock = self._open()
+        except OSError as e:
+            if not exit_on_error:
+                raise
             print(e)
-            print("Please run as root!")
+            if isinstance(e, PermissionError):
+                print("Please run as root!")
             exit(1)
-        self.ip_daddr = daddr
+
+    def _open(self) -> socket.socket:
+        """
+        _open sets up the raw socket for this OS.
+
+        :return: socket.socket
+        :raises OSError: if the socket cannot be opened, or raw IP packets cannot be written on this OS
+        """
         os_release = platform.system()
         if os_release == "Darwin":
             # Boned. TODO: Work on fixing this.
-            print("Detected Mac OS - Cannot support writing of raw IP packets, exiting")
-            exit(1)
+            raise OSError("Detected Mac OS - Cannot support writing of raw IP packets")
+        if os_release == "Windows":
+            # No idea - No ability to test. Maybe abort?
+            # TODO: Find testers?
+            logging.debug("Detected NT")
+            raise OSError("Untested on Windows")
+        raw_sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
         if os_release.endswith("BSD"):
             # BSD - Need to explicit set IP_HDRINCL.
             # BSD - Need to explicitly calculate IP total length
-            self.raw_sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+            raw_sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
             logging.debug("Detected a BSD")
         if os_release == "Linux":
             # Linux - No need to set IP_HDRINCL,as setting SOCK_RAW auto sets this. However should be explicit in settings.
-            self.raw_sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+            raw_sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
             logging.debug("Detected Linux")
-        if os_release == "Windows":
-            # No idea - No ability to test. Maybe abort?
-            # TODO: Find testers?
-            logging.debug("Detected NT")
-            print("Untested on Windows - Exiting")
-            exit(1)
+            # Linux - Can hand many datagrams to the kernel in a single syscall
+            self._sendmmsg = _get_sendmmsg()
+        return raw_sock
 
     def send_ipv4(self, packet: bytes) -> int:
         """
@@ -45,8 +205,92 @@ class socket_handler:
         :return: int: the bits put on the wire
         """
         bits = self.raw_sock.sendto(packet, (self.ip_daddr, 0))
+        metrics.PROBES_SENT.inc()
         return bits
 
+    def send_batch(self, probes: list) -> int:
+        """
+        send_batch puts a list of pre-built probes on the wire. On Linux this uses sendmmsg() to push many datagrams per
+        syscall, elsewhere it falls back to a sendto() loop.
+        Each probe is sent to the destination address found in its own IPv4 header.
+
+        On a non-blocking socket the kernel may push back part way through. The probes sent up to that point are
+        counted, and the caller can send the rest, from that offset, once the socket is writable again.
+        BlockingIOError is only raised if not a single probe could be sent.
+
+        :param probes: list of bytes objects, each containing an IPv4 header and encap'd proto packet (ie: udp/tcp)
+        :return: int: the number of probes put on the wire, from the start of probes
+        """
+        start = time.perf_counter()
+        sent = 0
+        try:
+            if self._sendmmsg is None:
+                for probe in probes:
+                    self.raw_sock.sendto(probe, (socket.inet_ntoa(probe[16:20]), 0))
+                    sent += 1
+            else:
+                for offset in range(0, len(probes), UIO_MAXIOV):
+                    chunk = probes[offset : offset + UIO_MAXIOV]
+                    n = self._send_mmsg(chunk)
+                    sent += n
+                    if n < len(chunk):
+                        break
+        except BlockingIOError:
+            if not sent:
+                raise
+        metrics.PHASE_SEND.observe(time.perf_counter() - start)
+        metrics.PROBES_SENT.inc(sent)
+        return sent
+
+    def _send_mmsg(self, probes: list) -> int:
+        """
+        _send_mmsg is an internal method which sends up to UIO_MAXIOV probes with as few sendmmsg() calls as possible
+
+        :param probes: list of bytes objects, each containing an IPv4 packet
+        :return: int: the number of probes put on the wire, fewer than given if the socket would block part way
+        """
+        count = len(probes)
+        # Keep references to every buffer until the syscall is done, ctypes only holds raw pointers
+        bufs = [ctypes.create_string_buffer(probe, len(probe)) for probe in probes]
+        addrs = (_sockaddr_in * count)()
+        iovs = (_iovec * count)()
+        msgs = (_mmsghdr * count)()
+        for i, probe in enumerate(probes):
+            addrs[i].sin_family = socket.AF_INET
+            addrs[i].sin_addr = probe[16:20]
+            iovs[i].iov_base = ctypes.cast(bufs[i], ctypes.c_void_p)
+            iovs[i].iov_len = len(probe)
+            msgs[i].msg_hdr.msg_name = ctypes.cast(
+                ctypes.pointer(addrs[i]), ctypes.c_void_p
+            )
+            msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+        sent = 0
+        fd = self.raw_sock.fileno()
+        while sent < count:
+            msgvec = ctypes.addressof(msgs) + sent * ctypes.sizeof(_mmsghdr)
+            ret = self._sendmmsg(fd, msgvec, count - sent, 0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if sent and err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise OSError(err, os.strerror(err))
+            sent += ret
+        return sent
+
+    def close(self) -> None:
+        """
+        close releases the raw socket. The handler cannot be used to send afterwards.
+        """
+        self.raw_sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     @staticmethod
     def get_egress_ip(daddr: bytes) -> str:
         """
@@ -67,108 +311,499 @@ class socket_handler:
 
 
 class socket_listener:
-    def __init__(self, ip_daddr):
+    def __init__(
+        self,
+        ip_daddr=(),
+        probe_ids=None,
+        udp_dst_port=None,
+        capacity=REPLY_CAPACITY,
+        max_age=None,
+        exit_on_error=True,
+    ):
+        """
+        socket_listener receives ICMP on a background thread, and matches every reply up to the probe it quotes.
+        One listener can be shared by many traces, each registering its destinations with add_destination() and
+        dropping them with remove_destination() once done. close() (or leaving a with block) stops the thread.
+
+        :param ip_daddr: destination address to listen for replies to, or a list of them. Replies are told apart by the
+        destination address quoted back in the ICMP message.
+        :param probe_ids: the probe_id_table the probes were sent with, defaults to the ipid scheme
+        :param udp_dst_port: the UDP destination port of the probes. If given, every other ICMP message is filtered
+        out in the kernel, where supported.
+        :param capacity: maximum number of replies kept, the oldest is evicted to make room for a new one
+        :param max_age: time (in seconds) a reply is kept for, None to keep it until evicted or forgotten. Should be
+        longer than any one trace takes.
+        :param exit_on_error: print the error and exit if the raw socket cannot be opened, rather than raising it
+        """
         # We're only interested in ICMP, so happy to have this hard coded.
         try:
             self.icmp_listener = socket.socket(
                 socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp")
             )
-        except PermissionError as e:
+        except OSError as e:
+            if not exit_on_error:
+                raise
             print(e)
-            print("Please run as root!")
+            if isinstance(e, PermissionError):
+                print("Please run as root!")
             exit(1)
-        # TODO: Test Timestamps correctly
+        # Replies are timestamped by the kernel, so RTTs do not include however long this thread took to wake up.
+        # Where that is not available they are timestamped on receive instead.
         try:
-            SO_TIMESTAMPNS = 35
             self.icmp_listener.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
         except OSError as e:
-            logging.debug("Timestamps not available, continuing without them for now")
-        self.ip_daddr = ip_daddr
+            logging.debug("Kernel timestamps not available, timestamping in Python")
+        # The thread waits in select() on the socket and a pipe, so close() can wake it up by writing to the pipe
+        self.icmp_listener.setblocking(False)
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._stop = threading.Event()
+        self._recvmmsg = None
+        if platform.system() == "Linux":
+            if udp_dst_port is not None:
+                self._attach_filter(udp_dst_port)
+            self._recvmmsg = _get_recvmmsg()
+        if isinstance(ip_daddr, str):
+            self.ip_daddr = ip_daddr
+            self.ip_daddrs = {ip_daddr}
+        else:
+            self.ip_daddr = None
+            self.ip_daddrs = set(ip_daddr)
+        if probe_ids is None:
+            probe_ids = traceflow.probe_id_table()
+        self.probe_ids = probe_ids
+        # Decoded addresses are ints, so replies to other tools can be dropped without turning them into text first.
+        # int daddr -> (daddr, the probe_id_table the probes to it are sent with)
+        self._daddr_ints = {
+            traceflow.packet.ip_to_int(daddr): (daddr, probe_ids)
+            for daddr in self.ip_daddrs
+        }
         self.mutex = threading.Lock()
+        # Signalled whenever a reply is stored
+        self.replies = threading.Condition(self.mutex)
+        # Every reply is decoded once, on receive, and indexed as an icmp_reply record:
+        # daddr -> (path, ttl) -> icmp_reply
+        self.icmp_packets = {daddr: dict() for daddr in self.ip_daddrs}
+        # (daddr, path) -> ttl -> icmp_reply
+        self._by_path = dict()
+        # (daddr, ip_id) -> icmp_reply
+        self._by_ipid = dict()
+        # However much ICMP comes in, no more than capacity replies are kept, nor handed out by wait_for_replies()
+        self.capacity = capacity
+        self.max_age = max_age
+        # (time stored, daddr, path, ttl, icmp_reply) for every reply kept, oldest first. Replies forgotten since are
+        # only dropped from it once they reach the front, or it is compacted; _live is the number still kept.
+        self._stored = collections.deque()
+        self._live = 0
+        # (sequence number, reply) for every reply not handed out by wait_for_replies() yet. Replies to a daddr with
+        # a sequence number up to _forgotten[daddr] were forgotten since, and are skipped.
+        self._new_replies = collections.deque(maxlen=capacity)
+        self._seq = 0
+        self._forgotten = dict()
+        # Replies evicted to stay within capacity or max_age, seen again for the same probe, and not for our probes
+        self.evicted = 0
+        self.duplicates = 0
+        self.foreign = 0
+        self.thread = None
+        self.start()
+
+    def start(self) -> None:
+        """
+        start starts the listener thread. The listener is started on creation, so this is only needed after stop().
+        """
+        if self._running() or self.icmp_listener.fileno() < 0:
+            return
         logging.debug("Starting")
-        self.icmp_packets = dict()
-        t = threading.Thread(target=self.listener)
-        t.setDaemon(True)
-        t.start()
+        self._stop.clear()
+        self.thread = threading.Thread(target=self.listener, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        stop stops the listener thread, and waits for it to finish. Replies received so far can still be read.
+        """
+        self._stop.set()
+        if self._running():
+            os.write(self._wakeup_w, b"\0")
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            # Leave the pipe empty, in case the listener is started again
+            os.read(self._wakeup_r, 1)
+        with self.replies:
+            # Nobody should be left waiting for replies which will never come
+            self.replies.notify_all()
+
+    def _running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def close(self) -> None:
+        """
+        close stops the listener thread and releases its socket. Replies received so far can still be read.
+        """
+        if self.icmp_listener.fileno() < 0:
+            return
+        self.stop()
+        self.icmp_listener.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _attach_filter(self, udp_dst_port: int) -> None:
+        program = ctypes.create_string_buffer(icmp_filter(udp_dst_port))
+        # struct sock_fprog: number of instructions, and a pointer to them
+        fprog = struct.pack("HP", len(program) // 8, ctypes.addressof(program))
+        try:
+            self.icmp_listener.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+        except OSError as e:
+            logging.debug(f"Could not attach BPF filter, filtering in Python only: {e}")
 
     def listener(self):
         """thread worker function"""
         logging.debug("Listening for ICMP...")
-        while True:
-            icmp_packet, curr_addr = self.icmp_listener.recvfrom(512)
-            # Decode the IPv4 packet around the ICMP message
-            i = traceflow.packet_decode.decode_ipv4_header(icmp_packet)
-            # Decode the actual ICMP message inside the IPv4 packet
-            icmp_packet_ret = traceflow.packet_decode.decode_icmp(i["payload"])
-            # And decode the returning IPv4 packet which is the payload inside of the ICMP message
-            ip_id = traceflow.packet_decode.decode_ipv4_header(
-                icmp_packet_ret["payload"]
-            )["ip_id"]
-            # Did we get a TTL Expired (11)?
-            if icmp_packet_ret["type"] == 11:
-                logging.debug(
-                    "Got TTL Expired from %s with ip_id %s" % (curr_addr[0], ip_id)
+        if self._recvmmsg is not None:
+            self._listen_mmsg()
+        else:
+            self._listen()
+        logging.debug("Stopped listening for ICMP")
+
+    def _wait(self) -> bool:
+        """
+        _wait blocks until there is something to read, or the listener is stopped.
+
+        :return: False once the listener has been stopped
+        """
+        select.select([self.icmp_listener, self._wakeup_r], [], [])
+        return not self._stop.is_set()
+
+    def _listen(self) -> None:
+        # One buffer, reused for every packet
+        buf = bytearray(RECV_SIZE)
+        view = memoryview(buf)
+        while self._wait():
+            try:
+                n, ancdata, _, _ = self.icmp_listener.recvmsg_into([buf], CONTROL_SIZE)
+            except (BlockingIOError, InterruptedError):
+                continue
+            rx_time = 0
+            for level, type, data in ancdata:
+                if level == socket.SOL_SOCKET and type == SO_TIMESTAMPNS:
+                    sec, nsec = _TIMESPEC.unpack_from(data)
+                    rx_time = sec * 1_000_000_000 + nsec
+            self._handle(view[:n], rx_time or helpers.time_ns())
+
+    def _listen_mmsg(self) -> None:
+        # RECV_BATCH buffers, set up once and reused for every call
+        bufs = (ctypes.c_char * (RECV_BATCH * RECV_SIZE))()
+        view = memoryview(bufs).cast("B")
+        controls = (ctypes.c_char * (RECV_BATCH * CONTROL_SIZE))()
+        control_view = memoryview(controls).cast("B")
+        iovs = (_iovec * RECV_BATCH)()
+        msgs = (_mmsghdr * RECV_BATCH)()
+        for i in range(RECV_BATCH):
+            iovs[i].iov_base = ctypes.addressof(bufs) + i * RECV_SIZE
+            iovs[i].iov_len = RECV_SIZE
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+            msgs[i].msg_hdr.msg_control = ctypes.addressof(controls) + i * CONTROL_SIZE
+        fd = self.icmp_listener.fileno()
+        msgvec = ctypes.addressof(msgs)
+        while self._wait():
+            # The kernel shrinks msg_controllen to what it filled in, so it has to be reset for every call
+            for i in range(RECV_BATCH):
+                msgs[i].msg_hdr.msg_controllen = CONTROL_SIZE
+            # Takes whatever is queued up, without waiting for more
+            n = self._recvmmsg(fd, msgvec, RECV_BATCH, MSG_WAITFORONE, None)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise OSError(err, os.strerror(err))
+            now = 0
+            for i in range(n):
+                offset = i * RECV_SIZE
+                rx_time = _rx_timestamp(
+                    control_view[i * CONTROL_SIZE : (i + 1) * CONTROL_SIZE],
+                    msgs[i].msg_hdr.msg_controllen,
                 )
-                self.mutex.acquire()
-                self.icmp_packets[ip_id] = i
-                self.mutex.release()
-            ## TODO: Correctly implement a "stop" here
-            if curr_addr[0] == self.ip_daddr:
-                self.mutex.acquire()
-                self.icmp_packets[ip_id] = i
-                self.mutex.release()
-
-    def get_packet_by_ipid(self, ipid: int) -> dict:
-        """
-        get_packet_by_ipid will take in a specific ip.id and find the corresponding packet
-
-        :param ipid: the ip.id of the packet in question
-        :return: dict() which contains the corresponding IP packet
-        """
-        self.mutex.acquire()
-        for packet in self.icmp_packets.keys():
-            icmp_packet = traceflow.packet_decode.decode_icmp(
-                self.icmp_packets[packet]["payload"]
+                if not rx_time:
+                    now = now or helpers.time_ns()
+                    rx_time = now
+                self._handle(view[offset : offset + msgs[i].msg_len], rx_time)
+
+    def _handle(self, icmp_packet, rx_time: int = 0) -> None:
+        """
+        _handle decodes a single ICMP message, and stores it if it answers one of our probes.
+
+        :param icmp_packet: memoryview of the packet, as read from the raw socket
+        :param rx_time: when the packet was received, in nanoseconds since the epoch
+        """
+        # Decode the outer IPv4 header, the ICMP header, and the IPv4 and UDP headers of the probe it quotes,
+        # all in one go and straight from the buffer
+        start = time.perf_counter()
+        try:
+            reply = traceflow.packet_decode.unpack_icmp_reply(icmp_packet)
+        except struct.error:
+            reply = None
+        metrics.PHASE_DECODE.observe(time.perf_counter() - start)
+        if reply is None:
+            # Too short to quote one of our probes
+            self.foreign += 1
+            metrics.REPLIES_FOREIGN.inc()
+            return
+        # Not one of our destinations, so not one of our probes
+        registered = self._daddr_ints.get(reply.daddr)
+        if registered is None:
+            self.foreign += 1
+            metrics.REPLIES_FOREIGN.inc()
+            return
+        (daddr, probe_ids) = registered
+        probe = probe_ids.lookup(daddr, reply.ip_id, reply.src_port, reply.udp_checksum)
+        if probe is None:
+            self.foreign += 1
+            metrics.REPLIES_FOREIGN.inc()
+            return
+        (path, ttl) = probe
+        # A reply from the destination itself, or a port unreachable for a probe to it, ends the path
+        final = reply.saddr == reply.daddr or (reply.type == 3 and reply.code == 3)
+        # Did we get a TTL Expired (11)?
+        if reply.type == 11:
+            logging.debug(
+                "Got TTL Expired from %s with ip_id %s" % (reply.ip_saddr, reply.ip_id)
             )
-            ipv4_packet = traceflow.packet_decode.decode_ipv4_header(
-                icmp_packet["payload"]
+        if reply.type == 11 or final:
+            reply.rx_time = rx_time
+            self._store(daddr, path, ttl, reply, final)
+
+    def add_destination(self, daddr: str, probe_ids=None) -> None:
+        """
+        add_destination starts accepting replies to probes sent to daddr.
+
+        :param daddr: destination IPv4 address, dotted quad
+        :param probe_ids: the probe_id_table the probes to daddr are sent with, defaults to the listener's own
+        """
+        with self.mutex:
+            self.icmp_packets.setdefault(daddr, dict())
+            self.ip_daddrs.add(daddr)
+            self._daddr_ints[traceflow.packet.ip_to_int(daddr)] = (
+                daddr,
+                probe_ids or self.probe_ids,
             )
-            if ipid == ipv4_packet["ip_id"]:
-                return icmp_packet
-        self.mutex.release()
-        return None
 
-    def get_all_packets(self) -> list:
+    def remove_destination(self, daddr: str) -> None:
+        """
+        remove_destination stops accepting replies to probes sent to daddr, and drops every reply stored for it.
+
+        :param daddr: destination IPv4 address, dotted quad
+        """
+        self.remove_destinations([daddr])
+
+    def remove_destinations(self, daddrs) -> None:
+        """
+        remove_destinations is remove_destination for many daddrs at once.
+
+        :param daddrs: iterable of destination IPv4 addresses, dotted quad
+        """
+        daddrs = list(daddrs)
+        self.forget_many(daddrs)
+        with self.mutex:
+            for daddr in daddrs:
+                self._daddr_ints.pop(traceflow.packet.ip_to_int(daddr), None)
+                self.ip_daddrs.discard(daddr)
+                self.icmp_packets.pop(daddr, None)
+
+    def forget(self, daddr: str) -> None:
         """
-        get_all_packets returns all currently captures packets.
+        forget drops every reply stored for daddr, while still accepting new ones. For long running callers which
+        trace the same destination over and over, so the listener does not grow without bound.
 
-        :return: list() of dicts()
+        :param daddr: destination IPv4 address, dotted quad
         """
-        self.mutex.acquire()
-        i = self.icmp_packets
-        self.mutex.release()
-        return i
+        self.forget_many([daddr])
 
-    def get_packets_by_pathid(self, path_id: int) -> list:
+    def forget_many(self, daddrs) -> None:
         """
-        get_packets_by_runid depends on the fact that we intent to manually construct the IPID for each packet, so the
-        top 8 bits correspond to a "run".
+        forget_many is forget for many daddrs at once. Only the replies stored for them are looked at, and the
+        queues shared by every daddr are compacted at most once.
 
-        :param run_id: an int which is 8 bits in size and corresponds to a path.
-        :return: list of packets
+        :param daddrs: iterable of destination IPv4 addresses, dotted quad
         """
-        packets = list()
-        self.mutex.acquire()
-        for packet in self.icmp_packets.keys():
-            icmp_packet = traceflow.packet_decode.decode_icmp(
-                self.icmp_packets[packet]["payload"]
+        with self.mutex:
+            for daddr in daddrs:
+                replies = self.icmp_packets.get(daddr)
+                if replies:
+                    for (path, ttl), reply in replies.items():
+                        self._by_path.pop((daddr, path), None)
+                        if self._by_ipid.get((daddr, reply.ip_id)) is reply:
+                            self._by_ipid.pop((daddr, reply.ip_id))
+                    self._live -= len(replies)
+                    self.icmp_packets[daddr] = dict()
+                # Anything queued up for daddr so far is skipped by wait_for_replies()
+                if self._new_replies:
+                    self._forgotten[daddr] = self._seq
+            # Only once forgotten replies make up most of it, so dropping them stays linear overall
+            if len(self._stored) > 2 * self._live + 1024:
+                self._stored = collections.deque(
+                    i for i in self._stored if self._is_stored(*i[1:])
+                )
+
+    def _is_stored(self, daddr: str, path: int, ttl: int, reply) -> bool:
+        # Caller must hold the mutex
+        return self.icmp_packets.get(daddr, {}).get((path, ttl)) is reply
+
+    def _store(
+        self,
+        daddr: str,
+        path: int,
+        ttl: int,
+        reply: traceflow.packet.icmp_reply,
+        final: bool,
+    ) -> None:
+        """
+        _store records a reply, and wakes up anyone waiting in wait_for_replies(). Whether the reply ends its path
+        is handed out along with it, for the scheduler to stop probing that path.
+
+        :param daddr: the destination address of the probe this reply quotes
+        :param path: the path ID of the probe this reply quotes
+        :param ttl: the TTL of the probe this reply quotes
+        :param reply: the decoded reply
+        :param final: True if the reply came from (or on behalf of) the destination
+        """
+        with self.replies:
+            # The destination may have been removed since the reply was matched up
+            if daddr not in self.icmp_packets:
+                return
+            # Only the first reply to a probe is kept, a retransmission may draw a second one
+            if (path, ttl) in self.icmp_packets[daddr]:
+                self.duplicates += 1
+                metrics.REPLIES_DUPLICATE.inc()
+            else:
+                metrics.REPLIES_MATCHED.inc()
+                now = time.monotonic()
+                self._evict(now)
+                self.icmp_packets[daddr][(path, ttl)] = reply
+                self._by_path.setdefault((daddr, path), dict())[ttl] = reply
+                self._by_ipid[(daddr, reply.ip_id)] = reply
+                self._stored.append((now, daddr, path, ttl, reply))
+                self._live += 1
+            if len(self._new_replies) == self.capacity:
+                # Nobody is reading them, the oldest one goes. Only counted if it was not forgotten already.
+                seq, oldest = self._new_replies[0]
+                if seq > self._forgotten.get(oldest[0], 0):
+                    self.evicted += 1
+                    metrics.REPLIES_EVICTED.inc()
+            self._seq += 1
+            self._new_replies.append(
+                (self._seq, (daddr, path, ttl, final, reply.ip_saddr))
             )
-            ipv4_packet = traceflow.packet_decode.decode_ipv4_header(
-                icmp_packet["payload"]
+            self.replies.notify_all()
+
+    def _evict(self, now: float) -> None:
+        """
+        _evict drops the oldest replies, until there is room for one more and none is older than max_age.
+        Caller must hold the mutex.
+
+        :param now: current time, as returned by time.monotonic()
+        """
+        while self._stored:
+            stored, daddr, path, ttl, reply = self._stored[0]
+            if not self._is_stored(daddr, path, ttl, reply):
+                # Forgotten already
+                self._stored.popleft()
+                continue
+            if self._live < self.capacity and (
+                self.max_age is None or stored >= now - self.max_age
+            ):
+                break
+            self._stored.popleft()
+            self._live -= 1
+            self.icmp_packets[daddr].pop((path, ttl))
+            hops = self._by_path[(daddr, path)]
+            hops.pop(ttl)
+            if not hops:
+                self._by_path.pop((daddr, path))
+            if self._by_ipid.get((daddr, reply.ip_id)) is reply:
+                self._by_ipid.pop((daddr, reply.ip_id))
+            self.evicted += 1
+            metrics.REPLIES_EVICTED.inc()
+
+    def wait_for_replies(self, timeout: float) -> list:
+        """
+        wait_for_replies blocks until at least one new reply has arrived, or the timeout passes.
+        Every reply is handed out exactly once.
+
+        :param timeout: maximum time (in seconds) to block for
+        :return: list of (daddr, path, ttl, final, responder) tuples, one per reply received since the last call
+        """
+        with self.replies:
+            if not self._new_replies:
+                self.replies.wait(timeout)
+            forgotten = self._forgotten
+            new_replies = [
+                reply
+                for seq, reply in self._new_replies
+                if seq > forgotten.get(reply[0], 0)
+            ]
+            # Nothing queued up from before any forget() is left
+            self._new_replies.clear()
+            self._forgotten = dict()
+        return new_replies
+
+    def get_packet_by_ipid(self, ipid: int, daddr: str = None):
+        """
+        get_packet_by_ipid will take in a specific ip.id and find the corresponding reply.
+        Only the ipid probe ID scheme gives every probe its own ip.id.
+
+        :param ipid: the ip.id of the probe in question
+        :param daddr: the destination of the probe, defaults to the one the listener was created for
+        :return: icmp_reply, or None if the probe was not answered
+        """
+        with self.mutex:
+            return self._by_ipid.get((daddr or self.ip_daddr, ipid))
+
+    def get_reply(self, path_id: int, ttl: int, daddr: str = None):
+        """
+        get_reply returns the reply to a single probe.
+
+        :param path_id: the path ID of the probe
+        :param ttl: the TTL of the probe
+        :param daddr: the destination of the probe, defaults to the one the listener was created for
+        :return: icmp_reply, or None if the probe was not answered
+        """
+        with self.mutex:
+            return self.icmp_packets.get(daddr or self.ip_daddr, dict()).get(
+                (path_id, ttl)
             )
-            b = ipv4_packet["ip_id"].to_bytes(2, byteorder="big")
-            (run, ttl) = struct.unpack("!BB", b)
-            if run == path_id:
-                packets.append(self.icmp_packets[packet])
-        self.mutex.release()
-        return packets
+
+    def get_all_packets(self) -> dict:
+        """
+        get_all_packets returns all currently captured replies.
+
+        :return: dict() of destination address -> dict() of (path, ttl) -> icmp_reply
+        """
+        with self.mutex:
+            return {daddr: dict(i) for daddr, i in self.icmp_packets.items()}
+
+    def get_packets_by_daddr(self, daddr: str) -> dict:
+        """
+        get_packets_by_daddr returns the replies captured for a single destination.
+
+        :param daddr: destination IPv4 address, dotted quad
+        :return: dict() of (path, ttl) -> icmp_reply
+        """
+        with self.mutex:
+            return dict(self.icmp_packets.get(daddr, dict()))
+
+    def get_packets_by_pathid(self, path_id: int, daddr: str = None) -> dict:
+        """
+        get_packets_by_pathid returns every reply captured for a single path, as mapped by the probe ID table.
+
+        :param path_id: the path ID
+        :param daddr: the destination of the path, defaults to the one the listener was created for
+        :return: dict() of ttl -> icmp_reply
+        """
+        with self.mutex:
+            return dict(self._by_path.get((daddr or self.ip_daddr, path_id), dict()))
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+""" Streaming API: hop events handed out as soon as they are known, and the traces dict built from them """
+
+import logging
+import time
+
+import traceflow
+import traceflow.helpers as helpers
+import traceflow.metrics as metrics
+
+
+class hop_event:
+    """
+    hop_event is one hop of one path to one target. responder is None if the probe was given up on without a reply.
+    Hops filled in from a stop set rather than probed have no type, code or RTT.
+    """
+
+    __slots__ = ("target", "path", "ttl", "responder", "rtt", "type", "code", "final")
+
+    def __init__(
+        self,
+        target: str,
+        path: int,
+        ttl: int,
+        responder: str = None,
+        rtt: float = None,
+        type: int = None,
+        code: int = None,
+        final: bool = False,
+    ):
+        """
+        :param target: destination address the probe was sent to
+        :param path: path ID of the probe
+        :param ttl: TTL of the probe
+        :param responder: address of the hop which answered, dotted quad
+        :param rtt: round trip time of the probe in milliseconds, None if it could not be measured
+        :param type: ICMP type of the reply
+        :param code: ICMP code of the reply
+        :param final: True if the reply came from (or on behalf of) the destination
+        """
+        self.target = target
+        self.path = path
+        self.ttl = ttl
+        self.responder = responder
+        self.rtt = rtt
+        self.type = type
+        self.code = code
+        self.final = final
+
+    def __repr__(self) -> str:
+        return (
+            f"hop_event({self.target} path {self.path} TTL {self.ttl}: "
+            f"{self.responder}, rtt {self.rtt}, type {self.type} code {self.code})"
+        )
+
+
+class hop_stream:
+    """
+    hop_stream traces a batch of targets, yielding a hop_event for every hop as soon as it is known rather than once
+    every path is done. Each hop is yielded once as answered, though a hop given up on may still be yielded again
+    if its reply turns up late. Nothing past the destination is yielded, once it is known where that is.
+
+    Iterating registers the targets with the listener, and removes them again once done or once the iteration is
+    abandoned. Once done, scheduler holds the batch_scheduler used.
+    """
+
+    def __init__(
+        self,
+        daddrs,
+        listener,
+        sender,
+        probe_ids,
+        tot_runs=4,
+        dst_port=33452,
+        src_port=33452,
+        max_ttl=64,
+        to_wait=1.0,
+        window=32,
+        pps=0,
+        stop_set=None,
+        confidence=None,
+        retries=1,
+        backoff=2.0,
+    ):
+        """
+        :param daddrs: list of destination IPv4 addresses, dotted quad
+        :param listener: the socket_listener to receive replies through, may be shared with other traces
+        :param sender: the socket_handler to send probes through
+        :param probe_ids: the probe_id_table to send probes with
+        :param tot_runs: number of paths to enumerate, or the most flows to use with confidence set
+        :param dst_port: UDP destination port
+        :param src_port: UDP source port, path N uses src_port + N
+        :param max_ttl: Max TTL to reach
+        :param to_wait: time (in seconds) to wait for a reply to each probe
+        :param window: maximum number of probes in flight at once
+        :param pps: maximum number of probes per second, 0 for no limit
+        :param stop_set: traceflow.stop_set to skip hops already known with
+        :param confidence: enumerate paths adaptively (MDA) with this confidence, None to probe tot_runs paths
+        :param retries: number of times to retransmit a probe which got no reply
+        :param backoff: factor the wait grows by with each retransmission
+        """
+        self.daddrs = daddrs
+        self.listener = listener
+        self.sender = sender
+        self.probe_ids = probe_ids
+        self.tot_runs = tot_runs
+        self.dst_port = dst_port
+        self.src_port = src_port
+        self.retries = retries
+        # Rather than walking one path at a time, keep a window of probes in flight across all targets, paths and TTLs.
+        # Replies are matched back up to (path, ttl) through the IP.ID, and to the target through the quoted daddr.
+        # Lost probes are retransmitted on their own, with a growing timeout, rather than waiting on whole paths again
+        self.scheduler = traceflow.batch_scheduler(
+            daddrs,
+            tot_runs,
+            max_ttl,
+            window,
+            pps,
+            to_wait,
+            stop_set,
+            confidence,
+            retries,
+            backoff,
+        )
+
+    def __iter__(self):
+        listener = self.listener
+        probe_ids = self.probe_ids
+        scheduler = self.scheduler
+        run_ids = dict()
+        for path in range(1, self.tot_runs + 1):
+            run_ids[path] = self.src_port + path
+        # Anything left over from an earlier run to these daddrs would be mistaken for a reply to this one
+        listener.forget_many(self.daddrs)
+        for daddr in self.daddrs:
+            listener.add_destination(daddr, probe_ids)
+        # Resolve addresses and pack the headers once per target, each probe only patches TTL, IP.ID and source port
+        fixed_checksum = probe_ids.scheme == "checksum"
+        templates = {
+            daddr: traceflow.probe_template(
+                daddr, self.src_port + 1, self.dst_port, fixed_checksum=fixed_checksum
+            )
+            for daddr in self.daddrs
+        }
+        # (daddr, path, ttl) of every hop answered so far, so each is only yielded once
+        answered = set()
+        # (daddr, path) -> lowest TTL the destination answered at. Probes sent past it before that was known
+        # are answered by the destination again, and are not hops.
+        ends = dict()
+        try:
+            while not scheduler.done():
+                probes = list()
+                before = scheduler.retransmitted
+                batch = scheduler.next_probes(time.monotonic())
+                metrics.PROBES_RETRANSMITTED.inc(scheduler.retransmitted - before)
+                for daddr, path, ttl in batch:
+                    # Here we will combine the path we're after with the TTL,
+                    # and use this to track the returning ICMP payload
+                    port = run_ids[path]
+                    ip_id, checksum = probe_ids.allocate(daddr, path, ttl, port)
+                    probes.append(templates[daddr].build(ttl, ip_id, port, checksum))
+                if probes:
+                    # Same clock as the kernel timestamps replies with, taken as late as possible
+                    sent_at = helpers.time_ns()
+                    for daddr, path, ttl in batch:
+                        probe_ids.sent(daddr, path, ttl, sent_at)
+                    _ = self.sender.send_batch(probes)
+                # Sleep until a reply comes in or the scheduler has something to do.
+                # A reply from the destination stops any higher TTL for that path being sent.
+                timeout = scheduler.next_deadline(time.monotonic())
+                for reply in listener.wait_for_replies(timeout):
+                    (daddr, path, ttl, final, saddr) = reply
+                    # The listener may be shared with runs to other daddrs
+                    if daddr not in scheduler.schedulers:
+                        continue
+                    scheduler.reply(daddr, path, ttl, final, saddr)
+                    if final and ttl < ends.get((daddr, path), ttl + 1):
+                        ends[(daddr, path)] = ttl
+                    if ttl > ends.get((daddr, path), ttl):
+                        continue
+                    if (daddr, path, ttl) not in answered:
+                        answered.add((daddr, path, ttl))
+                        yield self._event(daddr, path, ttl, final, saddr)
+                for daddr, path, ttl in scheduler.expire(time.monotonic()):
+                    logging.debug(
+                        f"No reply from {daddr} path {path} TTL {ttl} "
+                        f"after {self.retries} retries"
+                    )
+                    metrics.PROBES_TIMED_OUT.inc()
+                    if ttl <= ends.get((daddr, path), ttl):
+                        yield hop_event(daddr, path, ttl)
+            # Hops which were not probed, as the stop set already knew them
+            for daddr in self.daddrs:
+                for path, hops in scheduler.schedulers[daddr].filled.items():
+                    for ttl, saddr in hops.items():
+                        if (daddr, path, ttl) not in answered:
+                            yield hop_event(daddr, path, ttl, saddr)
+        finally:
+            listener.remove_destinations(self.daddrs)
+            for daddr in self.daddrs:
+                probe_ids.release(daddr)
+
+    def _event(
+        self, daddr: str, path: int, ttl: int, final: bool, saddr: str
+    ) -> hop_event:
+        """
+        _event builds the hop_event for a reply, from what the listener stored for it.
+
+        :param daddr: destination address of the probe
+        :param path: path ID of the probe
+        :param ttl: TTL of the probe
+        :param final: True if the reply came from (or on behalf of) the destination
+        :param saddr: address of the hop which answered
+        :return: hop_event
+        """
+        reply = self.listener.get_reply(path, ttl, daddr)
+        if reply is None:
+            # Evicted already, all that is left is who answered
+            return hop_event(daddr, path, ttl, saddr, final=final)
+        rtt = self.probe_ids.rtt(daddr, path, ttl, reply.rx_time)
+        if rtt is not None:
+            metrics.RTT.observe(rtt / 1000)
+        return hop_event(
+            daddr, path, ttl, reply.ip_saddr, rtt, reply.type, reply.code, final
+        )
+
+
+def collect_traces(events, daddrs, rtts=None, matrix=False) -> dict:
+    """
+    collect_traces builds the traces dict consumed by traceflow.printer out of a stream of hop events. Missing hops
+    are filled in with a *, and shorter paths padded out with an x.
+
+    :param events: iterable of hop_event, such as a hop_stream
+    :param daddrs: list of destination addresses the events are for
+    :param rtts: if a dict, it is filled in with rtts[daddr][path][ttl], the RTT of each hop in milliseconds
+    :param matrix: return each target's traces as the traceflow.trace_matrix they are built in, rather than a dict
+    :return: dict of daddr -> traces[path][ttl]. The traces are empty if nothing answered.
+    """
+    traces = {daddr: traceflow.trace_matrix() for daddr in daddrs}
+    for event in events:
+        if event.responder is None:
+            continue
+        # Add them to the matrix as: traces[path][ttl]
+        traces[event.target].setdefault(event.path, event.ttl, event.responder)
+        logging.debug("Run: %s TTL: %s" % (event.path, event.ttl))
+        if rtts is not None and event.rtt is not None:
+            rtts.setdefault(event.target, dict()).setdefault(event.path, dict())[
+                event.ttl
+            ] = event.rtt
+    results = dict()
+    for daddr in daddrs:
+        logging.debug(f"rx_icmp for {daddr} is {len(traces[daddr])}")
+        results[daddr] = traces[daddr].pad(daddr)
+        if rtts is not None and daddr in rtts:
+            # Only the hops left once each path is cut off at the destination
+            rtts[daddr] = {
+                path: {
+                    ttl: rtt
+                    for ttl, rtt in hops.items()
+                    if results[daddr][path].get(ttl, "x") != "x"
+                }
+                for path, hops in rtts[daddr].items()
+                if path in results[daddr]
+            }
+        if not matrix:
+            results[daddr] = results[daddr].to_dict()
+    return results
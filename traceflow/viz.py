@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+""" Browser based visualisation: a vis.js page, the topology as JSON, and live updates over Server-Sent Events """
+
+import gzip
+import http.server
+import json
+import logging
+import os
+import pkgutil
+import queue
+import threading
+
+import traceflow.helpers as helpers
+
+# Updates queued up for a single browser before it is considered too slow, and dropped
+SSE_BACKLOG = 1024
+# Time (in seconds) between keepalives on an idle event stream
+SSE_KEEPALIVE = 15.0
+
+
+def _compress(body: bytes):
+    """
+    _compress gzips a body once, for every request which takes gzip.
+
+    :param body: bytes
+    :return: bytes, or None if compressing does not make it any smaller
+    """
+    compressed = gzip.compress(body)
+    if len(compressed) >= len(body):
+        return None
+    return compressed
+
+
+class topology:
+    """
+    topology holds every hop and link between hops seen so far, across all paths and targets, as the vis.js page
+    draws them. Padding (x) is not a hop, and is left out.
+    """
+
+    def __init__(self):
+        # id -> node, and (from, to) -> link, in the order they were seen
+        self.nodes = dict()
+        self.links = dict()
+        # (target, path) -> ttl -> hop, to link each new hop up with its neighbours
+        self._paths = dict()
+
+    def add_hop(self, target: str, path: int, ttl: int, hop: str) -> dict:
+        """
+        add_hop adds a single hop, and links it up with the hops either side of it on its path.
+
+        :param target: destination address of the path
+        :param path: path ID
+        :param ttl: TTL of the hop
+        :param hop: address of the hop, or *
+        :return: dict of the nodes and links which are new, as lists
+        """
+        new = {"nodes": list(), "links": list()}
+        if hop == "x":
+            return new
+        hops = self._paths.setdefault((target, path), dict())
+        hops[ttl] = hop
+        if hop not in self.nodes:
+            self.nodes[hop] = {"id": hop, "label": hop}
+            new["nodes"].append(self.nodes[hop])
+        for a, b in [(hops.get(ttl - 1), hop), (hop, hops.get(ttl + 1))]:
+            if a is None or b is None or (a, b) in self.links:
+                continue
+            self.links[(a, b)] = {"id": f"{a}>{b}", "from": a, "to": b}
+            new["links"].append(self.links[(a, b)])
+        return new
+
+    def add_traces(self, traces: dict, target: str = None) -> None:
+        """
+        add_traces adds every hop of a finished trace.
+
+        :param traces: dict: traces[path][ttl], as used by traceflow.printer
+        :param target: destination address the traces are for
+        """
+        for path in traces:
+            for ttl in sorted(traces[path]):
+                self.add_hop(target, path, ttl, traces[path][ttl])
+
+    def to_dict(self) -> dict:
+        return {"nodes": list(self.nodes.values()), "links": list(self.links.values())}
+
+
+class _viz_handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        viz = self.server.viz
+        if self.path in ["/", "/index.html"]:
+            self._send(viz.index, "text/html; charset=utf-8")
+        elif self.path in ["/nodes.json"]:
+            self._send(viz.snapshot(), "application/json")
+        elif self.path in ["/events"]:
+            self._stream(viz)
+        else:
+            self._send_body(404, b"404: not found", "text/plain")
+
+    def _send(self, asset: tuple, content_type: str) -> None:
+        """
+        _send serves a precomputed asset, compressed if the browser takes gzip, or not at all if it has it already.
+
+        :param asset: tuple of (body, gzipped body or None, ETag)
+        :param content_type: Content-Type of the body
+        """
+        body, compressed, etag = asset
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        encoding = None
+        if compressed is not None and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = compressed
+            encoding = "gzip"
+        self._send_body(200, body, content_type, etag, encoding)
+
+    def _send_body(self, code, body, content_type, etag=None, encoding=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, viz) -> None:
+        """
+        _stream sends every topology update to the browser as it happens, until either side goes away.
+        """
+        # Subscribed before the headers go out, so nothing after them is missed
+        updates = viz.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            while True:
+                try:
+                    update = updates.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    update = b": keepalive\n\n"
+                if update is None:
+                    # Server is shutting down, or we fell too far behind
+                    return
+                self.wfile.write(update)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            viz.unsubscribe(updates)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class viz_server:
+    """
+    viz_server serves the vis.js page, the topology as JSON, and live updates to it as Server-Sent Events, from a
+    thread per connection. The page and the JSON are encoded and compressed once per change rather than per request,
+    and served with an ETag. Every update is encoded once, whoever is watching.
+    """
+
+    def __init__(self, bind_ip: str = "127.0.0.1", port: int = 8081):
+        """
+        :param bind_ip: IP address to bind to
+        :param port: TCP port to listen on
+        """
+        self.topology = topology()
+        self.mutex = threading.Lock()
+        # Bumped on every change, and part of the ETag of the JSON
+        self.version = 0
+        self._snapshot = None
+        self._subscribers = set()
+        # Unique to this server, so a browser never keeps an ETag from an earlier one
+        self._instance = os.urandom(4).hex()
+        page = pkgutil.get_data("traceflow", "var/index.html")
+        self.index = (page, _compress(page), f'"{self._instance}-index"')
+        self.httpd = helpers.threaded_server((bind_ip, port), _viz_handler)
+        self.httpd.viz = self
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self) -> None:
+        """
+        start serves requests on a background thread.
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def serve_forever(self) -> None:
+        """
+        serve_forever serves requests until interrupted, then shuts the server down.
+        """
+        try:
+            if self.thread is None:
+                self.httpd.serve_forever()
+            else:
+                self.thread.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """
+        close stops serving, and ends every event stream.
+        """
+        if self.thread is not None:
+            self.httpd.shutdown()
+        self.httpd.server_close()
+        with self.mutex:
+            for updates in self._subscribers:
+                self._put(updates, None)
+            self._subscribers = set()
+
+    def subscribe(self) -> queue.Queue:
+        """
+        subscribe returns a queue every update from now on is put in, already encoded as an event.
+        """
+        updates = queue.Queue(SSE_BACKLOG)
+        with self.mutex:
+            self._subscribers.add(updates)
+        return updates
+
+    def unsubscribe(self, updates: queue.Queue) -> None:
+        with self.mutex:
+            self._subscribers.discard(updates)
+
+    @staticmethod
+    def _put(updates: queue.Queue, update) -> None:
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            # Too far behind to catch up. The stream is ended, and the browser reconnects and fetches the whole
+            # topology again.
+            with updates.mutex:
+                updates.queue.clear()
+            updates.put_nowait(None)
+
+    def _publish(self, update: dict) -> None:
+        # Caller must hold the mutex. Every update carries the version it brings the topology to, so a browser can
+        # tell which ones the JSON it fetched has in already.
+        self.version += 1
+        self._snapshot = None
+        update["version"] = self.version
+        event = b"data: " + json.dumps(update).encode() + b"\n\n"
+        for updates in list(self._subscribers):
+            self._put(updates, event)
+
+    def add_hop(self, target: str, path: int, ttl: int, hop: str) -> None:
+        """
+        add_hop adds a single hop to the topology, and pushes whatever it adds to every browser watching.
+
+        :param target: destination address of the path
+        :param path: path ID
+        :param ttl: TTL of the hop
+        :param hop: address of the hop
+        """
+        with self.mutex:
+            new = self.topology.add_hop(target, path, ttl, hop)
+            if new["nodes"] or new["links"]:
+                self._publish(new)
+
+    def set_traces(self, traces: dict) -> None:
+        """
+        set_traces replaces the topology with finished traces, and has every browser watching fetch it again.
+
+        :param traces: dict: traces[path][ttl], as used by traceflow.printer
+        """
+        with self.mutex:
+            self.topology = topology()
+            self.topology.add_traces(traces)
+            self._publish({"reset": True})
+
+    def update(self, event) -> None:
+        """
+        update adds the hop a hop event is for. Probes given up on are left out until the trace is done.
+
+        :param event: traceflow.hop_event
+        """
+        if event.responder is not None:
+            self.add_hop(event.target, event.path, event.ttl, event.responder)
+
+    def watch(self, events):
+        """
+        watch passes a stream of hop events through, adding them to the topology along the way.
+
+        :param events: iterable of hop_event, such as a hop_stream
+        :return: generator of the same hop_event
+        """
+        for event in events:
+            self.update(event)
+            yield event
+
+    def snapshot(self) -> tuple:
+        """
+        snapshot returns the topology as JSON, encoded and compressed once per change.
+
+        :return: tuple of (body, gzipped body or None, ETag)
+        """
+        with self.mutex:
+            if self._snapshot is None:
+                body = json.dumps(self.topology.to_dict()).encode()
+                etag = f'"{self._instance}-{self.version}"'
+                self._snapshot = (body, _compress(body), etag)
+            return self._snapshot